@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# scans all (model x modification) combinations of an object swapping scene in parallel
+# each combination is one job, the jobs are distributed to several Blender processes running in the background
+# the state directory keeps the list of jobs and the finished ones, so an interrupted run can be resumed
+# by starting the script again with the same state directory
+#
+# usage: python3 generate_dataset.py scene.blend state_directory --workers 8 --seed 0
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import dirname, abspath, join
+
+directory = dirname(abspath(__file__))
+
+# the script which is executed inside of Blender
+scriptPath = join(directory, "scan_jobs.py")
+
+def runBlender(blenderPath, blendPath, arguments, logPath, scriptPath=scriptPath):
+    # the output of each worker is written to its own log file, as the output of parallel workers would be mixed up
+    # without --python-exit-code, Blender also returns 0 if the script raised an exception
+    with open(logPath, "w") as logFile:
+        return subprocess.run([blenderPath, blendPath, '--background', '--python-exit-code', '1', '--python', scriptPath, '--'] + arguments,
+                              stdout=logFile, stderr=subprocess.STDOUT).returncode
+
+def getJobSeed(seed, model, modification):
+    # the seed only depends on the job itself, not on the order or the worker in which it is scanned
+    key = "%d:%s:%s" % (seed, model[1] if model is not None else "", modification)
+
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:4], "little")
+
+def createManifest(blenderPath, blendPath, stateDirectory, seed):
+    # let Blender list the models and modifications of the scene
+    returnCode = runBlender(blenderPath, blendPath, ["scene", stateDirectory], join(stateDirectory, "logs", "scene.log"))
+
+    if returnCode != 0:
+        raise RuntimeError("Could not read the scene, see %s" % join(stateDirectory, "logs", "scene.log"))
+
+    with open(join(stateDirectory, "scene.json")) as sceneFile:
+        scene = json.load(sceneFile)
+
+    if scene["numberOfModifications"] is None:
+        modifications = [None]
+    else:
+        modifications = list(range(scene["numberOfModifications"]))
+
+    jobs = []
+
+    for model in scene["models"]:
+        for modification in modifications:
+            jobs.append({
+                "id": len(jobs),
+                "model": model,
+                "modification": modification,
+                "seed": getJobSeed(seed, model, modification),
+            })
+
+    manifest = {"blendFile": blendPath, "seed": seed, "jobs": jobs}
+
+    with open(join(stateDirectory, "manifest.json"), "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=4)
+
+    return manifest
+
+def getCompletedJobs(stateDirectory):
+    completedPath = join(stateDirectory, "completed.txt")
+
+    if not os.path.exists(completedPath):
+        return set()
+
+    completedJobs = set()
+
+    with open(completedPath) as completedFile:
+        for line in completedFile:
+            # the last line might be incomplete if a worker was killed while writing it
+            # e.g. "12" instead of "123\n", so only lines with their line break are complete
+            if line.endswith("\n") and line.strip().isdigit():
+                completedJobs.add(int(line))
+
+    return completedJobs
+
+def getBatches(jobs, batchSize):
+    # each batch is scanned by one Blender process, the jobs of a batch belong to the same model,
+    # so that each process only loads the scene and the model once
+    batches = []
+
+    for job in jobs:
+        if len(batches) > 0 and len(batches[-1]) < batchSize and batches[-1][-1]["model"] == job["model"]:
+            batches[-1].append(job)
+        else:
+            batches.append([job])
+
+    return batches
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan all models and modifications of a scene in parallel")
+    parser.add_argument("blendFile", help="scene with the scanner settings, swapping and modification have to be configured in the scanner panel")
+    parser.add_argument("stateDirectory", help="directory for the job list, the finished jobs and the logs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of Blender processes running at the same time")
+    parser.add_argument("--batchSize", type=int, default=8, help="maximum number of jobs per Blender process")
+    parser.add_argument("--seed", type=int, default=0, help="base seed for the random modifications and the noise")
+    parser.add_argument("--blender", default="blender", help="path to the Blender executable")
+    arguments = parser.parse_args()
+
+    blendPath = abspath(arguments.blendFile)
+    stateDirectory = abspath(arguments.stateDirectory)
+
+    os.makedirs(join(stateDirectory, "logs"), exist_ok=True)
+
+    manifestPath = join(stateDirectory, "manifest.json")
+
+    if os.path.exists(manifestPath):
+        # resume an interrupted run with the same jobs
+        with open(manifestPath) as manifestFile:
+            manifest = json.load(manifestFile)
+
+        if manifest["blendFile"] != blendPath:
+            print("WARNING: the state directory was created for %s!" % manifest["blendFile"])
+    else:
+        manifest = createManifest(arguments.blender, blendPath, stateDirectory, arguments.seed)
+
+    completedJobs = getCompletedJobs(stateDirectory)
+    remainingJobs = [job for job in manifest["jobs"] if not job["id"] in completedJobs]
+
+    print("%d of %d jobs already done" % (len(manifest["jobs"]) - len(remainingJobs), len(manifest["jobs"])))
+
+    batches = getBatches(remainingJobs, max(arguments.batchSize, 1))
+
+    failedBatches = 0
+
+    with ThreadPoolExecutor(max_workers=max(arguments.workers, 1)) as executor:
+        futures = {}
+
+        for batch in batches:
+            jobIDs = [str(job["id"]) for job in batch]
+            logPath = join(stateDirectory, "logs", "jobs_%s_to_%s.log" % (jobIDs[0], jobIDs[-1]))
+
+            futures[executor.submit(runBlender, arguments.blender, manifest["blendFile"], ["scan", stateDirectory] + jobIDs, logPath)] = (jobIDs, logPath)
+
+        for batchIndex, future in enumerate(as_completed(futures)):
+            jobIDs, logPath = futures[future]
+
+            if future.result() != 0:
+                failedBatches += 1
+                print("ERROR: jobs %s to %s failed, see %s" % (jobIDs[0], jobIDs[-1], logPath))
+
+            print("Finished %d of %d batches" % (batchIndex + 1, len(batches)))
+
+    completedJobs = getCompletedJobs(stateDirectory)
+
+    print("%d of %d jobs done" % (len(completedJobs), len(manifest["jobs"])))
+
+    if failedBatches > 0:
+        print("Start the script again with the same state directory to retry the remaining jobs.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# scans the animation of a scene with several Blender processes running in the background
+# the frames are split into contiguous parts, each part is scanned by its own process and the
+# geometric results of all frames are exported together afterwards, so that the files are the
+# same as for a scan inside of Blender
+#
+# usage: python3 scan_animation.py scene.blend logs --workers 16
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import dirname, abspath, join
+
+from generate_dataset import runBlender
+
+directory = dirname(abspath(__file__))
+
+# the script which is executed inside of Blender
+scriptPath = join(directory, "scan_frames.py")
+
+def getShards(frames, numberOfShards):
+    # split the frames into contiguous parts of (almost) the same size
+    numberOfShards = max(min(numberOfShards, len(frames)), 1)
+    shardSize, remainder = divmod(len(frames), numberOfShards)
+
+    shards = []
+    start = 0
+
+    for shardIndex in range(numberOfShards):
+        end = start + shardSize + (1 if shardIndex < remainder else 0)
+        shards.append(frames[start:end])
+        start = end
+
+    return shards
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan the animation of a scene with several Blender processes")
+    parser.add_argument("blendFile", help="scene with the scanner settings, the animation has to be enabled in the scanner panel")
+    parser.add_argument("logDirectory", help="directory for the log of each process")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of Blender processes running at the same time")
+    parser.add_argument("--blender", default="blender", help="path to the Blender executable")
+    parser.add_argument("--ignoreSimulations", action="store_true", help="scan in parallel even if the scene contains unbaked simulations")
+    arguments = parser.parse_args()
+
+    blendPath = abspath(arguments.blendFile)
+    logDirectory = abspath(arguments.logDirectory)
+
+    os.makedirs(logDirectory, exist_ok=True)
+
+    # let Blender read the animation settings of the scene
+    if runBlender(arguments.blender, blendPath, ["scene", logDirectory], join(logDirectory, "scene.log"), scriptPath) != 0:
+        print("ERROR: could not read the scene, see %s" % join(logDirectory, "scene.log"))
+        sys.exit(1)
+
+    with open(join(logDirectory, "scene.json")) as sceneFile:
+        scene = json.load(sceneFile)
+
+    # the sonar has no cache for its geometric results
+    if scene["scannerType"] == "sideScan":
+        print("ERROR: the sonar can't be scanned in parallel!")
+        sys.exit(1)
+
+    if not scene["enableAnimation"]:
+        print("ERROR: the animation is not enabled for this scene!")
+        sys.exit(1)
+
+    frames = list(range(scene["frameStart"], scene["frameEnd"] + 1, scene["frameStep"]))
+    shards = getShards(frames, arguments.workers)
+
+    # each process jumps directly to the first frame of its part, unbaked simulations (particles, rigid bodies,
+    # cloth, ...) would then be evaluated differently than in a serial scan, which steps through all frames
+    if len(scene["unbakedSimulations"]) > 0 and len(shards) > 1:
+        print("%s: the scene contains unbaked simulations, the result depends on the parts:" % ("WARNING" if arguments.ignoreSimulations else "ERROR"))
+
+        for simulation in scene["unbakedSimulations"]:
+            print("  %s" % simulation)
+
+        if not arguments.ignoreSimulations:
+            print("Bake the simulations first or start the script with --ignoreSimulations.")
+            sys.exit(1)
+
+    print("Scanning %d frames with %d processes..." % (len(frames), len(shards)))
+
+    failedShards = 0
+
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        futures = {}
+
+        for shard in shards:
+            # the frame step is read from the scene, so the first and last frame define the part
+            logPath = join(logDirectory, "frames_%d_to_%d.log" % (shard[0], shard[-1]))
+
+            futures[executor.submit(runBlender, arguments.blender, blendPath, ["scan", str(shard[0]), str(shard[-1])], logPath, scriptPath)] = (shard, logPath)
+
+        for future in as_completed(futures):
+            shard, logPath = futures[future]
+
+            if future.result() != 0:
+                failedShards += 1
+                print("ERROR: frames %d to %d failed, see %s" % (shard[0], shard[-1], logPath))
+            else:
+                print("Finished frames %d to %d" % (shard[0], shard[-1]))
+
+    if failedShards > 0:
+        sys.exit(1)
+
+    print("Exporting...")
+
+    if runBlender(arguments.blender, blendPath, ["merge"], join(logDirectory, "merge.log"), scriptPath) != 0:
+        print("ERROR: could not export the scan, see %s" % join(logDirectory, "merge.log"))
+        sys.exit(1)
+
+    print("Done.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# this script runs inside of Blender and is started by scan_animation.py
+# usage: blender scene.blend --background --python scan_frames.py -- scene <state directory>
+#        blender scene.blend --background --python scan_frames.py -- scan <first frame> <last frame>
+#        blender scene.blend --background --python scan_frames.py -- merge
+
+import bpy
+import sys
+import os
+import json
+
+# the add-on has to be installed and enabled in Blender
+from range_scanner.ui import user_interface
+from range_scanner.scanners import generic
+from range_scanner.scanners import scan_cache
+
+# all arguments after "--" are ignored by Blender
+arguments = sys.argv[sys.argv.index("--") + 1:]
+
+mode = arguments[0]
+
+context = bpy.context
+properties = context.scene.scannerProperties
+
+dataFileName = generic.removeInvalidCharatersFromFileName(properties.dataFileName)
+
+def getUnbakedSimulations(scene):
+    # simulations which are not baked are evaluated step by step from the first frame
+    # a process which jumps directly to the first frame of its part gets a different result
+    # see: https://docs.blender.org/api/current/bpy.types.PointCache.html
+    simulations = []
+
+    if scene.rigidbody_world is not None and scene.rigidbody_world.enabled and not scene.rigidbody_world.point_cache.is_baked:
+        simulations.append("rigid body world")
+
+    for obj in scene.objects:
+        for particleSystem in obj.particle_systems:
+            # static hair doesn't need a simulation
+            if particleSystem.settings.type == 'HAIR' and not particleSystem.use_hair_dynamics:
+                continue
+
+            if not particleSystem.point_cache.is_baked:
+                simulations.append("%s (particle system %s)" % (obj.name, particleSystem.name))
+
+        for modifier in obj.modifiers:
+            if modifier.type in ('CLOTH', 'SOFT_BODY') and not modifier.point_cache.is_baked:
+                simulations.append("%s (%s)" % (obj.name, modifier.name))
+
+    return simulations
+
+if mode == "scene":
+    # write the animation settings, so that the coordinator can split the frames
+    with open(os.path.join(arguments[1], "scene.json"), "w") as sceneFile:
+        json.dump({
+            "scannerType": properties.scannerType,
+            "enableAnimation": properties.enableAnimation,
+            "frameStart": properties.frameStart,
+            "frameEnd": properties.frameEnd,
+            "frameStep": properties.frameStep,
+            "unbakedSimulations": getUnbakedSimulations(context.scene),
+        }, sceneFile)
+
+elif mode == "scan":
+    # scan the given part of the animation, the geometric result of each frame is stored
+    # in the scan cache and exported by the merge step, as the exports need all frames
+    # the rendered images only belong to a single frame, so they are still exported here
+    properties.frameStart = int(arguments[1])
+    properties.frameEnd = int(arguments[2])
+
+    properties.cacheGeometry = True
+    properties.exportSingleFrames = True
+    properties.addMesh = False
+
+    properties.exportLAS = False
+    properties.exportHDF = False
+    properties.exportCSV = False
+    properties.exportPLY = False
+    properties.exportSegmentedImage = False
+    properties.exportDepthmap = False
+
+    generic.startScan(context, properties, None)
+
+elif mode == "merge":
+    # apply the sensor model to all frames and export them like a serial scan would
+    # the noise only depends on the frame number, so the result doesn't depend on the parts
+    frameRange = (properties.frameStart, properties.frameEnd, properties.frameStep)
+
+    user_interface.resensorizeScan(properties, dataFileName, dataFileName, False, frameRange)
+
+    if not properties.cacheGeometry:
+        # the cached frames were only needed for the merge
+        frameNumbers = range(properties.frameStart, properties.frameEnd + 1, properties.frameStep)
+        echoTypes = generic.getEchoTypes(properties.echoMode)
+
+        for echo in echoTypes:
+            echoSuffix = "_%s_echo" % echo if len(echoTypes) > 1 else ""
+
+            scan_cache.removeFrames(properties.dataFilePath, dataFileName + echoSuffix, frameNumbers)
+
+else:
+    print("Unknown mode %s!" % mode)
+    sys.exit(1)
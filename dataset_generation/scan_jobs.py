@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# this script runs inside of Blender and is started by generate_dataset.py
+# usage: blender scene.blend --background --python scan_jobs.py -- scene <state directory>
+#        blender scene.blend --background --python scan_jobs.py -- scan <state directory> <job id> ...
+
+import bpy
+import sys
+import os
+import json
+import random
+
+# the add-on has to be installed and enabled in Blender
+from range_scanner.ui import user_interface
+
+# all arguments after "--" are ignored by Blender
+arguments = sys.argv[sys.argv.index("--") + 1:]
+
+mode = arguments[0]
+stateDirectory = arguments[1]
+
+context = bpy.context
+properties = context.scene.scannerProperties
+
+if mode == "scene":
+    # write the models and modifications of the scene, so that the job runner can create the jobs
+    if properties.enableSwapping:
+        models = user_interface.getModelFiles(properties.modelsFilePath)
+    else:
+        models = [None]
+
+    if properties.enableModification:
+        numberOfModifications = properties.numberOfModifications
+    else:
+        numberOfModifications = None
+
+    with open(os.path.join(stateDirectory, "scene.json"), "w") as sceneFile:
+        json.dump({"models": models, "numberOfModifications": numberOfModifications}, sceneFile)
+
+elif mode == "scan":
+    with open(os.path.join(stateDirectory, "manifest.json")) as manifestFile:
+        jobs = json.load(manifestFile)["jobs"]
+
+    currentModel = None
+
+    for jobID in map(int, arguments[2:]):
+        job = jobs[jobID]
+
+        print("Scanning job %d..." % jobID)
+
+        if job["model"] is None:
+            objectName = None
+        else:
+            # the jobs of a worker are sorted by model, so each model is only loaded once
+            if job["model"] != currentModel:
+                user_interface.swapModel(context, properties, job["model"][0], job["model"][1])
+                currentModel = job["model"]
+
+            objectName = job["model"][1]
+
+        # the noise of each job is drawn with its own seed, like its modification
+        # IntProperty is a signed 32 bit value
+        properties.noiseSeed = job["seed"] & 0x7FFFFFFF
+
+        if job["modification"] is None:
+            user_interface.modifyAndScan(context, properties, objectName)
+        else:
+            # each modification gets its own seed, so that it doesn't depend on the other jobs of the worker
+            user_interface.modifyAndScan(context, properties, objectName, [job["modification"]], random.Random(job["seed"]))
+
+        # mark the job as done, so that it is skipped if the job runner is started again
+        with open(os.path.join(stateDirectory, "completed.txt"), "a+") as completedFile:
+            # a worker which was killed while writing can leave an incomplete line (see getCompletedJobs in
+            # generate_dataset.py), terminate it with an invalid character so that it isn't continued by this job
+            if completedFile.tell() > 0:
+                completedFile.seek(completedFile.tell() - 1)
+
+                if completedFile.read(1) != "\n":
+                    completedFile.write("-\n")
+
+            completedFile.write("%d\n" % jobID)
+            completedFile.flush()
+            os.fsync(completedFile.fileno())
+
+else:
+    print("Unknown mode %s!" % mode)
+    sys.exit(1)
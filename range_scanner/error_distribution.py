@@ -1,6 +1,45 @@
+import hashlib
 import numpy as np
+from enum import Enum
 
 # for more distributions see: https://numpy.org/doc/stable/reference/random/generator.html#distributions
 
-def applyNoise(mu, sigma):
-    return np.random.default_rng().normal(mu, sigma, None)
\ No newline at end of file
+# each kind of noise gets its own random stream, so that e.g. enabling rain
+# does not change the values of the gaussian sensor noise
+NoiseStream = Enum('NoiseStream', 'gaussian rain')
+
+# all distributions which can be selected by the 'noiseType' property
+# each function returns 'size' samples with the given mean and standard deviation
+distributions = {
+    'gaussian': lambda generator, mu, sigma, size: generator.normal(mu, sigma, size),
+}
+
+class NoiseGenerator:
+    def __init__(self, seed, scanName=""):
+        # Philox expects unsigned 64 bit values
+        self.seed = int(seed) & 0xFFFFFFFFFFFFFFFF
+
+        # scanName: the (file) name of the scan, so that e.g. the scans of different swapped models or
+        # modifications get independent noise, even though their seed and frame numbers are the same
+        self.scanName = scanName
+
+    def getGenerator(self, stream, frameNumber):
+        # we use a counter-based generator: the key is defined by the seed, the scan name and the noise stream,
+        # the counter by the frame number
+        # this way, every (scan, frame, stream) combination has its own reproducible sequence, no matter
+        # in which order (or in which process) the frames are scanned
+        # see: https://numpy.org/doc/stable/reference/random/bit_generators/philox.html
+        streamKey = hashlib.blake2b(("%s|%d" % (self.scanName, stream.value)).encode(), digest_size=8).digest()
+        key = np.array([self.seed, int.from_bytes(streamKey, "little")], dtype=np.uint64)
+        counter = np.array([0, 0, int(frameNumber) & 0xFFFFFFFFFFFFFFFF, 0], dtype=np.uint64)
+
+        return np.random.Generator(np.random.Philox(key=key, counter=counter))
+
+    def frameNoise(self, stream, frameNumber, numberOfRays, noiseType, mu, sigma):
+        # generate the noise for all rays of one frame at once
+        # the value for a ray is selected by its index inside the frame, so the result
+        # does not depend on how the rays are batched
+        if not noiseType in distributions:
+            raise ValueError("Unknown noise type %s!" % noiseType)
+
+        return distributions[noiseType](self.getGenerator(stream, frameNumber), mu, sigma, numberOfRays)
@@ -0,0 +1,58 @@
+import numpy as np
+import os
+import png
+
+# side-scan sonar waterfall image: one row per ping (frame), the port side on the left and the
+# starboard side on the right, the closest range bins in the center
+# the rows are written into a memory-mapped array while scanning, so the memory usage does not
+# depend on the length of the survey
+
+class WaterfallWriter:
+    def __init__(self, filePath, fileName, numberOfPings, numberOfBins, maxRange, bitdepth, useGroundRange):
+        self.filePath = filePath
+        self.fileName = fileName
+        self.numberOfBins = numberOfBins
+        self.maxRange = maxRange
+        self.bitdepth = bitdepth
+        self.useGroundRange = useGroundRange
+
+        dtype = np.uint8 if bitdepth == 8 else np.uint16
+        self.maxValue = np.iinfo(dtype).max
+
+        # .npy file which can be opened with np.load(..., mmap_mode='r') for further processing
+        # see: https://numpy.org/doc/stable/reference/generated/numpy.lib.format.open_memmap.html
+        self.arrayPath = os.path.join(filePath, "%s_waterfall.npy" % fileName)
+        self.rows = np.lib.format.open_memmap(self.arrayPath, mode='w+', dtype=dtype, shape=(numberOfPings, 2 * numberOfBins))
+
+    def addPing(self, pingIndex, isPort, slantRanges, groundRanges, intensities):
+        # isPort, slantRanges, groundRanges, intensities: (N) values of all hits of one ping
+        ranges = np.asarray(groundRanges if self.useGroundRange else slantRanges, dtype=np.float64)
+        isPort = np.asarray(isPort, dtype=bool)
+
+        bins = (ranges / self.maxRange * self.numberOfBins).astype(np.int64)
+        isInside = (bins >= 0) & (bins < self.numberOfBins)
+
+        # the port side is mirrored, so that the range increases from the center to the left
+        columns = np.where(isPort, self.numberOfBins - 1 - bins, self.numberOfBins + bins)[isInside]
+        values = np.round(np.clip(np.asarray(intensities, dtype=np.float64)[isInside], 0.0, 1.0) * self.maxValue)
+
+        # several hits can fall into the same bin, keep the brightest one
+        row = np.zeros(2 * self.numberOfBins, dtype=np.float64)
+        np.maximum.at(row, columns, values)
+
+        self.rows[pingIndex] = row
+        self.rows.flush()
+
+    def close(self):
+        print("Saving waterfall image...")
+
+        self.rows.flush()
+
+        # pypng accepts an iterator of rows, so the image is also written row by row
+        with open(os.path.join(self.filePath, "%s_waterfall.png" % self.fileName), 'wb') as f:
+            w = png.Writer(self.rows.shape[1], self.rows.shape[0], greyscale=True, bitdepth=self.bitdepth)
+            w.write(f, (row for row in self.rows))
+
+        del self.rows
+
+        print("Done.")
@@ -92,7 +92,7 @@ def r_par_amplitude(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = m2 * np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex) # = m*cos(theta_t)
+    d = np.sqrt(m2 - s * s, dtype=complex) # = m*cos(theta_t)
     if m.imag == 0:  # choose right branch for dielectrics
         d = np.conjugate(d)
     rp = (c - d) / (c + d)
@@ -122,7 +122,7 @@ def r_per_amplitude(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex) # = m*cos(theta_t)
+    d = np.sqrt(m2 - s * s, dtype=complex) # = m*cos(theta_t)
     if m.imag == 0:  # choose right branch for dielectrics
         d = np.conjugate(d)
     rs = (c - d) / (c + d)
@@ -152,7 +152,7 @@ def t_par_amplitude(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex) # = m*cos(theta_t)
+    d = np.sqrt(m2 - s * s, dtype=complex) # = m*cos(theta_t)
     if m.imag == 0:  # choose right branch for dielectrics
         d = np.conjugate(d)
     tp = 2 * c * (m/n_i) / (m2 * c + d)
@@ -182,7 +182,7 @@ def t_per_amplitude(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex) # = m*cos(theta_t)
+    d = np.sqrt(m2 - s * s, dtype=complex) # = m*cos(theta_t)
     if m.imag == 0:  # choose right branch for dielectrics
         d = np.conjugate(d)
     ts = 2 * d / (m/n_i)/ (c + d)
@@ -256,7 +256,7 @@ def T_par(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex)
+    d = np.sqrt(m2 - s * s, dtype=complex)
     tp = 2 * c * (m/n_i) / (m2 * c + d)
     return np.abs(d / c * abs(tp)**2)
 
@@ -284,7 +284,7 @@ def T_per(m, theta_i, n_i=1):
     m2 = (m/n_i)**2
     c = np.cos(theta_i)
     s = np.sin(theta_i)
-    d = np.sqrt(m2 - s * s, dtype=np.complex)
+    d = np.sqrt(m2 - s * s, dtype=complex)
     ts = 2 * c / (c + d)
     return np.abs(d / c * abs(ts)**2)
 
@@ -7,6 +7,8 @@ from bpy.types import Scene, Mesh, MeshPolygon, Image
 from collections import namedtuple
 import numpy as np
 
+from .scanners import evaluated_meshes
+
 def getSurfaceReflectivity(color):
     # Blender uses different color models for RGB / HSV / HEX, so there might be some
     # different values in the GUI
@@ -23,6 +25,16 @@ class MaterialProperty:
         self.metallic = metallic
         self.ior = ior
 
+class FaceProperties:
+    def __init__(self, color, reflectivity, metallic, ior, isTextured):
+        # all values are stored per face of the target, so that a face index
+        # can directly be used to look up the material properties
+        self.color = color                  # (F x 4) RGBA
+        self.reflectivity = reflectivity    # (F) alpha channel, see getSurfaceReflectivity
+        self.metallic = metallic            # (F)
+        self.ior = ior                      # (F)
+        self.isTextured = isTextured        # (F) faces which need the texture sampler
+
 class Image:
     def __init__(self, pixels, size):
         self.pixels = pixels
@@ -99,20 +111,78 @@ def getTargetMaterials(debugOutput, target):
 
     return targetMaterials
 
-def getMaterialColorAndMetallic(hit, materialMappings, depsgraph, debugOutput):
+def sampleMaterial(target, faceIndex, location, materialMappings, inverseMatrix=None):
     # each face can have an individual material so we need to get the correct one here
+    materialIndex = materialMappings[target][1][faceIndex]
+    material = materialMappings[target][0][materialIndex]
 
-    materialIndex = materialMappings[hit.target][1][hit.faceIndex]
-    material = materialMappings[hit.target][0][materialIndex]
+    if material.texture is None:
+        return material
 
-    if material.texture is not None:
-        # caculate point location in relation to the hit target
-        newPoint = hit.target.matrix_world.inverted() @ hit.location
+    if inverseMatrix is None:
+        inverseMatrix = target.matrix_world.inverted()
 
-        # retrieve color
-        material.color = getUVPixelColor(hit.target.data, hit.faceIndex, newPoint, material.texture)
-    
-    return material
+    # caculate point location in relation to the hit target
+    newPoint = inverseMatrix @ location
+
+    # retrieve color
+    # IMPORTANT: the material table is shared between all hits (and possibly threads), so we
+    # never write the sampled color back into it, but return a new property object instead
+    # the face index belongs to the evaluated mesh, which can differ from target.data if the object has modifiers
+    color = getUVPixelColor(evaluated_meshes.getMesh(target), faceIndex, newPoint, material.texture)
+
+    return MaterialProperty(color, material.texture, material.metallic, material.ior)
+
+def sampleMaterials(targets, faceIndices, locations, materialMappings):
+    # batched version of sampleMaterial
+    # returns the color (N x 4), metallic (N) and ior (N) values for each (target, faceIndex, location) input
+    # without modifying the material table
+    numberOfHits = len(faceIndices)
+    faceIndices = np.asarray(faceIndices, dtype=np.int64)
+
+    colors = np.zeros((numberOfHits, 4), dtype=np.float64)
+    metallic = np.zeros(numberOfHits, dtype=np.float64)
+    ior = np.zeros(numberOfHits, dtype=np.float64)
+
+    # group all inputs by their target, so that we can gather the values from the
+    # precomputed face arrays in one step per target
+    hitsPerTarget = {}
+    for index, target in enumerate(targets):
+        hitsPerTarget.setdefault(target, []).append(index)
+
+    for target, hitIndices in hitsPerTarget.items():
+        hitIndices = np.asarray(hitIndices, dtype=np.int64)
+        targetFaceIndices = faceIndices[hitIndices]
+
+        faceProperties = materialMappings[target][2]
+
+        colors[hitIndices] = faceProperties.color[targetFaceIndices]
+        metallic[hitIndices] = faceProperties.metallic[targetFaceIndices]
+        ior[hitIndices] = faceProperties.ior[targetFaceIndices]
+
+        # only textured faces need the (slow) texture lookup
+        texturedHits = hitIndices[faceProperties.isTextured[targetFaceIndices]]
+
+        if len(texturedHits) > 0:
+            # inverting the world matrix is only needed for textures, so do it once per target
+            inverseMatrix = target.matrix_world.inverted()
+
+            for index in texturedHits:
+                colors[index] = sampleMaterial(target, faceIndices[index], Vector(locations[index]), materialMappings, inverseMatrix).color
+
+    return (colors, metallic, ior)
+
+def getFaceColor(target, faceIndex, location, materialMappings):
+    # returns the color of a single face, only textured faces need to be sampled
+    faceProperties = materialMappings[target][2]
+
+    if faceProperties.isTextured[faceIndex]:
+        return sampleMaterial(target, faceIndex, location, materialMappings).color
+
+    return faceProperties.color[faceIndex]
+
+def getMaterialColorAndMetallic(hit, materialMappings, depsgraph, debugOutput):
+    return sampleMaterial(hit.target, hit.faceIndex, hit.location, materialMappings)
     """
     if material is not None:
         if material.use_nodes == False:
@@ -260,4 +330,34 @@ def getFaceMaterialMapping(mesh):
     for f in mesh.polygons: 
         mapping[f.index] = f.material_index
 
-    return mapping
\ No newline at end of file
+    return mapping
+
+def getFaceProperties(targetMaterials, faceMaterialMapping):
+    # precompute all material values for each face of a target, so that the
+    # ray caster only needs an array lookup instead of going through the material table
+    materialCount = len(targetMaterials)
+
+    materialColors = np.zeros((materialCount, 4), dtype=np.float64)
+    materialMetallic = np.zeros(materialCount, dtype=np.float64)
+    materialIOR = np.zeros(materialCount, dtype=np.float64)
+    materialIsTextured = np.zeros(materialCount, dtype=bool)
+
+    for materialIndex, material in enumerate(targetMaterials):
+        if material is None:
+            # no material set for this slot
+            continue
+
+        if material.texture is not None:
+            materialIsTextured[materialIndex] = True
+        else:
+            materialColors[materialIndex] = material.color
+
+        materialMetallic[materialIndex] = material.metallic
+        materialIOR[materialIndex] = material.ior
+
+    # blender clamps invalid material indices to the last slot
+    mapping = np.minimum(faceMaterialMapping, max(materialCount - 1, 0))
+
+    color = materialColors[mapping]
+
+    return FaceProperties(color, color[:, 3].copy(), materialMetallic[mapping], materialIOR[mapping], materialIsTextured[mapping])
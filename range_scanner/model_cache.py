@@ -0,0 +1,40 @@
+import bpy
+import hashlib
+import os
+import tempfile
+
+# importing a model (.obj, .fbx, .gltf) and joining its parts takes much longer than scanning it,
+# so the resulting mesh is stored in a .blend file together with its materials
+# appending the mesh from there is fast and doesn't need any import operator
+# the key contains the path, size and modification time of the model, so changed files are imported again
+
+defaultDirectory = os.path.join(tempfile.gettempdir(), "range_scanner_model_cache")
+
+def getCachePath(directory, modelPath):
+    status = os.stat(modelPath)
+    key = "%s|%d|%d" % (os.path.abspath(modelPath), status.st_size, status.st_mtime_ns)
+
+    return os.path.join(directory, "%s.blend" % hashlib.blake2b(key.encode(), digest_size=16).hexdigest())
+
+def loadMesh(cachePath):
+    # append (instead of link) the mesh, so that it can be used like an imported one
+    # see: https://docs.blender.org/api/current/bpy.types.BlendDataLibraries.html#bpy.types.BlendDataLibraries.load
+    with bpy.data.libraries.load(cachePath, link=False) as (dataFrom, dataTo):
+        dataTo.meshes = dataFrom.meshes[:1]
+
+    return dataTo.meshes[0]
+
+def saveMesh(cachePath, mesh):
+    # the materials (and the paths of their images) are written together with the mesh
+    # several processes can share the cache (see dataset_generation), so write to a temporary file
+    # first and rename it afterwards, which is atomic
+    # see: https://docs.blender.org/api/current/bpy.types.BlendDataLibraries.html#bpy.types.BlendDataLibraries.write
+    os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+
+    temporaryPath = "%s.%d.tmp.blend" % (cachePath[:-len(".blend")], os.getpid())
+
+    try:
+        bpy.data.libraries.write(temporaryPath, {mesh}, path_remap='ABSOLUTE')
+        os.replace(temporaryPath, cachePath)
+    except (OSError, RuntimeError) as error:
+        print("WARNING: could not write to model cache: %s" % error)
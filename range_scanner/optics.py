@@ -0,0 +1,101 @@
+import numpy as np
+
+from . import fresnel
+
+# reflection, refraction and transmission at surfaces for whole arrays of rays
+# directions and normals are (N x 3) arrays, so that both scanners can process all rays
+# hitting a surface (glass, water layer, ...) at once
+
+# number of samples of the angle -> transmission lookup tables
+transmissionTableSize = 4096
+
+# lookup tables are cached for each (ior, ior of the incoming medium) combination
+transmissionTables = {}
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float64).reshape(-1, 3)
+    lengths = np.linalg.norm(vectors, axis=1)
+    lengths[lengths == 0.0] = 1.0
+    return vectors / lengths[:, np.newaxis]
+
+def dot(a, b):
+    # row-wise dot product
+    return np.einsum('ij,ij->i', a, b)
+
+def angles(a, b):
+    # row-wise angle between two (normalized) vector arrays, same as mathutils' Vector.angle
+    return np.arccos(np.clip(dot(a, b), -1.0, 1.0))
+
+def reflect(directions, normals):
+    # reflect the incoming rays with the surface normals
+    # see: https://docs.blender.org/api/current/mathutils.html#mathutils.Vector.reflect
+    directions = normalize(directions)
+    normals = normalize(normals)
+
+    return normalize(directions - 2.0 * dot(directions, normals)[:, np.newaxis] * normals)
+
+def refract(directions, normals, n):
+    # send the rays through the surface
+    # n = n1 / n2 is the ratio of the refractive indices of the current and the next medium
+    # (scalar or one value per ray)
+    # returns the normalized new directions and a mask of all rays which are totally reflected,
+    # their direction is undefined
+    # see: https://en.wikipedia.org/wiki/Snell%27s_law
+    #      http://www.starkeffects.com/snells-law-vector.shtml
+    directions = normalize(directions)
+    normals = normalize(normals)
+    n = np.broadcast_to(np.asarray(n, dtype=np.float64), (len(directions),))
+
+    # check if the normal points to the same side of the face as the origin is
+    normals = np.where((dot(normals, directions) > 0.0)[:, np.newaxis], -normals, normals)
+
+    normalCrossDirection = np.cross(normals, directions)
+    radicand = 1 - (n**2) * dot(normalCrossDirection, normalCrossDirection)
+
+    # in case of total internal reflection, no energy passes the surface
+    isTotalInternalReflection = radicand < 0.0
+
+    newDirections = n[:, np.newaxis] * np.cross(normals, -normalCrossDirection) - normals * np.sqrt(np.maximum(radicand, 0.0))[:, np.newaxis]
+
+    return (normalize(newDirections), isTotalInternalReflection)
+
+class TransmissionTable:
+    # precomputed unpolarized fresnel transmission of one material for incidence angles in [0, pi / 2]
+    def __init__(self, ior, n_i):
+        self.angles = np.linspace(0.0, np.pi / 2, transmissionTableSize)
+        self.values = fresnel.T_unpolarized(ior, self.angles, n_i)
+
+    def lookup(self, angles):
+        return np.interp(angles, self.angles, self.values)
+
+def getTransmissionTable(ior, n_i):
+    key = (float(ior), float(n_i))
+
+    if not key in transmissionTables:
+        transmissionTables[key] = TransmissionTable(ior, n_i)
+
+    return transmissionTables[key]
+
+def incidenceAngles(angles):
+    # the angle between ray and normal is > pi / 2 if the normal points away from the ray's origin
+    # the fresnel equations are only defined for the angle to the normal on the incoming side
+    angles = np.asarray(angles, dtype=np.float64)
+    return np.where(angles > np.pi / 2, np.pi - angles, angles)
+
+def transmission(ior, angles, n_i=1, useTable=True):
+    # unpolarized fresnel transmission for each ray, ior can be a scalar or one value per ray
+    # there are usually only a few different glass materials in a scene, so each one
+    # gets its own lookup table
+    angles = incidenceAngles(angles)
+    ior = np.broadcast_to(np.asarray(ior, dtype=np.float64), angles.shape)
+
+    if not useTable:
+        return fresnel.T_unpolarized(ior, angles, n_i)
+
+    result = np.zeros(angles.shape, dtype=np.float64)
+
+    for value in np.unique(ior):
+        mask = ior == value
+        result[mask] = getTransmissionTable(value, n_i).lookup(angles[mask])
+
+    return result
@@ -0,0 +1,36 @@
+import bpy
+
+from . import instances
+
+# the scanned geometry is always taken from the evaluated depsgraph, so that modifiers are
+# considered without applying them to the user's objects
+# faces, materials and UV coordinates of the evaluated meshes are needed in several places,
+# so each object is only evaluated once and kept until its geometry changes, see getBVHTrees
+
+# object name -> copy of the evaluated mesh
+meshes = {}
+
+def getMesh(target, depsgraph=None):
+    # evaluated mesh of a target, instances share the mesh of their source object
+    sourceObject = instances.getSourceObject(target)
+
+    if not sourceObject.name in meshes:
+        if depsgraph is None:
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+
+        # the mesh returned by to_mesh is only valid until the next depsgraph update, so keep a copy
+        # see: https://docs.blender.org/api/current/bpy.types.BlendDataMeshes.html#bpy.types.BlendDataMeshes.new_from_object
+        evaluatedObject = sourceObject.evaluated_get(depsgraph)
+        meshes[sourceObject.name] = bpy.data.meshes.new_from_object(evaluatedObject, preserve_all_data_layers=True, depsgraph=depsgraph)
+
+    return meshes[sourceObject.name]
+
+def invalidate(objectNames):
+    # the geometry of these objects changed, so they are evaluated again when needed
+    for name in objectNames:
+        if name in meshes:
+            bpy.data.meshes.remove(meshes.pop(name))
+
+def clear():
+    # remove all copies from the blend file
+    invalidate(list(meshes.keys()))
@@ -1,19 +1,38 @@
 import bpy
 import sys
 import bmesh
+from mathutils import Vector
 from mathutils.bvhtree import BVHTree
 import numpy as np
 from . import hit_info
+from . import instances
+from . import heightfield
+from . import tiles
+from . import lod
+from . import mesh_cache
+from . import evaluated_meshes
 import os
+import math
 import time
 
 from enum import Enum
 ScannerType = Enum('ScannerType', 'static rotating sideScan')
 
+# real sensors can report more than one return (echo) per emitted pulse
+EchoType = Enum('EchoType', 'strongest first last')
+
+def getEchoTypes(echoMode):
+    # 'all' exports each echo type as its own point cloud
+    if echoMode == 'all':
+        return [echo.name for echo in EchoType]
+
+    return [echoMode]
+
 from . import lidar
 from . import sonar
 from ..export import exporter
 from .. import material_helper
+from .. import error_distribution
 from ..scanners import generic
 
 # source: https://blender.stackexchange.com/a/30739/95167
@@ -51,7 +70,7 @@ def addLine(v1, v2):
     scene.collection.objects.link(obj)
 
 
-def getTargetIndices(targets, debugOutput):
+def getTargetIndices(targets, materialMappings, debugOutput):
     # we need indices to store which point belongs to which object
     # there are to types of indices: 
     #   TOP LEVEL: the category of the top level object in our scene, e.g. chair, table
@@ -102,7 +121,51 @@ def getTargetIndices(targets, debugOutput):
             partIDs[materialName] = partIndex
             partIndex += 1
 
-    return (categoryIDs, partIDs)
+    # now that all indices are known, resolve them once per target (category) and
+    # per face (part), so that labeling a hit is a simple array lookup
+    # target -> (categoryID, partID for each face)
+    targetLabels = {}
+
+    for target in targets:
+        categoryID = np.uint16(categoryIDs[target["categoryID"]])
+
+        faceMaterialMapping = materialMappings[target][1]
+
+        if "partID" in target:
+            facePartIDs = np.full(len(faceMaterialMapping), partIDs[target["partID"]], dtype=np.uint16)
+        else:
+            # use the material of each face as fallback
+            slotPartIDs = np.zeros(max(len(target.material_slots), 1), dtype=np.uint16)
+
+            for slotIndex, slot in enumerate(target.material_slots):
+                if not slot.name in partIDs:
+                    partIDs[slot.name] = partIndex
+                    partIndex += 1
+
+                slotPartIDs[slotIndex] = partIDs[slot.name]
+
+            facePartIDs = slotPartIDs[np.minimum(faceMaterialMapping, len(slotPartIDs) - 1)]
+
+        targetLabels[target] = (categoryID, facePartIDs)
+
+    return (categoryIDs, partIDs, targetLabels)
+
+def assignLabels(hits, targetLabels):
+    # set category/part id for all hits to enable segmentation
+    # the hits are grouped by their target, so the part IDs can be gathered at once
+    hitsPerTarget = {}
+    for index, hit in enumerate(hits):
+        hitsPerTarget.setdefault(hit.target, []).append(index)
+
+    for target, hitIndices in hitsPerTarget.items():
+        categoryID, facePartIDs = targetLabels[target]
+
+        faceIndices = np.fromiter((hits[index].faceIndex for index in hitIndices), dtype=np.int64, count=len(hitIndices))
+        hitPartIDs = facePartIDs[faceIndices]
+
+        for index, partID in zip(hitIndices, hitPartIDs):
+            hits[index].categoryID = int(categoryID)
+            hits[index].partID = int(partID)
 
 def addMeshToScene(name, values, useNoiseLocation):
     # Create new mesh to store all measurements as points
@@ -133,13 +196,24 @@ def addMeshToScene(name, values, useNoiseLocation):
     scene = bpy.context.scene
     scene.collection.objects.link(obj)
 
-def getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debugLines):
+def getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debugLines, mergedTrees=()):
     closestLocation = None
     closestFaceNormal = None
     closestFaceIndex = None
     closestDistance = maxRange
     closestTarget = None
 
+    # the merged static targets are cast first, their closest hit limits the range of all other targets
+    for mergedTree in mergedTrees:
+        location, faceNormal, faceIndex, distance, target = mergedTree.ray_cast(origin, direction, closestDistance)
+
+        if distance is not None and distance < closestDistance:
+            closestLocation = location
+            closestFaceNormal = faceNormal
+            closestFaceIndex = faceIndex
+            closestDistance = distance
+            closestTarget = target
+
     # iterate over all targets to find the closest hit
     for target in targets:
         if debugOutput:
@@ -148,7 +222,7 @@ def getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debu
         # perform the actual ray casting
         # see: https://docs.blender.org/api/current/mathutils.bvhtree.html#mathutils.bvhtree.BVHTree.ray_cast
         #      https://github.com/blender/blender/blob/master/source/blender/blenlib/BLI_kdopbvh.h#L81
-        location, faceNormal, faceIndex, distance = trees[target][0].ray_cast(origin, direction, closestDistance)
+        location, faceNormal, faceIndex, distance = trees[target].ray_cast(origin, direction, closestDistance)
 
         # we use the current closest distance as maximum range, because we don't need to consider geometry which 
         # is further away than the current closest hit
@@ -176,6 +250,67 @@ def getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debu
     else:
         return None
 
+def castRays(targets, trees, origins, directions, maxRanges, debugOutput, debugLines, outputProgress=False):
+    # cast a whole batch of rays and return the closest hit of each ray as columns
+    # origins (N x 3), directions (N x 3), maxRanges (N)
+    numberOfRays = len(origins)
+
+    hits = np.zeros(numberOfRays, dtype=bool)
+    locations = np.zeros((numberOfRays, 3), dtype=np.float64)
+    faceIndices = np.zeros(numberOfRays, dtype=np.int64)
+    distances = np.zeros(numberOfRays, dtype=np.float64)
+    targetIndices = np.full(numberOfRays, -1, dtype=np.int64)
+
+    # hits store the target object, but the columns need an index into the target list
+    indexOfTarget = {target: index for index, target in enumerate(targets)}
+
+    # culled targets are skipped for all rays
+    activeTargets = getActiveTargets(targets, trees)
+    mergedTrees = getMergedTrees(trees)
+
+    # heightfields are cast for all rays at once, their closest hit limits
+    # the range of the remaining targets
+    batchedTargets = [target for target in activeTargets if trees[target].isBatched]
+    activeTargets = [target for target in activeTargets if not trees[target].isBatched]
+
+    closestDistances = np.array(maxRanges, dtype=np.float64)
+
+    for target in batchedTargets:
+        targetHits, targetLocations, targetFaceIndices, targetDistances = trees[target].ray_cast_batch(
+            np.asarray(origins, dtype=np.float64), np.asarray(directions, dtype=np.float64), closestDistances)
+
+        isCloser = targetHits & (targetDistances < closestDistances)
+
+        hits[isCloser] = True
+        locations[isCloser] = targetLocations[isCloser]
+        faceIndices[isCloser] = targetFaceIndices[isCloser]
+        distances[isCloser] = targetDistances[isCloser]
+        targetIndices[isCloser] = indexOfTarget[target]
+
+        closestDistances[isCloser] = targetDistances[isCloser]
+
+    if debugLines:
+        for rayIndex in np.flatnonzero(hits):
+            addLine(Vector(origins[rayIndex]), Vector(locations[rayIndex]))
+
+    # update the progress bar about every percent
+    progressStep = max(numberOfRays // 100, 1)
+
+    for rayIndex in range(numberOfRays):
+        closestHit = getClosestHit(activeTargets, trees, Vector(origins[rayIndex]), Vector(directions[rayIndex]), closestDistances[rayIndex], debugOutput, debugLines, mergedTrees)
+
+        if closestHit is not None:
+            hits[rayIndex] = True
+            locations[rayIndex] = closestHit.location
+            faceIndices[rayIndex] = closestHit.faceIndex
+            distances[rayIndex] = closestHit.distance
+            targetIndices[rayIndex] = indexOfTarget[closestHit.target]
+
+        if outputProgress and (rayIndex + 1) % progressStep == 0:
+            updateProgress("Scanning scene", (rayIndex + 1) / numberOfRays)
+
+    return (hits, locations, faceIndices, distances, targetIndices)
+
 # remove invalid characters
 # source https://blender.stackexchange.com/a/104877
 def removeInvalidCharatersFromFileName(name):  
@@ -219,7 +354,11 @@ def startScan(context, properties, objectName):
     targets = []
     materialMappings = {}
 
-    version = bpy.app.version
+    # graph needed for the evaluated meshes and BVH trees
+    depsgraph = context.evaluated_depsgraph_get()
+
+    # meshes of a previous scan might be outdated
+    evaluated_meshes.clear()
 
     for target in allTargets:
         # we need to know which material belongs to which face, get the mapping for each target
@@ -228,18 +367,6 @@ def startScan(context, properties, objectName):
                 print("No material set for object %s! Skipping..." % target.name)
             continue
         
-        # Blender's modifiers can change an objetc's shape although it seems
-        # already modified in the viewport
-        # so wen need to apply all modifiers here
-        context.view_layer.objects.active = target
-
-        for modifier in target.modifiers:
-            # apply_as was removed, see https://blender.stackexchange.com/a/187711/95167
-            if version >= (2, 91, 0):
-                bpy.ops.object.modifier_apply(modifier=modifier.name)    
-            else:
-                bpy.ops.object.modifier_apply(apply_as='DATA', modifier=modifier.name)
-
         try:
             targetMaterials = material_helper.getTargetMaterials(properties.debugOutput, target)
         except ValueError as e:
@@ -250,16 +377,71 @@ def startScan(context, properties, objectName):
         targets.append(target)
 
         # get the face->material mappings for the current object
-        targetMappings =  material_helper.getFaceMaterialMapping(target.data)
+        # Blender's modifiers can change an object's faces, so the evaluated mesh is used
+        targetMappings =  material_helper.getFaceMaterialMapping(evaluated_meshes.getMesh(target, depsgraph))
+
+        # precompute reflectivity, color, metallic and IOR for each face
+        faceProperties = material_helper.getFaceProperties(targetMaterials, targetMappings)
         
-        materialMappings[target] = (targetMaterials, targetMappings)
+        materialMappings[target] = (targetMaterials, targetMappings, faceProperties)
+
+    if not properties.singleRay:
+        # instanced objects (particles, collection instances, geometry nodes) are scanned without
+        # making them real, all instances of an object share its materials and its BVH tree
+        sourceMappings = {}
+        numberOfInstances = 0
 
-    (categoryIDs, partIDs) = getTargetIndices(targets, properties.debugOutput)
+        for instance in instances.getObjectInstances(depsgraph):
+            sourceObject = instance.sourceObject
+
+            if not sourceObject in sourceMappings:
+                try:
+                    targetMaterials = material_helper.getTargetMaterials(properties.debugOutput, sourceObject)
+                except ValueError as e:
+                    print(e)
+                    print(f"The instances of the object with name {sourceObject.name} will be ignored! ")
+                    sourceMappings[sourceObject] = None
+                    continue
+
+                targetMappings = material_helper.getFaceMaterialMapping(evaluated_meshes.getMesh(sourceObject, depsgraph))
+                faceProperties = material_helper.getFaceProperties(targetMaterials, targetMappings)
+
+                sourceMappings[sourceObject] = (targetMaterials, targetMappings, faceProperties)
+
+            if sourceMappings[sourceObject] is None:
+                continue
+
+            targets.append(instance)
+            materialMappings[instance] = sourceMappings[sourceObject]
+            numberOfInstances += 1
+
+        if properties.debugOutput:
+            print("Found %d instances of %d objects" % (numberOfInstances, len(sourceMappings)))
+
+    (categoryIDs, partIDs, targetLabels) = getTargetIndices(targets, materialMappings, properties.debugOutput)
+
+    # all random values of a scan are derived from this seed and the name of the scan
+    noiseGenerator = error_distribution.NoiseGenerator(properties.noiseSeed, cleanedFileName)
 
     if properties.debugOutput:
         print("CategoryIDs ", categoryIDs)
         print("PartIDs ", partIDs)
 
+    # the prepared geometry of each mesh is stored on disk and reused by later scans
+    if properties.cacheMeshes:
+        meshCache = mesh_cache.MeshCache(mesh_cache.defaultDirectory, properties.meshCacheSize * 1024 * 1024)
+    else:
+        meshCache = None
+
+    # static objects are cast as one merged tree, the swap object changes during the scan
+    if properties.joinMeshes and not properties.singleRay:
+        mergedTargets = getStaticTargets(targets, depsgraph, [properties.swapObject])
+
+        if properties.debugOutput:
+            print("Merging %d static targets into one tree" % len(mergedTargets))
+    else:
+        mergedTargets = []
+
     if properties.scannerType == ScannerType.sideScan.name:
         if properties.scannerObject.matrix_world.translation.z > properties.surfaceHeight:
             print("ERROR: Sensor is above water level!")
@@ -280,20 +462,28 @@ def startScan(context, properties, objectName):
         else:
             depthList = []
 
+        # trees are only rebuilt for deformed objects, see getBVHTrees
+        startGeometryTracking()
+
         sonar.performScan(context, 
                     properties.scannerType, properties.scannerObject,
                     properties.maxDistance,
-                    properties.fovSonar, properties.sonarStepDegree, properties.sonarMode3D, properties.sonarKeepRotation,
+                    properties.fovSonar, properties.sonarStepDegree, properties.sonarMode3D, properties.sonarKeepRotation, properties.sonarMultibeam, properties.numberOfBeams,
                     properties.sourceLevel, properties.noiseLevel, properties.directivityIndex, properties.processingGain, properties.receptionThreshold,   
                     properties.simulateWaterProfile, depthList,   
-                    properties.addNoise, properties.noiseType, properties.mu, properties.sigma, properties.addConstantNoise, properties.noiseAbsoluteOffset, properties.noiseRelativeOffset,
+                    properties.addNoise, properties.noiseType, properties.mu, properties.sigma, properties.addConstantNoise, properties.noiseAbsoluteOffset, properties.noiseRelativeOffset, noiseGenerator,
                     properties.addMesh,
                     properties.exportLAS, properties.exportHDF, properties.exportCSV, properties.exportPLY, properties.exportSingleFrames,
+                    properties.exportWaterfall, properties.waterfallResolution, properties.waterfallBitDepth, properties.waterfallGroundRange,
                     properties.dataFilePath, cleanedFileName,
                     properties.debugLines, properties.debugOutput, properties.outputProgress, properties.measureTime, properties.singleRay, properties.destinationObject, properties.targetObject,
                     properties.enableAnimation, properties.frameStart, properties.frameEnd, properties.frameStep,
+                    properties.levelOfDetail, meshCache, mergedTargets,
                     targets, materialMappings,
-                    categoryIDs, partIDs)
+                    categoryIDs, partIDs, targetLabels)
+
+        stopGeometryTracking()
+        evaluated_meshes.clear()
 
     else:
         if properties.enableAnimation:
@@ -350,24 +540,40 @@ def startScan(context, properties, objectName):
 
         frameRange = range(firstFrame, lastFrame + 1, frameStep)
 
+        # each ray can create one hit per exported echo type
+        echoTypes = getEchoTypes(properties.echoMode)
+
         # array to store hit information
         # we don't know how many of our rays will actually hit an object, so we allocate
         # memory for the worst case of every ray hitting the scene
         # (TODO depending on the RAM usage, it might be a good idea to use some kind of caching/splitting)
-        scannedValues = np.full(len(frameRange) * totalNumberOfRays, None, dtype=hit_info.HitInfo)
+        scannedValues = np.full(len(frameRange) * totalNumberOfRays * len(echoTypes), None, dtype=hit_info.HitInfo)
 
         startIndex = 0
 
-        # graph needed for BVH tree
-        depsgraph = context.evaluated_depsgraph_get()
-
         trees = {}
 
+        # trees are only rebuilt for deformed objects, see getBVHTrees
+        startGeometryTracking()
+
+        # the rays of a static sensor stay inside its field of view unless they are reflected,
+        # a rotating sensor covers all directions
+        if properties.scannerType == ScannerType.static.name and (properties.maxReflectionDepth <= 1 or not hasSecondaryRays(targets, materialMappings)):
+            coneAngle = getFrustumAngle(properties.fovX, properties.fovY)
+        else:
+            coneAngle = None
+
+        # the smallest angle between two neighboring rays
+        if properties.scannerType == ScannerType.static.name:
+            angularResolution = math.radians(min(properties.fovX / stepsX, properties.fovY / stepsY))
+        else:
+            angularResolution = math.radians(min(stepsX, stepsY))
+
+        levelStatistics = {}
+
         for frameNumber in frameRange:
             print("Rendering frame %d..." % frameNumber)
 
-            trees = generic.getBVHTrees(trees, targets, depsgraph)
-
             halfFOV = properties.fovX / 2.0
 
             # get the angle which the sensor needs to cover in the current frame
@@ -386,86 +592,613 @@ def startScan(context, properties, objectName):
                 # be updated before calculating the point data!
                 bpy.context.scene.frame_set(frameNumber)
 
+            # skip all targets which are out of range or outside of the field of view in this frame
+            # and build the trees after the frame change, so that they match the scanned frame
+            if properties.singleRay:
+                visibleTargets = targets
+            else:
+                visibleTargets = getVisibleTargets(targets, depsgraph, properties.scannerObject.matrix_world, properties.distanceUpper, coneAngle)
+
+            if properties.debugOutput:
+                print("%d of %d targets visible" % (len(visibleTargets), len(targets)))
+
+            trees = generic.getBVHTrees(trees, targets, depsgraph, visibleTargets, meshCache, mergedTargets)
+            generic.updateTiles(trees, properties.scannerObject.matrix_world.translation, properties.distanceUpper)
+
+            if properties.levelOfDetail:
+                generic.updateLevelsOfDetail(trees, targets, depsgraph, properties.scannerObject.matrix_world.translation, angularResolution, levelStatistics)
+
             numberOfHits = lidar.performScan(context, 
                                 properties.scannerType, properties.scannerObject,
-                                properties.reflectivityLower, properties.distanceLower, properties.reflectivityUpper, properties.distanceUpper, properties.maxReflectionDepth,
+                                properties.reflectivityLower, properties.distanceLower, properties.reflectivityUpper, properties.distanceUpper, properties.maxReflectionDepth, properties.echoMode,
                                 intervalStart, intervalEnd, properties.fovX, stepsX, properties.fovY, stepsY, properties.resolutionPercentage,
                                 scannedValues, startIndex,
                                 firstFrame, lastFrame, frameNumber, properties.rotationsPerSecond,
-                                properties.addNoise, properties.noiseType, properties.mu, properties.sigma, properties.addConstantNoise, properties.noiseAbsoluteOffset, properties.noiseRelativeOffset,
+                                properties.addNoise, properties.noiseType, properties.mu, properties.sigma, properties.addConstantNoise, properties.noiseAbsoluteOffset, properties.noiseRelativeOffset, noiseGenerator,
                                 properties.simulateRain, properties.rainfallRate,
                                 properties.simulateDust, properties.particleRadius, properties.particlesPcm, properties.dustCloudLength, properties.dustCloudStart,
                                 properties.addMesh and properties.exportSingleFrames,
                                 properties.exportLAS and properties.exportSingleFrames, properties.exportHDF and properties.exportSingleFrames, properties.exportCSV and properties.exportSingleFrames, properties.exportPLY and properties.exportSingleFrames, 
                                 properties.exportRenderedImage, properties.exportSegmentedImage, properties.exportPascalVoc, properties.exportDepthmap, properties.depthMinDistance, properties.depthMaxDistance, 
-                                properties.dataFilePath, cleanedFileName,
+                                properties.dataFilePath, cleanedFileName, properties.cacheGeometry,
                                 properties.debugLines, properties.debugOutput, properties.outputProgress, properties.measureTime, properties.singleRay, properties.destinationObject, properties.targetObject,
                                 targets, materialMappings,
-                                categoryIDs, partIDs, trees, depsgraph)
+                                categoryIDs, partIDs, targetLabels, trees, depsgraph)
 
             startIndex += numberOfHits
 
+        stopGeometryTracking()
+        evaluated_meshes.clear()
+
+        if properties.levelOfDetail:
+            printLevelStatistics(levelStatistics)
+
+        if meshCache is not None and properties.debugOutput:
+            meshCache.printStatistics()
+
         if not properties.exportSingleFrames:
             # we now have the final number of hits so we could shrink the array here
             # as explained here (https://stackoverflow.com/a/32398318/13440564), resizing
             # would cause a copy, so we slice the array instead
             slicedScannedValues = scannedValues[:startIndex]
 
-            if properties.addMesh:
-                addMeshToScene("real_values_frames_%d_to_%d" % (firstFrame, lastFrame), slicedScannedValues, False)
+            exportNoiseData = properties.addNoise or properties.simulateRain
 
-                if (properties.addNoise or properties.simulateRain):
-                    addMeshToScene("noise_values_frames_%d_to_%d" % (firstFrame, lastFrame), slicedScannedValues, True)
+            for echo in echoTypes:
+                # each echo type is exported as its own point cloud
+                if len(echoTypes) > 1:
+                    echoSuffix = "_%s_echo" % echo
+                    echoValues = slicedScannedValues[np.fromiter((hit.echo == echo for hit in slicedScannedValues), dtype=bool, count=len(slicedScannedValues))]
+                else:
+                    echoSuffix = ""
+                    echoValues = slicedScannedValues
+
+                if properties.addMesh:
+                    addMeshToScene("real_values_frames_%d_to_%d%s" % (firstFrame, lastFrame, echoSuffix), echoValues, False)
+
+                    if (properties.addNoise or properties.simulateRain):
+                        addMeshToScene("noise_values_frames_%d_to_%d%s" % (firstFrame, lastFrame, echoSuffix), echoValues, True)
+
+                if len(echoValues) > 0:
+                    # setup exporter with our data
+                    if (properties.exportLAS) or (properties.exportHDF) or (properties.exportCSV) or (properties.exportPLY):
+                        fileExporter = exporter.Exporter(properties.dataFilePath, "%s_frames_%d_to_%d%s" % (cleanedFileName, firstFrame, lastFrame, echoSuffix), cleanedFileName + echoSuffix, echoValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, stepsX, stepsY)
+
+                        print(fileExporter.fileName)
+
+                        # export to each format
+                        if properties.exportLAS:
+                            fileExporter.exportLAS()
+
+                        if properties.exportHDF:
+                            fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_merged" % (firstFrame, lastFrame))
+
+                        if properties.exportCSV:
+                            fileExporter.exportCSV()
+                            
+                        if properties.exportPLY:
+                            fileExporter.exportPLY()
+                else:
+                    print("No data to export!")
+    if properties.measureTime:
+        print("Scan time: %s s" % (time.time() - startTime))
 
-            exportNoiseData = properties.addNoise or properties.simulateRain
+def getLocalFaceNormals(target, depsgraph):
+    # get the face normals of the evaluated mesh in local space
+    # see: https://docs.blender.org/api/current/bpy.types.bpy_prop_collection.html#bpy.types.bpy_prop_collection.foreach_get
+    mesh = evaluated_meshes.getMesh(target, depsgraph)
 
-            if len(slicedScannedValues) > 0:
-                # setup exporter with our data
-                if (properties.exportLAS) or (properties.exportHDF) or (properties.exportCSV) or (properties.exportPLY):
-                    fileExporter = exporter.Exporter(properties.dataFilePath, "%s_frames_%d_to_%d" % (cleanedFileName, firstFrame, lastFrame), cleanedFileName, slicedScannedValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, stepsX, stepsY)
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float64)
+    mesh.polygons.foreach_get("normal", normals)
 
-                    print(fileExporter.fileName)
+    return normals.reshape(-1, 3)
 
-                    # export to each format
-                    if properties.exportLAS:
-                        fileExporter.exportLAS()
+def transformFaceNormals(normals, matrix_world):
+    # normals have to be transformed with the inverse transpose of the world matrix
+    # so that they stay perpendicular to the surface for non-uniformly scaled objects
+    normalMatrix = np.array(matrix_world.to_3x3().inverted_safe().transposed())
+    normals = normals @ normalMatrix.T
 
-                    if properties.exportHDF:
-                        fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_merged" % (firstFrame, lastFrame))
+    # normalize the result, degenerated faces keep their zero normal
+    lengths = np.linalg.norm(normals, axis=1)
+    lengths[lengths == 0.0] = 1.0
 
-                    if properties.exportCSV:
-                        fileExporter.exportCSV()
-                        
-                    if properties.exportPLY:
-                        fileExporter.exportPLY()
-            else:
-                print("No data to export!")
-    if properties.measureTime:
-        print("Scan time: %s s" % (time.time() - startTime))
+    return normals / lengths[:, np.newaxis]
+
+# names of all objects whose evaluated geometry changed since the last frame (armature, shape keys,
+# animated modifiers, ...), collected from the depsgraph updates after each frame change
+updatedGeometry = set()
+
+def collectGeometryUpdates(scene, depsgraph):
+    # transform-only updates (is_updated_transform) don't require a new tree, see TargetTree
+    # see: https://docs.blender.org/api/current/bpy.types.DepsgraphUpdate.html
+    for update in depsgraph.updates:
+        if update.is_updated_geometry and isinstance(update.id, bpy.types.Object):
+            updatedGeometry.add(update.id.original.name)
+
+def startGeometryTracking():
+    updatedGeometry.clear()
+
+    # see: https://docs.blender.org/api/current/bpy.app.handlers.html#bpy.app.handlers.frame_change_post
+    if not collectGeometryUpdates in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.append(collectGeometryUpdates)
+
+def stopGeometryTracking():
+    if collectGeometryUpdates in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(collectGeometryUpdates)
+
+    updatedGeometry.clear()
+
+class MeshTree:
+    # BVH tree of one (evaluated) mesh in the object's local coordinate system
+    # the tree only depends on the geometry, so it is shared by all targets with the same mesh
+    def __init__(self, sourceObject, depsgraph, meshCache=None):
+        self.levelsOfDetail = None
+
+        if "tileSize" in sourceObject:
+            # very large terrains are split into tiles on disk, see updateTiles
+            # the face normals are stored with the tiles, see TargetTree.getFaceNormals
+            self.localFaceNormals = None
+            self.tree = tiles.getTiledTree(sourceObject, depsgraph, meshCache)
+            return
+
+        if meshCache is not None:
+            # the prepared geometry of unchanged meshes is loaded from disk
+            self.localFaceNormals, self.tree = meshCache.getTree(sourceObject, depsgraph)
+            return
+
+        self.localFaceNormals = getLocalFaceNormals(sourceObject, depsgraph)
+
+        # regular grid terrains are intersected as heightfield, which is faster to build and needs less memory
+        self.tree = heightfield.getHeightfieldTree(sourceObject, depsgraph, self.localFaceNormals)
+
+        if self.tree is None:
+            # source: https://developer.blender.org/T57861
+            bm = bmesh.new()
+            bm.from_object(sourceObject, depsgraph=depsgraph)
+            
+            self.tree = BVHTree.FromBMesh(bm)
+
+            bm.free()  # always do this when finished
+
+        # level -> decimated tree, only generated if needed, see updateLevelsOfDetail
+        self.levelsOfDetail = None
+
+    def getLevelOfDetail(self, level, sourceObject, depsgraph):
+        if level == 0:
+            return self.tree
+
+        if self.levelsOfDetail is None:
+            self.levelsOfDetail = lod.getLevelsOfDetail(sourceObject, depsgraph, self.localFaceNormals)
+
+        return self.levelsOfDetail[level]
+
+def getMeshKey(target):
+    # objects without modifiers share the tree of their mesh datablock, the evaluated
+    # geometry of all other objects is unique
+    sourceObject = instances.getSourceObject(target)
+
+    if len(sourceObject.modifiers) == 0:
+        return ('mesh', sourceObject.data.name)
+
+    return ('object', sourceObject.name)
+
+class TargetTree:
+    # the tree of a target's mesh together with the target's transformation
+    # for rigid motion we keep the tree and transform the rays into the object's space instead of rebuilding it
+    def __init__(self, meshTree, matrix_world):
+        self.meshTree = meshTree
+
+        # culled targets can't be hit in the current frame, see getVisibleTargets
+        self.isCulled = False
+
+        # merged targets are cast together with other static targets, see MergedTree
+        self.isMerged = False
+
+        # the tree which is used for ray casting, the original or a decimated one, see updateLevelsOfDetail
+        self.level = 0
+        self.tree = meshTree.tree
+
+        self.setMatrix(matrix_world)
+
+    def setMatrix(self, matrix_world):
+        self.matrix_world = matrix_world.copy()
+        self.matrixInverse = matrix_world.inverted_safe()
+        self.directionMatrix = self.matrixInverse.to_3x3()
+        self.normalMatrix = matrix_world.to_3x3().inverted_safe().transposed()
+
+        # the world space face normals are only computed when they are needed, as most
+        # instances are never hit
+        self.worldFaceNormals = None
+
+    @property
+    def faceNormals(self):
+        if self.worldFaceNormals is None:
+            self.worldFaceNormals = transformFaceNormals(self.meshTree.localFaceNormals, self.matrix_world)
+
+        return self.worldFaceNormals
+
+    def getFaceNormals(self, faceIndices):
+        # world space normals of the given faces
+        if isinstance(self.meshTree.tree, tiles.TiledTree):
+            # tiled terrains only keep the normals of their loaded tiles
+            return transformFaceNormals(self.meshTree.tree.getFaceNormals(faceIndices), self.matrix_world)
+
+        return self.faceNormals[faceIndices]
+
+    def ray_cast(self, origin, direction, distance):
+        # same interface as BVHTree.ray_cast, but origin, direction and all results are in world space
+        localOrigin = self.matrixInverse @ origin
+        localDirection = self.directionMatrix @ direction
+
+        # the tree normalizes the direction, so all distances along the ray are scaled
+        # by the length of the transformed direction
+        scale = localDirection.length / direction.length
+
+        if scale == 0.0:
+            return (None, None, None, None)
+
+        location, faceNormal, faceIndex, localDistance = self.tree.ray_cast(localOrigin, localDirection, distance * scale)
+
+        if location is None:
+            return (None, None, None, None)
+
+        return (self.matrix_world @ location, (self.normalMatrix @ faceNormal).normalized(), faceIndex, localDistance / scale)
+
+    @property
+    def isBatched(self):
+        # heightfields can cast all rays at once
+        return hasattr(self.meshTree.tree, "ray_cast_batch")
+
+    def ray_cast_batch(self, origins, directions, distances):
+        # world space version of HeightfieldTree.ray_cast_batch
+        matrixInverse = np.array(self.matrixInverse)
+
+        localOrigins = origins @ matrixInverse[:3, :3].T + matrixInverse[:3, 3]
+        localDirections = directions @ matrixInverse[:3, :3].T
+
+        scale = np.linalg.norm(localDirections, axis=1) / np.linalg.norm(directions, axis=1)
+
+        hits, localLocations, faceIndices, localDistances = self.meshTree.tree.ray_cast_batch(localOrigins, localDirections, distances * scale)
+
+        matrix = np.array(self.matrix_world)
+
+        locations = localLocations @ matrix[:3, :3].T + matrix[:3, 3]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = np.where(hits, localDistances / scale, 0.0)
+
+        return (hits, locations, faceIndices, distances)
+
+class MergedTree:
+    # one BVH tree in world space over all static targets, so that each ray only traverses a single tree
+    # instead of one tree per object (like joining the objects, but without modifying the scene)
+    # each triangle keeps the index of its target and face, so that labels and materials still resolve
+    def __init__(self, targets, depsgraph):
+        self.targets = targets
+        self.matrices = [target.matrix_world.copy() for target in targets]
+
+        vertices = []
+        triangles = []
+        triangleTargets = []
+        polygonIndices = []
+
+        # world space face normals of each target
+        self.faceNormals = []
+
+        numberOfVertices = 0
+
+        for targetIndex, target in enumerate(targets):
+            mesh = evaluated_meshes.getMesh(target, depsgraph)
+            mesh.calc_loop_triangles()
+
+            matrix = np.array(target.matrix_world)
+
+            targetVertices = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+            mesh.vertices.foreach_get("co", targetVertices)
+            targetVertices = targetVertices.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+            targetTriangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+            mesh.loop_triangles.foreach_get("vertices", targetTriangles)
+
+            targetPolygonIndices = np.empty(len(mesh.loop_triangles), dtype=np.int64)
+            mesh.loop_triangles.foreach_get("polygon_index", targetPolygonIndices)
+
+            vertices.append(targetVertices)
+            triangles.append(targetTriangles.reshape(-1, 3) + numberOfVertices)
+            triangleTargets.append(np.full(len(targetPolygonIndices), targetIndex, dtype=np.int64))
+            polygonIndices.append(targetPolygonIndices)
+
+            self.faceNormals.append(transformFaceNormals(getLocalFaceNormals(target, depsgraph), target.matrix_world))
+
+            numberOfVertices += len(targetVertices)
+
+        self.triangleTargets = np.concatenate(triangleTargets)  # (T) target index of each triangle
+        self.polygonIndices = np.concatenate(polygonIndices)    # (T) face index of each triangle
+
+        self.tree = BVHTree.FromPolygons(np.concatenate(vertices).tolist(), np.concatenate(triangles).tolist())
+
+    def isOutdated(self, targets):
+        # the tree has to be rebuilt if a merged target moved or was deformed
+        return targets != self.targets or \
+               any(target.name in updatedGeometry for target in targets) or \
+               any(target.matrix_world != matrix for target, matrix in zip(targets, self.matrices))
+
+    def ray_cast(self, origin, direction, distance):
+        # same as BVHTree.ray_cast in world space, additionally returns the hit target
+        location, _, triangleIndex, distance = self.tree.ray_cast(origin, direction, distance)
+
+        if location is None:
+            return (None, None, None, None, None)
+
+        targetIndex = self.triangleTargets[triangleIndex]
+        faceIndex = int(self.polygonIndices[triangleIndex])
+
+        return (location, Vector(self.faceNormals[targetIndex][faceIndex]), faceIndex, distance, self.targets[targetIndex])
+
+class MergedTargetTree:
+    # a target which is part of a MergedTree, it is never cast on its own
+    isCulled = False
+    isMerged = True
+    isBatched = False
+
+    def __init__(self, mergedTree, targetIndex):
+        self.mergedTree = mergedTree
+        self.targetIndex = targetIndex
+
+    @property
+    def faceNormals(self):
+        return self.mergedTree.faceNormals[self.targetIndex]
+
+    def getFaceNormals(self, faceIndices):
+        return self.faceNormals[faceIndices]
+
+def getStaticTargets(targets, depsgraph, excludedObjects):
+    # all targets which can be merged into one tree, see MergedTree
+    staticTargets = []
 
-def getBVHTrees(trees, targets, depsgraph):
     for target in targets:
-        # check if the target is already in the tree map
-        if target in trees:
-            # if so, get the old values
-            (existingTree, matrix_world) = trees[target]
+        # instances move with their instancer, tiled terrains are kept on disk
+        if isinstance(target, instances.ObjectInstance) or \
+            target in excludedObjects or \
+            "tileSize" in target:
+                continue
+
+        # exclude animated objects
+        if target.animation_data is not None and target.animation_data.action is not None:
+            continue
+
+        # grid terrains are faster as heightfield, so they keep their own tree
+        # other large meshes (e.g. high-poly models) are merged like all others
+        if heightfield.isHeightfield(target, evaluated_meshes.getMesh(target, depsgraph)):
+            continue
+
+        staticTargets.append(target)
+
+    # a single target is not worth a merged tree
+    if len(staticTargets) < 2:
+        return []
+
+    return staticTargets
+
+def getMergedTrees(trees):
+    # all merged trees which have to be cast in the current frame
+    return list({id(targetTree.mergedTree): targetTree.mergedTree for targetTree in trees.values() if targetTree.isMerged}.values())
+
+def getFrustumAngle(fovX, fovY):
+    # half opening angle of the cone around the viewing direction which contains the whole
+    # rectangular field of view (the angle to its corners)
+    # the static sensor's camera uses the larger FOV as its angle and scales the other axis with the
+    # pixel aspect (see lidar.performScan), so the image plane's extent is proportional to the FOVs
+    # and not to their tangents
+    largerTangent = math.tan(math.radians(max(fovX, fovY)) / 2.0)
+    smallerTangent = largerTangent * min(fovX, fovY) / max(fovX, fovY)
+
+    # small margin for rounding errors, as culled targets silently disappear from the scan
+    return math.atan(math.sqrt(largerTangent**2 + smallerTangent**2)) + math.radians(1.0)
+
+def hasSecondaryRays(targets, materialMappings):
+    # mirrors and glass send rays into other directions than the sensor's field of view
+    for target in targets:
+        faceProperties = materialMappings[target][2]
+
+        if np.any(faceProperties.metallic == 1.0) or np.any(faceProperties.ior > 0.0):
+            return True
+
+    return False
+
+def getVisibleTargets(targets, depsgraph, sensorMatrix, maxRange, coneAngle=None):
+    # cull all targets which can't be hit by any ray of the current frame
+    # each target is approximated by the bounding sphere of its world space bounding box, which is
+    # tested against the maximum range and (optionally) the cone around the sensor's viewing direction
+    # as the range of reflected and refracted rays is reduced by the distance they already traveled,
+    # the range test is also valid for them
+    sensorLocation = np.array(sensorMatrix.translation)
+
+    # "zero" direction of the sensor
+    viewDirection = np.array((sensorMatrix.to_3x3() @ Vector((0.0, 0.0, -1.0))).normalized())
+
+    # the local bounding box only depends on the geometry, so instances can share it
+    localCorners = {}
+
+    visibleTargets = []
+
+    for target in targets:
+        sourceObject = instances.getSourceObject(target)
+
+        if not sourceObject in localCorners:
+            localCorners[sourceObject] = np.array(sourceObject.evaluated_get(depsgraph).bound_box, dtype=np.float64)
+
+        matrix = np.array(target.matrix_world)
+        corners = localCorners[sourceObject] @ matrix[:3, :3].T + matrix[:3, 3]
+
+        center = corners.mean(axis=0)
+        radius = np.max(np.linalg.norm(corners - center, axis=1))
 
-            # if the object did not change its world matrix, we
-            # don't have to recompute the tree
-            if matrix_world == target.matrix_world:
+        toCenter = center - sensorLocation
+        distance = np.linalg.norm(toCenter)
+
+        # the whole sphere is out of range
+        if distance - radius > maxRange:
+            continue
+
+        # the sensor is outside of the sphere, so check if the sphere's silhouette intersects the viewing cone
+        if coneAngle is not None and distance > radius:
+            angle = np.arccos(np.clip(np.dot(toCenter / distance, viewDirection), -1.0, 1.0))
+
+            if angle - np.arcsin(radius / distance) > coneAngle:
                 continue
 
-        # the easy way would be to use this function, but then we would have to transform all
-        # coordinates into the object's local coordinate system
-        #trees[target] = BVHTree.FromObject(target, depsgraph)
-        
-        # source: https://developer.blender.org/T57861
-        bm = bmesh.new()
-        bm.from_object(target, depsgraph=depsgraph)
-        bm.transform(target.matrix_world)
-        
-        trees[target] = (BVHTree.FromBMesh(bm), target.matrix_world.copy())
+        visibleTargets.append(target)
+
+    return visibleTargets
+
+def getActiveTargets(targets, trees):
+    # all targets which have to be tested in the current frame
+    return [target for target in targets if target in trees and not trees[target].isCulled and not trees[target].isMerged]
+
+def updateLevelsOfDetail(trees, targets, depsgraph, sensorLocation, angularResolution, levelStatistics):
+    # choose the level of detail of each target from the distance between two neighboring rays at its location
+    # levelStatistics: target name -> number of frames each level was used
+    sensorLocation = np.array(sensorLocation)
+
+    # the local bounding box only depends on the geometry, so instances can share it
+    localBounds = {}
+
+    for target in targets:
+        targetTree = trees.get(target)
+
+        # heightfields and tiles are not decimated
+        if targetTree is None or targetTree.isCulled or targetTree.isMerged or targetTree.isBatched:
+            continue
+
+        sourceObject = instances.getSourceObject(target)
+
+        if len(targetTree.meshTree.localFaceNormals) < lod.minimumNumberOfFaces:
+            level = 0
+        else:
+            if not sourceObject in localBounds:
+                corners = np.array(sourceObject.evaluated_get(depsgraph).bound_box, dtype=np.float64)
+                localBounds[sourceObject] = (corners.mean(axis=0), np.linalg.norm(corners.max(axis=0) - corners.min(axis=0)))
+
+            localCenter, localDiagonal = localBounds[sourceObject]
+
+            matrix = np.array(target.matrix_world)
+
+            # the largest scaling keeps the size conservative
+            size = localDiagonal * np.linalg.norm(matrix[:3, :3], 2)
+            center = matrix[:3, :3] @ localCenter + matrix[:3, 3]
+
+            # distance to the closest point of the bounding sphere
+            distance = max(np.linalg.norm(center - sensorLocation) - size / 2.0, 0.0)
+
+            level = lod.selectLevel(size, distance * angularResolution)
+
+        if level != targetTree.level:
+            targetTree.level = level
+            targetTree.tree = targetTree.meshTree.getLevelOfDetail(level, sourceObject, depsgraph)
+
+        statistics = levelStatistics.setdefault(target.name, [0] * len(lod.levelCellSizes))
+        statistics[level] += 1
+
+def printLevelStatistics(levelStatistics):
+    print("Level of detail (number of frames x instances for each level):")
+
+    for name, statistics in levelStatistics.items():
+        print("  %s: %s" % (name, ", ".join("level %d: %d" % (level, count) for level, count in enumerate(statistics) if count > 0)))
+
+def updateTiles(trees, sensorLocation, maxRange):
+    # tiled terrains only keep the tiles within the sensor's range in memory
+    # targets sharing the same tiled mesh need the tiles around each of them
+    sensorLocations = {}
+
+    for targetTree in trees.values():
+        if targetTree.isCulled or targetTree.isMerged or not isinstance(targetTree.meshTree.tree, tiles.TiledTree):
+            continue
+
+        matrixInverse = np.array(targetTree.matrixInverse)
+
+        # the range in local space, the largest scaling of the inverse matrix keeps it conservative
+        localLocation = matrixInverse[:3, :3] @ np.array(sensorLocation) + matrixInverse[:3, 3]
+        localRange = maxRange * np.linalg.norm(matrixInverse[:3, :3], 2)
+
+        sensorLocations.setdefault(targetTree.meshTree, []).append((localLocation, localRange))
+
+    for meshTree, locations in sensorLocations.items():
+        meshTree.tree.update([location for location, _ in locations], [localRange for _, localRange in locations])
+
+def getBVHTrees(trees, targets, depsgraph, visibleTargets=None, meshCache=None, mergedTargets=None):
+    # instances follow their instancer, so get their current transformation first
+    instances.updateInstanceMatrices(targets, depsgraph)
+
+    # meshes of deformed objects need a new tree
+    updatedKeys = set(getMeshKey(target) for target in targets if instances.getSourceObject(target).name in updatedGeometry)
+
+    # and have to be evaluated again
+    evaluated_meshes.invalidate(updatedGeometry)
+
+    if mergedTargets:
+        # static targets share one tree in world space
+        mergedTrees = getMergedTrees(trees)
+
+        if len(mergedTrees) == 0 or mergedTrees[0].isOutdated(mergedTargets):
+            mergedTree = MergedTree(mergedTargets, depsgraph)
+
+            for targetIndex, target in enumerate(mergedTargets):
+                trees[target] = MergedTargetTree(mergedTree, targetIndex)
+
+        mergedTargets = set(mergedTargets)
+    else:
+        mergedTargets = set()
+
+    # all targets with the same mesh share one tree, e.g. the instances of a particle system
+    meshTrees = {}
+
+    for target, targetTree in trees.items():
+        if targetTree.isMerged:
+            continue
+
+        meshKey = getMeshKey(target)
+
+        if not meshKey in updatedKeys:
+            meshTrees[meshKey] = targetTree.meshTree
+
+    if visibleTargets is not None:
+        visibleTargets = set(visibleTargets)
+
+    for target in targets:
+        if target in mergedTargets:
+            continue
+
+        meshKey = getMeshKey(target)
+
+        if visibleTargets is not None and not target in visibleTargets:
+            # culled targets are neither (re)built nor moved, but keep their tree for later frames
+            # unless it is outdated
+            if target in trees:
+                if meshKey in updatedKeys:
+                    del trees[target]
+                else:
+                    trees[target].isCulled = True
+
+            continue
+
+        if not meshKey in meshTrees:
+            meshTrees[meshKey] = MeshTree(instances.getSourceObject(target), depsgraph, meshCache)
+
+        # check if the target is already in the tree map
+        if target in trees and trees[target].meshTree is meshTrees[meshKey]:
+            trees[target].isCulled = False
+
+            # the geometry did not change, so we only have to update the
+            # transformation if the object moved
+            if trees[target].matrix_world != target.matrix_world:
+                trees[target].setMatrix(target.matrix_world)
+
+            continue
+
+        trees[target] = TargetTree(meshTrees[meshKey], target.matrix_world)
 
-        bm.free()  # always do this when finished
+    updatedGeometry.clear()
 
-    return trees
\ No newline at end of file
+    return trees
@@ -0,0 +1,402 @@
+import numpy as np
+from mathutils import Vector
+
+# terrains are usually regular grids (e.g. the ANT landscape add-on), which can be intersected
+# much faster and with less memory as heightfield than as generic triangle soup in a BVH tree
+# the rays are marched through the grid cells, empty space above or below the surface is skipped
+# with a min-max mipmap of the cell heights
+# see: Tevs et al., "Maximum Mipmaps for Fast, Accurate, and Scalable Dynamic Height Field Rendering", 2008
+
+# smaller meshes are not worth the detection, as their BVH tree is built fast enough
+# the custom property "heightfield" can be used to force (1) or disable (0) the detection
+minimumNumberOfVertices = 4096
+
+# the corners of a grid cell (i, j), counter clockwise starting at the lower left corner
+#   3 ---- 2
+#   |      |
+#   0 ---- 1
+cornerOffsets = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.int64)
+
+# (di, dj) -> corner index
+cornerIndices = np.array([[0, 3], [1, 2]], dtype=np.int8)
+
+def reduceLevel(values, function, fill):
+    # combine 2x2 blocks of the previous level, odd sizes are padded with a neutral value
+    height, width = values.shape
+    padded = np.full((height + height % 2, width + width % 2), fill, dtype=values.dtype)
+    padded[:height, :width] = values
+
+    return function(padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2), axis=(1, 3))
+
+def intersectTriangles(origins, directions, a, b, c):
+    # Moeller-Trumbore intersection for arrays of rays and triangles, both sides of the triangles are hit
+    # returns the distance to each triangle or inf if it is missed
+    # see: https://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
+    edge1 = b - a
+    edge2 = c - a
+
+    p = np.cross(directions, edge2)
+    determinant = np.einsum('ij,ij->i', edge1, p)
+
+    isParallel = np.abs(determinant) < 1e-12
+    inverseDeterminant = 1.0 / np.where(isParallel, 1.0, determinant)
+
+    s = origins - a
+    u = np.einsum('ij,ij->i', s, p) * inverseDeterminant
+
+    q = np.cross(s, edge1)
+    v = np.einsum('ij,ij->i', directions, q) * inverseDeterminant
+    t = np.einsum('ij,ij->i', edge2, q) * inverseDeterminant
+
+    # small tolerance, so that rays hitting an edge exactly don't pass between the triangles
+    tolerance = 1e-9
+    isHit = ~isParallel & (u >= -tolerance) & (v >= -tolerance) & (u + v <= 1.0 + tolerance) & (t >= 0.0)
+
+    return np.where(isHit, t, np.inf)
+
+class HeightfieldTree:
+    # same interface as BVHTree.ray_cast (local space), additionally all rays can be cast at once
+    def __init__(self, origin, spacing, heights, cellTriangles, cellFaces, faceNormals):
+        self.origin = origin                # (x, y) of the first vertex
+        self.spacing = spacing              # (dx, dy) of the grid
+        self.heights = heights              # (ny x nx) z value of each vertex
+        self.cellTriangles = cellTriangles  # (ny - 1 x nx - 1 x 2 x 3) corner indices of both triangles of a cell
+        self.cellFaces = cellFaces          # (ny - 1 x nx - 1 x 2) face index of both triangles of a cell
+        self.faceNormals = faceNormals      # (F x 3)
+
+        self.cellsY, self.cellsX = cellFaces.shape[:2]
+
+        corners = np.stack((heights[:-1, :-1], heights[:-1, 1:], heights[1:, 1:], heights[1:, :-1]))
+
+        # level n of the mipmap contains the minimum/maximum height of 2^n x 2^n cells
+        self.minimumMaps = [corners.min(axis=0)]
+        self.maximumMaps = [corners.max(axis=0)]
+
+        while max(self.minimumMaps[-1].shape) > 1:
+            self.minimumMaps.append(reduceLevel(self.minimumMaps[-1], np.min, np.inf))
+            self.maximumMaps.append(reduceLevel(self.maximumMaps[-1], np.max, -np.inf))
+
+        self.boxMin = np.array((origin[0], origin[1], self.minimumMaps[-1][0, 0]))
+        self.boxMax = np.array((origin[0] + self.cellsX * spacing[0], origin[1] + self.cellsY * spacing[1], self.maximumMaps[-1][0, 0]))
+
+        # step behind the cell borders, so that the next cell is found
+        self.epsilon = 1e-7 * max(spacing)
+
+    def getBlockExits(self, origins, directions, blockX, blockY, level, rangeEnds):
+        # distance at which the rays leave the given blocks of the mipmap level
+        size = 2**level
+
+        lower = np.stack((self.origin[0] + blockX * size * self.spacing[0], self.origin[1] + blockY * size * self.spacing[1]), axis=1)
+        upper = lower + size * np.asarray(self.spacing)
+
+        bounds = np.where(directions[:, :2] > 0.0, upper, lower)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exits = np.where(directions[:, :2] != 0.0, (bounds - origins[:, :2]) / directions[:, :2], np.inf)
+
+        return np.minimum(exits.min(axis=1), rangeEnds)
+
+    def intersectCells(self, origins, directions, cellX, cellY):
+        # test both triangles of each ray's current cell
+        numberOfRays = len(origins)
+
+        corners = np.empty((numberOfRays, 4, 3), dtype=np.float64)
+
+        for corner, (di, dj) in enumerate(cornerOffsets):
+            corners[:, corner, 0] = self.origin[0] + (cellX + di) * self.spacing[0]
+            corners[:, corner, 1] = self.origin[1] + (cellY + dj) * self.spacing[1]
+            corners[:, corner, 2] = self.heights[cellY + dj, cellX + di]
+
+        rays = np.arange(numberOfRays)
+
+        distances = np.full(numberOfRays, np.inf)
+        faceIndices = np.zeros(numberOfRays, dtype=np.int64)
+
+        for triangle in range(2):
+            triangleCorners = self.cellTriangles[cellY, cellX, triangle]
+
+            triangleDistances = intersectTriangles(origins, directions,
+                                                   corners[rays, triangleCorners[:, 0]],
+                                                   corners[rays, triangleCorners[:, 1]],
+                                                   corners[rays, triangleCorners[:, 2]])
+
+            isCloser = triangleDistances < distances
+
+            distances[isCloser] = triangleDistances[isCloser]
+            faceIndices[isCloser] = self.cellFaces[cellY[isCloser], cellX[isCloser], triangle]
+
+        return (distances, faceIndices)
+
+    def ray_cast_batch(self, origins, directions, maxDistances):
+        # origins (N x 3), directions (N x 3), maxDistances (N)
+        # returns the hit mask, locations, face indices and distances of all rays as columns
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+
+        lengths = np.linalg.norm(directions, axis=1)
+        lengths[lengths == 0.0] = 1.0
+        directions = directions / lengths[:, np.newaxis]
+
+        numberOfRays = len(origins)
+
+        hits = np.zeros(numberOfRays, dtype=bool)
+        faceIndices = np.zeros(numberOfRays, dtype=np.int64)
+        distances = np.zeros(numberOfRays, dtype=np.float64)
+
+        # only march along the part of each ray inside the bounding box of the terrain
+        # see: https://en.wikipedia.org/wiki/Slab_method
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1 = (self.boxMin - origins) / directions
+            t2 = (self.boxMax - origins) / directions
+
+        isParallel = directions == 0.0
+        isInsideSlab = (origins >= self.boxMin) & (origins <= self.boxMax)
+
+        tNear = np.where(isParallel, np.where(isInsideSlab, -np.inf, np.inf), np.minimum(t1, t2))
+        tFar = np.where(isParallel, np.where(isInsideSlab, np.inf, -np.inf), np.maximum(t1, t2))
+
+        t = np.maximum(tNear.max(axis=1), 0.0)
+        rangeEnds = np.minimum(tFar.min(axis=1), maxDistances)
+
+        isActive = t <= rangeEnds
+
+        while True:
+            rays = np.flatnonzero(isActive)
+
+            if len(rays) == 0:
+                break
+
+            rayOrigins = origins[rays]
+            rayDirections = directions[rays]
+            rayRangeEnds = rangeEnds[rays]
+            rayT = t[rays]
+
+            positions = rayOrigins + rayDirections * rayT[:, np.newaxis]
+
+            cellX = np.clip(np.floor((positions[:, 0] - self.origin[0]) / self.spacing[0]).astype(np.int64), 0, self.cellsX - 1)
+            cellY = np.clip(np.floor((positions[:, 1] - self.origin[1]) / self.spacing[1]).astype(np.int64), 0, self.cellsY - 1)
+
+            # skip the largest block which the ray passes completely above or below the surface,
+            # if there is none, test the triangles of the current cell
+            nextT = None
+            isSkipped = np.zeros(len(rays), dtype=bool)
+
+            for level in range(len(self.minimumMaps)):
+                blockX = cellX >> level
+                blockY = cellY >> level
+
+                exits = self.getBlockExits(rayOrigins, rayDirections, blockX, blockY, level, rayRangeEnds)
+
+                startHeights = positions[:, 2]
+                endHeights = rayOrigins[:, 2] + rayDirections[:, 2] * exits
+
+                canSkip = (np.minimum(startHeights, endHeights) > self.maximumMaps[level][blockY, blockX]) | \
+                          (np.maximum(startHeights, endHeights) < self.minimumMaps[level][blockY, blockX])
+
+                if nextT is None:
+                    # the exit of the current cell
+                    nextT = exits
+                else:
+                    nextT = np.where(canSkip, exits, nextT)
+
+                isSkipped |= canSkip
+
+            tested = np.flatnonzero(~isSkipped)
+
+            if len(tested) > 0:
+                cellDistances, cellFaceIndices = self.intersectCells(rayOrigins[tested], rayDirections[tested], cellX[tested], cellY[tested])
+
+                isHit = cellDistances <= rayRangeEnds[tested]
+                hitRays = rays[tested[isHit]]
+
+                hits[hitRays] = True
+                distances[hitRays] = cellDistances[isHit]
+                faceIndices[hitRays] = cellFaceIndices[isHit]
+
+                isActive[hitRays] = False
+
+            # always move forward, even if a ray ends exactly on a cell border
+            t[rays] = np.maximum(nextT, rayT) + self.epsilon
+            isActive[rays] &= t[rays] <= rayRangeEnds
+
+        locations = origins + directions * distances[:, np.newaxis]
+
+        return (hits, locations, faceIndices, distances)
+
+    def ray_cast(self, origin, direction, distance):
+        hits, locations, faceIndices, distances = self.ray_cast_batch(np.array([origin]), np.array([direction]), np.array([distance]))
+
+        if not hits[0]:
+            return (None, None, None, None)
+
+        return (Vector(locations[0]), Vector(self.faceNormals[faceIndices[0]]), int(faceIndices[0]), float(distances[0]))
+
+def fromArrays(vertices, loopStarts, loopTotals, loopVertices, faceNormals):
+    # detect if the mesh is a regular grid in the local XY plane with one triangulated
+    # or quad cell between each 2x2 vertices, returns None otherwise
+    numberOfVertices = len(vertices)
+
+    if numberOfVertices < 4 or np.any((loopTotals != 3) & (loopTotals != 4)):
+        return None
+
+    minimum = vertices[:, :2].min(axis=0)
+    maximum = vertices[:, :2].max(axis=0)
+
+    tolerance = 1e-6 * max(np.max(maximum - minimum), 1e-9)
+
+    # number of different X and Y coordinates
+    numberOfColumns = len(np.unique(np.round((vertices[:, 0] - minimum[0]) / tolerance)))
+    numberOfRows = len(np.unique(np.round((vertices[:, 1] - minimum[1]) / tolerance)))
+
+    if numberOfColumns < 2 or numberOfRows < 2 or numberOfColumns * numberOfRows != numberOfVertices:
+        return None
+
+    spacing = (maximum - minimum) / (numberOfColumns - 1, numberOfRows - 1)
+
+    # grid coordinates of each vertex, the spacing has to be regular
+    gridX = np.round((vertices[:, 0] - minimum[0]) / spacing[0]).astype(np.int64)
+    gridY = np.round((vertices[:, 1] - minimum[1]) / spacing[1]).astype(np.int64)
+
+    if np.any(np.abs(minimum[0] + gridX * spacing[0] - vertices[:, 0]) > tolerance) or \
+        np.any(np.abs(minimum[1] + gridY * spacing[1] - vertices[:, 1]) > tolerance):
+            return None
+
+    # each grid position has exactly one vertex
+    if len(np.unique(gridY * numberOfColumns + gridX)) != numberOfVertices:
+        return None
+
+    heights = np.empty((numberOfRows, numberOfColumns), dtype=np.float64)
+    heights[gridY, gridX] = vertices[:, 2]
+
+    # split all faces into triangles of grid corners
+    triangleCells = []
+    triangleCorners = []
+    triangleFaces = []
+
+    for faceSize, splits in ((3, [(0, 1, 2)]), (4, [(0, 1, 2), (0, 2, 3)])):
+        faces = np.flatnonzero(loopTotals == faceSize)
+
+        if len(faces) == 0:
+            continue
+
+        faceVertices = loopVertices[loopStarts[faces, np.newaxis] + np.arange(faceSize)]
+
+        faceX = gridX[faceVertices]
+        faceY = gridY[faceVertices]
+
+        cellX = faceX.min(axis=1)
+        cellY = faceY.min(axis=1)
+
+        offsetX = faceX - cellX[:, np.newaxis]
+        offsetY = faceY - cellY[:, np.newaxis]
+
+        # all vertices of a face have to be corners of the same cell
+        if np.any(offsetX > 1) or np.any(offsetY > 1):
+            return None
+
+        corners = cornerIndices[offsetX, offsetY]
+
+        # no face may use a corner twice
+        if np.any(np.sort(corners, axis=1)[:, 1:] == np.sort(corners, axis=1)[:, :-1]):
+            return None
+
+        if faceSize == 4:
+            # quads are split along the diagonal of their first vertex, so the corners have to be in order
+            if np.any((corners[:, 1] - corners[:, 0]) % 4 != (corners[:, 2] - corners[:, 1]) % 4):
+                return None
+
+        for split in splits:
+            triangleCells.append(cellY * (numberOfColumns - 1) + cellX)
+            triangleCorners.append(corners[:, split])
+            triangleFaces.append(faces)
+
+    triangleCells = np.concatenate(triangleCells)
+    triangleCorners = np.concatenate(triangleCorners)
+    triangleFaces = np.concatenate(triangleFaces)
+
+    # each cell has to be covered by exactly two triangles
+    numberOfCells = (numberOfRows - 1) * (numberOfColumns - 1)
+
+    if len(triangleCells) != 2 * numberOfCells or np.any(np.bincount(triangleCells, minlength=numberOfCells) != 2):
+        return None
+
+    order = np.argsort(triangleCells, kind='stable')
+
+    cellTriangles = triangleCorners[order].reshape(numberOfRows - 1, numberOfColumns - 1, 2, 3).astype(np.int8)
+    cellFaces = triangleFaces[order].reshape(numberOfRows - 1, numberOfColumns - 1, 2).astype(np.int32)
+
+    # the corner which is not used by a triangle (0 + 1 + 2 + 3 = 6), both triangles
+    # of a cell have to be opposite of each other
+    missingCorners = 6 - cellTriangles.sum(axis=3, dtype=np.int64)
+
+    if np.any((missingCorners[:, :, 0] + 2) % 4 != missingCorners[:, :, 1]):
+        return None
+
+    return HeightfieldTree(minimum, spacing, heights, cellTriangles, cellFaces, faceNormals)
+
+def isCandidate(sourceObject, numberOfVertices):
+    # returns if the detection should be run for the object and if it was forced by the user
+    isForced = "heightfield" in sourceObject and bool(sourceObject["heightfield"])
+
+    if "heightfield" in sourceObject and not isForced:
+        return (False, False)
+
+    return (isForced or numberOfVertices >= minimumNumberOfVertices, isForced)
+
+def getHeightfieldTreeFromArrays(sourceObject, vertices, loopStarts, loopTotals, loopVertices, faceNormals):
+    # returns None if the object should use a BVH tree instead
+    isDetected, isForced = isCandidate(sourceObject, len(vertices))
+
+    if not isDetected:
+        return None
+
+    tree = fromArrays(vertices, loopStarts, loopTotals, loopVertices, faceNormals)
+
+    if tree is None and isForced:
+        print("WARNING: %s is no regular grid, using a BVH tree instead of a heightfield!" % sourceObject.name)
+    elif tree is not None:
+        print("Using heightfield for %s (%d x %d vertices)" % (sourceObject.name, tree.heights.shape[1], tree.heights.shape[0]))
+
+    return tree
+
+def isHeightfield(sourceObject, mesh):
+    # returns if the mesh would be intersected as heightfield, without printing anything
+    # most meshes which are no grid are rejected by fromArrays before the heightfield is built
+    if not isCandidate(sourceObject, len(mesh.vertices))[0]:
+        return False
+
+    vertices, loopStarts, loopTotals, loopVertices = readPolygons(mesh)
+
+    return fromArrays(vertices, loopStarts, loopTotals, loopVertices, None) is not None
+
+def readPolygons(mesh):
+    # see: https://docs.blender.org/api/current/bpy.types.bpy_prop_collection.html#bpy.types.bpy_prop_collection.foreach_get
+    vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+    mesh.vertices.foreach_get("co", vertices)
+
+    loopStarts = np.empty(len(mesh.polygons), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", loopStarts)
+
+    loopTotals = np.empty(len(mesh.polygons), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_total", loopTotals)
+
+    loopVertices = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("vertex_index", loopVertices)
+
+    return (vertices.reshape(-1, 3), loopStarts, loopTotals, loopVertices)
+
+def getHeightfieldTree(sourceObject, depsgraph, faceNormals):
+    # returns None if the object should use a BVH tree instead
+    evaluatedObject = sourceObject.evaluated_get(depsgraph)
+    mesh = evaluatedObject.to_mesh()
+
+    # don't read the mesh if it can't be a heightfield anyway
+    if not isCandidate(sourceObject, len(mesh.vertices))[0]:
+        evaluatedObject.to_mesh_clear()
+        return None
+
+    vertices, loopStarts, loopTotals, loopVertices = readPolygons(mesh)
+
+    evaluatedObject.to_mesh_clear()
+
+    return getHeightfieldTreeFromArrays(sourceObject, vertices, loopStarts, loopTotals, loopVertices, faceNormals)
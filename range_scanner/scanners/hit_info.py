@@ -13,6 +13,9 @@ class HitInfo:
 
         self.wasReflected = False
 
+        # echo type (first, strongest, last) for lidar returns
+        self.echo = None
+
         self.x = None
         self.y = None
 
@@ -0,0 +1,106 @@
+# particle systems, collection instances and geometry nodes create instances of mesh objects
+# which only exist in the evaluated depsgraph
+# instead of making them real (which copies each mesh and needs one BVH tree per copy),
+# each instance is scanned as its own target which shares the geometry of the instanced object
+
+class ObjectInstance:
+    # behaves like the instanced object for labels and materials, but has its own transformation
+    type = 'MESH'
+
+    def __init__(self, sourceObject, instancer, persistentID, matrix_world):
+        self.sourceObject = sourceObject
+        self.instancer = instancer
+        self.persistentID = persistentID
+        self.matrix_world = matrix_world.copy()
+
+        # all instances of an object get the same labels, so they also use its name
+        self.name = sourceObject.name
+
+    @property
+    def key(self):
+        # identifies the same instance in other frames
+        return (self.instancer.name, self.persistentID)
+
+    @property
+    def data(self):
+        return self.sourceObject.data
+
+    @property
+    def material_slots(self):
+        return self.sourceObject.material_slots
+
+    @property
+    def active_material(self):
+        return self.sourceObject.active_material
+
+    @property
+    def modifiers(self):
+        return self.sourceObject.modifiers
+
+    def hide_get(self):
+        return self.instancer.hide_get()
+
+    def evaluated_get(self, depsgraph):
+        return self.sourceObject.evaluated_get(depsgraph)
+
+    # custom properties (categoryID, partID) are read from the instanced object
+    def __contains__(self, key):
+        return key in self.sourceObject
+
+    def __getitem__(self, key):
+        return self.sourceObject[key]
+
+    def __setitem__(self, key, value):
+        self.sourceObject[key] = value
+
+def getSourceObject(target):
+    # the real object which holds the geometry of a target
+    if isinstance(target, ObjectInstance):
+        return target.sourceObject
+
+    return target
+
+def getObjectInstances(depsgraph):
+    instances = []
+
+    # IMPORTANT: the instance objects are only valid while iterating, so all values have to be copied
+    # see: https://docs.blender.org/api/current/bpy.types.Depsgraph.html#bpy.types.Depsgraph.object_instances
+    for instance in depsgraph.object_instances:
+        if not instance.is_instance:
+            continue
+
+        sourceObject = instance.object.original
+        instancer = instance.parent.original
+
+        # same filters as for real objects, but the visibility is defined by the instancer
+        if sourceObject.type != 'MESH' or \
+            sourceObject.active_material == None or \
+            instancer.hide_get() == True:
+                continue
+
+        # geometry nodes can also instance plain meshes without an object of their own,
+        # in this case the original is the instancer itself which can't be used as geometry source
+        if sourceObject == instancer:
+            continue
+
+        instances.append(ObjectInstance(sourceObject, instancer, tuple(instance.persistent_id), instance.matrix_world))
+
+    return instances
+
+def updateInstanceMatrices(targets, depsgraph):
+    # the instances move together with their instancer (or particles), so their transformation
+    # has to be read from the depsgraph in each frame
+    instances = {target.key: target for target in targets if isinstance(target, ObjectInstance)}
+
+    if len(instances) == 0:
+        return
+
+    for instance in depsgraph.object_instances:
+        if not instance.is_instance:
+            continue
+
+        key = (instance.parent.original.name, tuple(instance.persistent_id))
+
+        # instances which don't exist in the current frame keep their last transformation
+        if key in instances:
+            instances[key].matrix_world = instance.matrix_world.copy()
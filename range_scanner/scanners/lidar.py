@@ -15,9 +15,11 @@ from .. import error_distribution
 from .. import material_helper
 from ..export import exporter
 from . import hit_info
-from .. import fresnel
+from .. import optics
+from .. import sensor_model
 from ..ui import user_interface
 from . import generic
+from . import scan_cache
 
 
 # refractive index of air
@@ -25,255 +27,481 @@ from . import generic
 iorAir = 1.000293 
 
 
-def castRay(targets, trees, origin, direction, maxRange, materialMappings, depsgraph, debugLines, debugOutput, currentIOR, isInsideMaterial, remainingReflectionDepth):
-    if remainingReflectionDepth < 0:
-        return None
+class RayGeneration:
+    # all rays of one bounce level (primary rays, first reflections, ...)
+    # the rays of one generation are cast together, their secondary rays form the next generation
+    def __init__(self, origins, directions, maxRanges, isInsideMaterial):
+        numberOfRays = len(origins)
+
+        self.origins = origins                      # (N x 3)
+        self.directions = directions                # (N x 3) normalized
+        self.maxRanges = maxRanges                  # (N)
+        self.isInsideMaterial = isInsideMaterial    # (N) bool
+
+        # closest hit of each ray
+        self.hits = np.zeros(numberOfRays, dtype=bool)
+        self.locations = np.zeros((numberOfRays, 3), dtype=np.float64)
+        self.faceIndices = np.zeros(numberOfRays, dtype=np.int64)
+        self.targetIndices = np.full(numberOfRays, -1, dtype=np.int64)
+        self.distances = np.zeros(numberOfRays, dtype=np.float64)
+        self.colors = np.zeros((numberOfRays, 4), dtype=np.float64)
+        self.intensities = np.zeros(numberOfRays, dtype=np.float64)
+
+        # index of the secondary rays inside the next generation, -1 if there is none
+        self.mirrorChild = np.full(numberOfRays, -1, dtype=np.int64)
+        self.reflectionChild = np.full(numberOfRays, -1, dtype=np.int64)
+        self.refractionChild = np.full(numberOfRays, -1, dtype=np.int64)
+
+        # rays which hit a mirror / glass and depend on their secondary rays
+        self.isMirror = np.zeros(numberOfRays, dtype=bool)
+        self.isGlass = np.zeros(numberOfRays, dtype=bool)
+
+        self.transmission = np.zeros(numberOfRays, dtype=np.float64)
+
+        # final result of each ray after the secondary rays are resolved, one for each echo type
+        self.echoes = {}
+
+class EchoResult:
+    # result of the rays of one generation for one echo type (first, strongest or last return)
+    def __init__(self, generation):
+        self.valid = generation.hits.copy()
+        self.distances = generation.distances.copy()
+        self.colors = generation.colors.copy()
+        self.intensities = generation.intensities.copy()
+        self.wasReflected = np.zeros(len(generation.hits), dtype=bool)
+
+def shadeGeneration(generation, targets, trees, materialMappings, debugOutput):
+    # look up normal, color and reflectivity properties for all hits of this generation
+    hitIndices = np.flatnonzero(generation.hits)
+
+    normals = np.zeros((len(generation.hits), 3), dtype=np.float64)
+    metallic = np.zeros(len(generation.hits), dtype=np.float64)
+    ior = np.zeros(len(generation.hits), dtype=np.float64)
+
+    if len(hitIndices) == 0:
+        return (normals, metallic, ior)
+
+    hitTargets = [targets[targetIndex] for targetIndex in generation.targetIndices[hitIndices]]
+
+    # the world space normals are cached together with the BVH tree
+    for targetIndex in np.unique(generation.targetIndices[hitIndices]):
+        indices = hitIndices[generation.targetIndices[hitIndices] == targetIndex]
+        normals[indices] = trees[targets[targetIndex]].getFaceNormals(generation.faceIndices[indices])
+
+    # get the material's properties from the precomputed face arrays
+    colors, hitMetallic, hitIOR = material_helper.sampleMaterials(hitTargets, generation.faceIndices[hitIndices], generation.locations[hitIndices], materialMappings)
+
+    generation.colors[hitIndices] = colors
+    metallic[hitIndices] = hitMetallic
+    ior[hitIndices] = hitIOR
+
+    # use simple lambert reflectance to approximate light return
+    # see: https://en.wikipedia.org/wiki/Lambertian_reflectance
+    cosAngle = optics.dot(generation.directions[hitIndices], optics.normalize(normals[hitIndices]))
+    generation.intensities[hitIndices] = np.abs(cosAngle) * colors[:, 3]
 
     if debugOutput:
-        print("")
-        print("")
-        print("")
-        print("### SUBCAST ###")
-        print(origin, direction, maxRange)
+        print("Hits %d / %d, mirror %d, glass %d" % (len(hitIndices), len(generation.hits), np.count_nonzero(hitMetallic == 1.0), np.count_nonzero(hitIOR > 0.0)))
+
+    return (normals, metallic, ior)
+
+def spawnSecondaryRays(generation, normals, metallic, ior, debugLines):
+    # create the reflected and refracted rays of all mirror and glass hits
+    # they are returned as the next generation
+    hits = generation.hits
+    directions = generation.directions
+    normals = optics.normalize(normals)
 
-    closestHit = generic.getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debugLines)
+    # decrease maximum range by already travelled distance
+    newRanges = generation.maxRanges - generation.distances
 
-    if closestHit is not None:
-        # the normal is given in local object space, so we need to transform it to global space
-        normal = closestHit.target.rotation_euler.to_matrix() @ closestHit.faceNormal
+    reflectedDirections = optics.reflect(directions, normals)
+
+    # if the surface is 100% reflecting reflect the ray
+    # see: https://en.wikipedia.org/wiki/Ray_tracing_(graphics)#Recursive_ray_tracing_algorithm:~:text=rendered.-,Recursive%20ray%20tracing%20algorithm
+    # a face is either a mirror (metallic) or glass (ior), never both
+    generation.isMirror = hits & (metallic == 1.0)
+    spawnMirror = generation.isMirror & (newRanges > 0.0)
+
+    # when hitting glass, there are 4 cases:
+    #   - the ray goes through the glas and hits the object behind
+    #   - the ray is reflected and hits an object in the reflected direction
+    #   - the glass directly reflects the ray (only for small angles)
+    #   - no hit is detected
+    isGlass = hits & ~generation.isMirror & (ior > 0.0)
+
+    angles = np.abs(np.pi - optics.angles(directions, normals))
 
-        # calculate angle between our ray and the mesh surface
-        normalAngle = direction.angle(normal)
+    # for small angles, we return the glass surface as hit
+    # see: https://ieeexplore.ieee.org/document/6630875
+    # 0.0349066 rad = 2.0 deg
+    generation.isGlass = isGlass & (angles > 0.0349066) & (newRanges > 0.0)
 
-        # get the material's reflectivity properties
-        materialProperty = material_helper.getMaterialColorAndMetallic(closestHit, materialMappings, depsgraph, debugOutput)
-        
-        closestHit.color = materialProperty.color
+    glassIndices = np.flatnonzero(generation.isGlass)
+
+    # now we need to know how much light is reflected and how much is refracted
+    # static approach: 
+    # https://link.springer.com/content/pdf/10.1007%2F978-3-8348-2101-0.pdf, S. 604
+    # Velodyne Scanner 63-HDL64ES2g HDL-64E S2 CD HDL-64E S2 Users Manual low res, S. 39, 905nm -> IR-A (nahes Infrarot)
+    # -> 85 % transmission
 
-        # use simple lambert reflectance to approximate light return
-        # see: https://en.wikipedia.org/wiki/Lambertian_reflectance
-        closestHit.intensity = abs(math.cos(normalAngle)) *  material_helper.getSurfaceReflectivity(materialProperty.color)
+    # dynamic approach: 
+    # https://www.scratchapixel.com/lessons/3d-basic-rendering/introduction-to-shading/reflection-refraction-fresnel
+    # https://refractiveindex.info/?shelf=3d&book=glass&page=BK7
+    # https://de.wikipedia.org/wiki/Brechungsindex#Brechungsindex_der_Luft_und_anderer_Stoffe
+    generation.transmission[glassIndices] = optics.transmission(ior[glassIndices], angles[glassIndices], 1.000292)
+
+    # mirror the ray at the glass surface, but only from the outside
+    spawnGlassReflection = generation.isGlass & ~generation.isInsideMaterial
+
+    # send the ray through the glass
+    # are we going grom air to medium or from medium to air?
+    refractedDirections = np.zeros(directions.shape, dtype=np.float64)
+    isTotalInternalReflection = np.zeros(len(hits), dtype=bool)
+
+    glassIOR = ior[glassIndices]
+    n = np.where(generation.isInsideMaterial[glassIndices], glassIOR / iorAir, iorAir / glassIOR)
+
+    refractedDirections[glassIndices], isTotalInternalReflection[glassIndices] = optics.refract(directions[glassIndices], normals[glassIndices], n)
+
+    # in case of total internal reflection, no light passes the surface
+    spawnRefraction = generation.isGlass & ~isTotalInternalReflection
+
+    origins = []
+    newDirections = []
+    maxRanges = []
+    isInsideMaterial = []
+    numberOfChildren = 0
+
+    for spawn, childIndices, childDirections, flipInside in ((spawnMirror, generation.mirrorChild, reflectedDirections, False),
+                                                             (spawnGlassReflection, generation.reflectionChild, reflectedDirections, False),
+                                                             (spawnRefraction, generation.refractionChild, refractedDirections, True)):
+        parents = np.flatnonzero(spawn)
+
+        childIndices[parents] = np.arange(numberOfChildren, numberOfChildren + len(parents))
+        numberOfChildren += len(parents)
+
+        # the offset is needed to push the origin 1mm in the direction of the ray as otherwise we might
+        # hit the same location again because of rounding errors
+        origins.append(generation.locations[parents] + childDirections[parents] * 0.001)
+        newDirections.append(childDirections[parents])
+        maxRanges.append(newRanges[parents])
+        isInsideMaterial.append(generation.isInsideMaterial[parents] != flipInside)
+
+        if debugLines:
+            for parent in parents:
+                generic.addLine(Vector(generation.locations[parent]), Vector(generation.locations[parent] + normals[parent]))
+                generic.addLine(Vector(generation.locations[parent]), Vector(generation.locations[parent] + childDirections[parent]))
+
+    return RayGeneration(np.concatenate(origins), np.concatenate(newDirections), np.concatenate(maxRanges), np.concatenate(isInsideMaterial))
+
+def resolveGeneration(generation, nextGeneration, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper):
+    # combine the result of each ray with the results of its secondary rays
+    # all echo types are resolved from the same secondary rays, so no additional rays are cast
+    for echo in generic.EchoType:
+        generation.echoes[echo.name] = resolveEcho(generation, nextGeneration, echo, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper)
+
+def resolveEcho(generation, nextGeneration, echo, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper):
+    result = EchoResult(generation)
+
+    if nextGeneration is None:
+        return result
+
+    childResult = nextGeneration.echoes[echo.name]
+
+    # mirrors: the scanner does not know if a ray is returned from an object's surface or a mirror
+    # that means it assumes the returned distance was measured along the original direction vector
+    mirrors = np.flatnonzero(generation.mirrorChild >= 0)
+    children = generation.mirrorChild[mirrors]
+    childValid = childResult.valid[children]
+
+    # the hit location seems to have the color of the reflected surface
+    validMirrors = mirrors[childValid]
+    validChildren = children[childValid]
+    result.distances[validMirrors] += childResult.distances[validChildren]
+    result.colors[validMirrors] = childResult.colors[validChildren]
+    result.intensities[validMirrors] = childResult.colors[validChildren, 3]
+    result.wasReflected[validMirrors] = True
+
+    result.valid[mirrors[~childValid]] = False
+
+    # glass: the glass surface, the object behind the glass and the object in the reflection are candidates for a return
+    glass = np.flatnonzero(generation.isGlass)
+
+    if len(glass) == 0:
+        return result
+
+    transmission = generation.transmission[glass]
+    reflectivity = 1 - transmission
+
+    reflectionChildren = generation.reflectionChild[glass]
+    refractionChildren = generation.refractionChild[glass]
+
+    hasReflection = reflectionChildren >= 0
+    hasReflection[hasReflection] = childResult.valid[reflectionChildren[hasReflection]]
+
+    hasRefraction = refractionChildren >= 0
+    hasRefraction[hasRefraction] = childResult.valid[refractionChildren[hasRefraction]]
+
+    # the transmission tells us, which amount of light goes through the glass
+    # the rest is split up between absorption and reflection (~ 50/50 -> # https://link.springer.com/content/pdf/10.1007%2F978-3-8348-2101-0.pdf, S. 605, 3-18)
+    # as the ray is reflected at (or passes) the glass twice, the value is reduced twice
+    intensityReflected = np.zeros(len(glass), dtype=np.float64)
+    intensityReflected[hasReflection] = childResult.colors[reflectionChildren[hasReflection], 3] * reflectivity[hasReflection]**2
+
+    intensityPassthrough = np.zeros(len(glass), dtype=np.float64)
+    intensityPassthrough[hasRefraction] = childResult.colors[refractionChildren[hasRefraction], 3] * transmission[hasRefraction]**2
+
+    # a candidate can only be registered if some light returns
+    hasReflection &= intensityReflected > 0.0
+    hasRefraction &= intensityPassthrough > 0.0
+
+    distanceReflected = np.full(len(glass), np.inf)
+    distanceReflected[hasReflection] = childResult.distances[reflectionChildren[hasReflection]]
+
+    distancePassthrough = np.full(len(glass), np.inf)
+    distancePassthrough[hasRefraction] = childResult.distances[refractionChildren[hasRefraction]]
+
+    # for the first and last echo, the glass surface directly returns the reflected part of the light
+    # (for small angles, all of it, see spawnSecondaryRays)
+    # this return is weak, so it is only a candidate if it is above the reflectivity threshold of the sensor (same
+    # comparison as in sensor_model.applyLidarSensorModel), otherwise the sensor model would discard it and the
+    # objects behind or in the reflection of the glass would be lost
+    # the strongest echo never reports the glass surface, like before multi-echo support
+    intensitySurface = generation.intensities[glass] * reflectivity
+    travelledDistances = distanceUpper - generation.maxRanges[glass] + generation.distances[glass]
+
+    hasSurface = (intensitySurface > 0.0) & (intensitySurface > sensor_model.getReflectivityThreshold(travelledDistances, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper))
+
+    if echo == generic.EchoType.first:
+        # the closest return, the glass surface is always in front of the other candidates
+        useSurface = hasSurface
+        usePassthrough = ~useSurface & hasRefraction & (distancePassthrough <= distanceReflected)
+        useReflection = ~useSurface & hasReflection & ~usePassthrough
+    elif echo == generic.EchoType.last:
+        # the farthest return
+        usePassthrough = hasRefraction & (~hasReflection | (distancePassthrough >= distanceReflected))
+        useReflection = hasReflection & ~usePassthrough
+        useSurface = hasSurface & ~usePassthrough & ~useReflection
+    else:
+        # decide which return is the brightest
+        # object behind the glass is the brightest
+        usePassthrough = (intensityPassthrough >= intensityReflected) & (intensityPassthrough > 0.0)
+        # object in the reflection is the brightest
+        useReflection = ~usePassthrough & (intensityReflected > intensityPassthrough)
+        useSurface = np.zeros(len(glass), dtype=bool)
+
+    # the surface keeps the distance and color of the glass hit itself
+    result.intensities[glass[useSurface]] = intensitySurface[useSurface]
+
+    for selected, children, intensities in ((usePassthrough, refractionChildren, intensityPassthrough),
+                                            (useReflection, reflectionChildren, intensityReflected)):
+        parents = glass[selected]
+
+        result.distances[parents] += childResult.distances[children[selected]]
+        result.colors[parents] = childResult.colors[children[selected]]
+        result.intensities[parents] = intensities[selected]
+        result.wasReflected[parents] = True
+
+    # otherwise, the sensor can't register any return
+    result.valid[glass[~useSurface & ~usePassthrough & ~useReflection]] = False
+
+    return result
+
+def traceRays(targets, trees, origins, directions, materialMappings, debugLines, debugOutput, maxReflectionDepth, outputProgress,
+              reflectivityLower, distanceLower, reflectivityUpper, distanceUpper):
+    # breadth-first ray tracing: instead of following each ray recursively through all mirror and glass
+    # bounces, all rays of one bounce level are cast together and their results are resolved bottom-up
+    # afterwards (wavefront tracing, see: Laine et al., "Megakernels Considered Harmful: Wavefront Path Tracing on GPUs", 2013)
+    # returns the first generation, its echoes contain the final values of each primary ray
+    directions = optics.normalize(directions)
+    origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+
+    # the maximum range is the upper distance of the reflectivity threshold
+    generation = RayGeneration(origins, directions, np.full(len(directions), distanceUpper, dtype=np.float64), np.zeros(len(directions), dtype=bool))
+    generations = []
+
+    remainingReflectionDepth = maxReflectionDepth - 1
+
+    while len(generation.hits) > 0:
+        generations.append(generation)
+
+        # rays beyond the maximum reflection depth are not cast at all and don't return anything
+        if remainingReflectionDepth < 0:
+            break
 
         if debugOutput:
-            print("RGBA", materialProperty.color[0], materialProperty.color[1], materialProperty.color[2], materialProperty.color[3])
-            print("Metallic ", materialProperty.metallic)
-                        
-        # if the surface is 100% reflecting reflect the ray
-        # aka: recursive raytracing
-        # see: https://en.wikipedia.org/wiki/Ray_tracing_(graphics)#Recursive_ray_tracing_algorithm:~:text=rendered.-,Recursive%20ray%20tracing%20algorithm
-        if (materialProperty is not None and materialProperty.metallic == 1.0):
-            if debugOutput:
-                print("### RESULT ###")
-                print("Hit point location: ", closestHit.location)
-                print("Normal on hit point: ", normal, closestHit.faceNormal)
-                print("Index of the tree node: ", closestHit.faceIndex)
-                print("Distance to the hit point: ", closestHit.distance)
-
-            # reflect the incoming ray with surface normal
-            # see: https://docs.blender.org/api/current/mathutils.html#mathutils.Vector.reflect
-            reflectedVec = direction.reflect(normal)
-
-            if debugLines:
-                generic.addLine(closestHit.location, closestHit.location + normal)
-                generic.addLine(origin, closestHit.location)
-                generic.addLine(closestHit.location, closestHit.location + reflectedVec)
-            
-            if debugOutput:
-                print("### REFLECTION ###")
-                print("direction: ", direction)
-                print("normal: ", normal, normal + closestHit.location)
-                print("reflected: ", reflectedVec, closestHit.location + reflectedVec)
-
-            # decrease maximum range by already travelled distance
-            newRange = maxRange - closestHit.distance
-
-            if newRange > 0.0:
-                # the offset is needed to push the origin 1mm in the direction of the ray as otherwise we might
-                # hit the same location again because of rounding errors
-                directionOffset = (reflectedVec.normalized() * 0.001)    
-
-                # cast new ray from current hit point            
-                reflectedHit = castRay(targets, trees, closestHit.location + directionOffset, reflectedVec, newRange, materialMappings, depsgraph, debugLines, debugOutput, currentIOR, isInsideMaterial, remainingReflectionDepth - 1)
-
-                if reflectedHit is not None:
-                    # the scanner does not know if a ray is returned from an object's surface or a mirror
-                    # that means it assumes the returned distance was measured along the original direction vector
-                    closestHit.distance += reflectedHit.distance
-
-                    # the hit location seems to have the color of the reflected surface
-                    closestHit.color = reflectedHit.color
-                    closestHit.intensity = material_helper.getSurfaceReflectivity(reflectedHit.color)
-
-                    closestHit.wasReflected = True
-                else:
-                    return None
-        
-        if (materialProperty is not None and materialProperty.ior > 0.0):
-            # when hitting glass, there are 4 cases:
-            #   - the ray goes through the glas and hits the object behind
-            #   - the ray is reflected and hits an object in the reflected direction
-            #   - the glass directly reflects the ray (only for small angles)
-            #   - no hit is detected
-
-            angle = abs(np.pi - normalAngle)
-
-            # for small angles, we return the glass surface as hit
-            # see: https://ieeexplore.ieee.org/document/6630875
-            # 0.0349066 rad = 2.0 deg
-            if (abs(angle)) <= 0.0349066:
-                if debugOutput:
-                    print("Angle too small, returning...")
+            print("### GENERATION %d: %d rays ###" % (len(generations) - 1, len(generation.hits)))
 
-                return closestHit
+        generation.hits, generation.locations, generation.faceIndices, generation.distances, generation.targetIndices = generic.castRays(
+            targets, trees, generation.origins, generation.directions, generation.maxRanges, debugOutput, debugLines,
+            outputProgress and len(generations) == 1)
 
-            if debugOutput:
-                print("### RESULT ###")
-                print("Hit point location: ", closestHit.location)
-                print("Normal on hit point: ", normal, closestHit.faceNormal)
-                print("Index of the tree node: ", closestHit.faceIndex)
-                print("Distance to the hit point: ", closestHit.distance)
+        normals, metallic, ior = shadeGeneration(generation, targets, trees, materialMappings, debugOutput)
 
-            # decrease maximum range by already travelled distance
-            newRange = maxRange - closestHit.distance
+        generation = spawnSecondaryRays(generation, normals, metallic, ior, debugLines)
 
-            if newRange > 0.0:
-                # reflect the incoming ray with surface normal
-                # see: https://docs.blender.org/api/current/mathutils.html#mathutils.Vector.reflect
-                reflectedVec = direction.reflect(normal)
+        remainingReflectionDepth -= 1
 
-                if debugLines:
-                    generic.addLine(closestHit.location, closestHit.location + normal)
-                    generic.addLine(origin, closestHit.location)
-                    generic.addLine(closestHit.location, closestHit.location + reflectedVec)
-                
-                if debugOutput:
-                    print("### REFLECTION ###")
-                    print("direction: ", direction)
-                    print("normal: ", normal, normal + closestHit.location)
-                    print("reflected: ", reflectedVec, closestHit.location + reflectedVec)
-
-                # now we need to know how much light is reflected and how much is refracted
-                # static approach: 
-                # https://link.springer.com/content/pdf/10.1007%2F978-3-8348-2101-0.pdf, S. 604
-                # Velodyne Scanner 63-HDL64ES2g HDL-64E S2 CD HDL-64E S2 Users Manual low res, S. 39, 905nm -> IR-A (nahes Infrarot)
-                # -> 85 % transmission
-
-
-                # dynamic approach: 
-                # https://www.scratchapixel.com/lessons/3d-basic-rendering/introduction-to-shading/reflection-refraction-fresnel
-                # https://refractiveindex.info/?shelf=3d&book=glass&page=BK7
-                # https://de.wikipedia.org/wiki/Brechungsindex#Brechungsindex_der_Luft_und_anderer_Stoffe
-                transmission = fresnel.T_unpolarized(materialProperty.ior, angle, 1.000292)
-                reflectivity = 1 - transmission 
-
-                # mirror the ray at the glass surface   
-                if isInsideMaterial:
-                    reflectedHit = None
-                else:
-                    # the offset is needed to push the origin 1mm in the direction of the ray as otherwise we might
-                    # hit the same location again because of rounding errors
-                    directionOffset = (reflectedVec.normalized() * 0.001) 
-                    reflectedHit = castRay(targets, trees, closestHit.location + directionOffset, reflectedVec, newRange, materialMappings, depsgraph, debugLines, debugOutput, currentIOR, isInsideMaterial, remainingReflectionDepth - 1)
-
-                intensityReflected = 0.0
-                if reflectedHit is not None:
-                    reflectedHit.wasReflected = True
-                    intensityReflected = material_helper.getSurfaceReflectivity(reflectedHit.color)
-
-                    # the transmission tells us, which amount of light goes through the glass
-                    # the rest is split up between absorption and reflection (~ 50/50 -> # https://link.springer.com/content/pdf/10.1007%2F978-3-8348-2101-0.pdf, S. 605, 3-18)
-                    # as the ray is reflected at the glass twice, the value is reduced twice
-                    intensityReflected *= reflectivity * reflectivity
-
-
-
-
-                # send the ray through the glass
-                # see: https://en.wikipedia.org/wiki/Snell%27s_law
-                #      https://en.wikipedia.org/wiki/List_of_refractive_indices
-                direction = direction.normalized()
-                normal = normal.normalized()
-
-                # check if the normal points to the same side of the face as the origin is
-                if normal.dot(direction) > 0.0:
-                    normal *= -1.0
-
-                # are we going grom air to medium or from medium to air?
-                if isInsideMaterial:
-                    n = materialProperty.ior / iorAir
-                else:
-                    n = iorAir / materialProperty.ior
-
-                # calculate new direction vector
-                # see: http://www.starkeffects.com/snells-law-vector.shtml
-                newDirection = n * (normal.cross(-normal.cross(direction))) - normal * np.sqrt(1 - (n**2) * (normal.cross(direction) @ normal.cross(direction)))
+    # resolve the results from the last bounce back to the primary rays
+    nextGeneration = None
+    for generation in reversed(generations):
+        resolveGeneration(generation, nextGeneration, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper)
+        nextGeneration = generation
 
-                if debugOutput:
-                    print("### REFRACTION ###")
-                    print("dot:", normal.dot(direction))
-                    print("direction: ", direction)
-                    print("normal: ", normal, normal + closestHit.location)
-                    print("refracted: ", newDirection, closestHit.location + newDirection)
-
-                directionOffset = (newDirection.normalized() * 0.001)
-                passthroughHit = castRay(targets, trees, closestHit.location + directionOffset, newDirection, newRange, materialMappings, depsgraph, debugLines, debugOutput, materialProperty.ior, not isInsideMaterial, remainingReflectionDepth - 1)
-                
-                intensityPassthrough = 0.0
-                if passthroughHit is not None:
-                    intensityPassthrough = material_helper.getSurfaceReflectivity(passthroughHit.color)
+    return generations[0]
 
-                    # the transmission tells us, which amount of  light goes through the glass
-                    # as the ray passes the glass twice, the value is reduced twice
-                    intensityPassthrough *= transmission * transmission
 
 
-                # decide which return is the brightest
-                if intensityPassthrough >= intensityReflected and intensityPassthrough > 0.0:
-                    # object behind the glass is the brightest
-                    closestHit.distance += passthroughHit.distance
+def applySensorModel(geometry, noiseGenerator,
+                     reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+                     addNoise, noiseType, mu, sigma, noiseAbsoluteOffset, noiseRelativeOffset,
+                     simulateRain, rainfallRate,
+                     simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart):
+    # generate the noise for the whole frame at once
+    # each ray gets the value at its index inside the frame, so that the results are reproducible
+    gaussianNoise = None
+    if addNoise:
+        gaussianNoise = noiseGenerator.frameNoise(error_distribution.NoiseStream.gaussian, geometry.frameNumber, geometry.numberOfRays, noiseType, mu, sigma)[geometry.rayIndices]
 
-                    closestHit.color = passthroughHit.color
-                    closestHit.intensity = intensityPassthrough
+    rainNoise = None
+    if simulateRain:
+        # the standard deviation depends on the distance, so we generate
+        # standard normal values which are scaled per hit
+        rainNoise = noiseGenerator.frameNoise(error_distribution.NoiseStream.rain, geometry.frameNumber, geometry.numberOfRays, 'gaussian', 0.0, 1.0)[geometry.rayIndices]
 
-                    closestHit.wasReflected = True
+    return sensor_model.applyLidarSensorModel(
+        geometry.origin, geometry.directions, geometry.locations,
+        geometry.distances, geometry.rayDistances, geometry.intensities,
+        reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+        noiseAbsoluteOffset, noiseRelativeOffset, gaussianNoise,
+        simulateRain, rainfallRate, rainNoise,
+        simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart,
+        geometry.echo)
 
-                    return closestHit
-                elif intensityReflected > intensityPassthrough:
-                    # object in the reflection is the brightest
-                    closestHit.distance += reflectedHit.distance
+def exportHits(dataFilePath, fileName, rawFileName, hits, categoryIDs, partIDs, exportNoiseData, width, height,
+               exportLAS, exportHDF, exportCSV, exportPLY, hdfFileNameExtra,
+               exportSegmentedImage, exportPascalVoc, exportDepthmap, depthMinDistance, depthMaxDistance):
+    if exportLAS or exportHDF or exportCSV or exportPLY or exportSegmentedImage or exportDepthmap:
+        fileExporter = exporter.Exporter(dataFilePath, fileName, rawFileName, hits, [], categoryIDs, partIDs, {}, exportNoiseData, width, height)
 
-                    closestHit.color = reflectedHit.color
-                    closestHit.intensity = intensityReflected
+        # export to each format
+        if exportLAS:
+            fileExporter.exportLAS()
 
-                    closestHit.wasReflected = True
+        if exportHDF:
+            fileExporter.exportHDF(fileNameExtra=hdfFileNameExtra)
 
-                    return closestHit
-                else:
-                    # we return None, as the sensor can't register a hit on the glass' surface
-                    return None
-        
-        return closestHit
-    
-    return None
+        if exportCSV:
+            fileExporter.exportCSV()
+
+        if exportPLY:
+            fileExporter.exportPLY()
+
+        if exportSegmentedImage:
+            fileExporter.exportSegmentedImage(exportPascalVoc)
+
+        if exportDepthmap:
+            fileExporter.exportDepthmap(depthMinDistance, depthMaxDistance)
+
+def resensorize(dataFilePath, dataFileName, outputFileName,
+                reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+                addNoise, noiseType, mu, sigma, addConstantNoise, noiseAbsoluteOffset, noiseRelativeOffset, noiseSeed,
+                simulateRain, rainfallRate,
+                simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart,
+                addMesh,
+                exportLAS, exportHDF, exportCSV, exportPLY, exportSingleFrames,
+                exportSegmentedImage, exportPascalVoc, exportDepthmap, depthMinDistance, depthMaxDistance,
+                frameRange=None, echoSuffix=""):
+    # apply a weather/noise configuration to the cached geometric results of a previous scan
+    # (see 'cacheGeometry') and export the result without casting a single ray
+    # frameRange: (first frame, last frame, frame step) of the scan, only these frames are used and the
+    # file names are the same as if the scan was exported directly (default: all cached frames)
+    # echoSuffix: the echo type of the cached scan, see generic.getEchoTypes
+    if frameRange is None:
+        frameNumbers = None
+    else:
+        frameNumbers = range(frameRange[0], frameRange[1] + 1, frameRange[2])
+
+    (frames, categoryIDs, partIDs) = scan_cache.loadFrames(dataFilePath, dataFileName + echoSuffix, frameNumbers)
+
+    if len(frames) == 0:
+        print("No cached scan found for %s!" % (dataFileName + echoSuffix))
+        return
+
+    print("Applying sensor model to %d cached frames..." % len(frames))
+
+    # the name of the cached scan is the one of the original scan, so the same seed leads to the same noise
+    noiseGenerator = error_distribution.NoiseGenerator(noiseSeed, dataFileName)
+
+    exportNoiseData = addNoise or simulateRain or addConstantNoise
+
+    if frameRange is None:
+        firstFrame = frames[0].frameNumber
+        lastFrame = frames[-1].frameNumber
+    else:
+        # frames without any hit are not cached
+        firstFrame = frameRange[0]
+        lastFrame = frameRange[1]
+
+    allHits = []
+
+    for geometry in frames:
+        sensorResult = applySensorModel(geometry, noiseGenerator,
+                                        reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+                                        addNoise, noiseType, mu, sigma, noiseAbsoluteOffset, noiseRelativeOffset,
+                                        simulateRain, rainfallRate,
+                                        simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart)
+
+        hits = geometry.toHits(sensorResult, exportNoiseData)
+
+        # images can only be generated for tof sensors
+        isStatic = geometry.scannerType == generic.ScannerType.static.name
+
+        if exportSingleFrames:
+            if addMesh:
+                generic.addMeshToScene("real_values_frame_%d%s" % (geometry.frameNumber, echoSuffix), hits, False)
+
+                if exportNoiseData:
+                    generic.addMeshToScene("noise_values_frame_%d%s" % (geometry.frameNumber, echoSuffix), hits, True)
+
+            exportHits(dataFilePath, "%s_frame_%d%s" % (outputFileName, geometry.frameNumber, echoSuffix), outputFileName + echoSuffix, hits, categoryIDs, partIDs, exportNoiseData, geometry.width, geometry.height,
+                       exportLAS, exportHDF, exportCSV, exportPLY, "_frames_%d_to_%d_single" % (firstFrame, lastFrame),
+                       exportSegmentedImage and isStatic, exportPascalVoc, exportDepthmap and isStatic, depthMinDistance, depthMaxDistance)
+        else:
+            allHits.append(hits)
+
+    if not exportSingleFrames:
+        mergedHits = np.concatenate(allHits)
 
+        if addMesh:
+            generic.addMeshToScene("real_values_frames_%d_to_%d%s" % (firstFrame, lastFrame, echoSuffix), mergedHits, False)
 
+            if exportNoiseData:
+                generic.addMeshToScene("noise_values_frames_%d_to_%d%s" % (firstFrame, lastFrame, echoSuffix), mergedHits, True)
+
+        exportHits(dataFilePath, "%s_frames_%d_to_%d%s" % (outputFileName, firstFrame, lastFrame, echoSuffix), outputFileName + echoSuffix, mergedHits, categoryIDs, partIDs, exportNoiseData, 0, 0,
+                   exportLAS, exportHDF, exportCSV, exportPLY, "_frames_%d_to_%d_merged" % (firstFrame, lastFrame),
+                   False, False, False, depthMinDistance, depthMaxDistance)
+
+    print("Done.")
 
 def performScan(context, 
                 scannerType, scannerObject,
-                reflectivityLower, distanceLower, reflectivityUpper, distanceUpper, maxReflectionDepth,
+                reflectivityLower, distanceLower, reflectivityUpper, distanceUpper, maxReflectionDepth, echoMode,
                 intervalStart, intervalEnd, fovX, stepsX, fovY, stepsY, percentage,
                 scannedValues, startIndex,
                 firstFrame, lastFrame, frameNumber, rotationsPerSecond,
-                addNoise, noiseType, mu, sigma, addConstantNoise, noiseAbsoluteOffset, noiseRelativeOffset,
+                addNoise, noiseType, mu, sigma, addConstantNoise, noiseAbsoluteOffset, noiseRelativeOffset, noiseGenerator,
                 simulateRain, rainfallRate, 
                 simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart,
                 addMesh,
                 exportLAS, exportHDF, exportCSV, exportPLY, 
                 exportRenderedImage, exportSegmentedImage, exportPascalVoc, exportDepthmap, depthMinDistance, depthMaxDistance, 
-                dataFilePath, dataFileName,
+                dataFilePath, dataFileName, cacheGeometry,
                 debugLines, debugOutput, outputProgress, measureTime, singleRay, destinationObject, targetObject,
                 targets, materialMappings,
-                categoryIDs, partIDs, trees, depsgraph):
+                categoryIDs, partIDs, targetLabels, trees, depsgraph):
 
     if measureTime:
         startTime = time.time()
@@ -292,7 +520,6 @@ def performScan(context,
         ySteps = fovY / stepsY + 1
         yRange = np.linspace(-(fovY / 2.0), fovY / 2.0, int(ySteps))
 
-        totalNumberOfRays = xRange.size * yRange.size
     elif scannerType == generic.ScannerType.static.name:
         # setup camera properties
         sensor.data.lens_unit = 'FOV'
@@ -328,7 +555,6 @@ def performScan(context,
         xRange = np.linspace(topLeft[0], topRight[0], stepsX)
         yRange = np.linspace(topLeft[1], bottomLeft[1], stepsY)
 
-        totalNumberOfRays = xRange.size * yRange.size
     else:
         print("ERROR: Unknown scanner type %s!" % scannerType)
         return {'FINISHED'}
@@ -352,6 +578,14 @@ def performScan(context,
     sensorZero.rotate(sensor.matrix_world.decompose()[1])
 
     exportNoiseData = addNoise or simulateRain or addConstantNoise
+
+    numberOfRaysInFrame = xRange.size * yRange.size
+
+    # collect all primary rays of this frame first, they are traced together afterwards
+    rayDirections = []
+    rayX = []
+    rayY = []
+
     # iterate over all X/Y coordinates
     for x in xRange:
         # setup vector in the according direction
@@ -388,258 +622,179 @@ def performScan(context,
                 destination = destinationObject.matrix_world.translation
 
             # calculate ray direction 
-            direction = destination - origin
-
-            closestHit = castRay(targets, trees, origin, direction, distanceUpper, materialMappings, depsgraph, debugLines, debugOutput, iorAir, False, maxReflectionDepth - 1)
-
-            # if location is None, no hit was found within the given range
-            if closestHit is not None: 
-                # set the image x/y coordinates for tof sensor
-                closestHit.x = indexX
-                closestHit.y = indexY
-
-                # the Kinect raw depth data does not measure the distance between camera lens (L)
-                # and hit point (H) -> d_1, but between the (virtual) camera plane and hit point, 
-                # so we need to correct the distance
-                #
-                #   -----------------------H----
-                #             |          / |
-                #             |        /   |
-                #             |  d_1 /     |
-                #             |    /       |
-                #             |  /         |
-                #             |/           |
-                #   ----------L------------------
-                actualDistance = closestHit.distance
-                if scannerType == generic.ScannerType.static.name:
-                    # only modify the distance, not the XYZ values!
-                    closestHit.distance = mathutils.geometry.distance_point_to_plane(closestHit.location, origin, sensorZero)
-                
-                # set category/part id for that hit to enable segmentation
-                if "partID" in closestHit.target:
-                    partIDIndex = closestHit.target["partID"]
-                else:
-                    partIDIndex = closestHit.target.material_slots[materialMappings[closestHit.target][1][closestHit.faceIndex]].name
-
-                closestHit.categoryID = categoryIDs[closestHit.target["categoryID"]]
-                closestHit.partID = partIDs[partIDIndex]
-                    
-                if closestHit.wasReflected:
-                    if debugLines:
-                        generic.addLine(origin, closestHit.location)
-                    
-                    fakePoint = direction.normalized() * closestHit.distance + origin
-                    
-                    if debugOutput:
-                        print(fakePoint)
-                        print("Total reflected distance ", closestHit.distance)
-                        
-                    # update the original hit location (on the mirror) with the fake position from the total distance
-                    closestHit.location = fakePoint
-                    
-                    if debugLines:
-                        generic.addLine(origin, closestHit.location)
+            rayDirections.append(destination - origin)
+            rayX.append(indexX)
+            rayY.append(indexY)
+            
+            indexY += 1
 
-                
-                noise = noiseAbsoluteOffset + (closestHit.distance * noiseRelativeOffset / 100.0)
-                
-                surfaceReflectivity = closestHit.intensity
+            if singleRay:
+                break
+        
+        indexX += 1
+        indexY = 0
 
-                # source: https://github.com/mgschwan/blensor/blob/0b6cca9f189b1e072cfd8aaa6360deeab0b96c61/release/scripts/addons/blensor/scan_interface_pure.py#L9
-                rMin = 0.0
-                if closestHit.distance >= distanceLower:
-                    rMin = reflectivityLower + ((reflectivityUpper - reflectivityLower) * closestHit.distance) / (distanceUpper - distanceLower)
+        if singleRay:
+            break
 
-                delta = 0
+    # cast all primary rays and their mirror/glass bounces generation by generation
+    generation = traceRays(targets, trees, origin, rayDirections, materialMappings, debugLines, debugOutput, maxReflectionDepth, outputProgress,
+                           reflectivityLower, distanceLower, reflectivityUpper, distanceUpper)
+
+    # all echo types are resolved from the same traced rays
+    # each one is a separate point cloud, the file names only get a suffix if more than one echo is exported
+    echoTypes = generic.getEchoTypes(echoMode)
+
+    for echo in echoTypes:
+        result = generation.echoes[echo]
+
+        echoSuffix = "_%s_echo" % echo if len(echoTypes) > 1 else ""
+        echoStartIndex = valueIndex
+
+        # normalized ray direction and distance along the ray for each hit
+        hitDirections = []
+        hitRayDistances = []
+
+        for rayIndex in np.flatnonzero(result.valid):
+            closestHit = hit_info.HitInfo(Vector(generation.locations[rayIndex]), None, int(generation.faceIndices[rayIndex]), result.distances[rayIndex], targets[generation.targetIndices[rayIndex]])
+            closestHit.color = result.colors[rayIndex]
+            closestHit.intensity = result.intensities[rayIndex]
+            closestHit.wasReflected = bool(result.wasReflected[rayIndex])
+            closestHit.echo = echo
+
+            direction = Vector(generation.directions[rayIndex])
+
+            # set the image x/y coordinates for tof sensor
+            closestHit.x = rayX[rayIndex]
+            closestHit.y = rayY[rayIndex]
+
+            # the Kinect raw depth data does not measure the distance between camera lens (L)
+            # and hit point (H) -> d_1, but between the (virtual) camera plane and hit point, 
+            # so we need to correct the distance
+            #
+            #   -----------------------H----
+            #             |          / |
+            #             |        /   |
+            #             |  d_1 /     |
+            #             |    /       |
+            #             |  /         |
+            #             |/           |
+            #   ----------L------------------
+            actualDistance = closestHit.distance
+            if scannerType == generic.ScannerType.static.name:
+                # only modify the distance, not the XYZ values!
+                closestHit.distance = mathutils.geometry.distance_point_to_plane(closestHit.location, origin, sensorZero)
 
-                if simulateRain:
-                    # see https://www.researchgate.net/publication/330415308_Predicting_the_influence_of_rain_on_LIDAR_in_ADAS for details
-                    noise += error_distribution.applyNoise(0.0, 0.02 * closestHit.distance * (1 - np.e ** -rainfallRate) ** 2) # equation (9)
+            if closestHit.wasReflected:
+                if debugLines:
+                    generic.addLine(origin, closestHit.location)
+            
+                fakePoint = direction * closestHit.distance + origin
+            
+                if debugOutput:
+                    print(fakePoint)
+                    print("Total reflected distance ", closestHit.distance)
                 
-                    # coefficient following observation
-                    backScatteringCoefficientRain = 0.01 * rainfallRate ** 0.6 # equation (5)
-
-                    delta = np.e ** (-2 * backScatteringCoefficientRain * closestHit.distance) - 1
-
-                surfaceReflectivity += delta
+                # update the original hit location (on the mirror) with the fake position from the total distance
+                closestHit.location = fakePoint
+            
+                if debugLines:
+                    generic.addLine(origin, closestHit.location)
 
-                alpha = 1.0
+            # remember the geometric values, the sensor model is applied to the whole frame at once after casting
+            hitDirections.append(direction)
+            hitRayDistances.append(actualDistance)
 
-                if simulateDust:
-                    # see: https://www.researchgate.net/publication/313582355_When_the_Dust_Settles_The_Four_Behaviors_of_LiDAR_in_the_Presence_of_Fine_Airborne_Particulates
-                    Rt = closestHit.distance
+            # save closest hit into array
+            scannedValues[valueIndex] = closestHit
+            valueIndex += 1
 
-                    r = particleRadius * 10**(-6)
-                    n = particlesPcm
-                    Ld = dustCloudLength
-                    Rd = dustCloudStart
+        if debugOutput:
+            print("%d / %d rays hit within range of %f (%s echo)" % (valueIndex - echoStartIndex, len(rayDirections), distanceUpper, echo))
 
-                    if Rt < Rd:
-                        # target is in front of dust cloud -> no backscatter or reduction -> no action to perform
-                        pass
-                    else:
-                        # target in or behind dust cloud
-                        beta = (r**2 * n) / 4 # eq. (31)
+        if measureTime:
+            print("Loop: %s s" % (time.time() - startTime))
+            startTime = time.time()
 
-                        if beta > rMin:
-                            # light is reflected by the cloud -> appears as solid object
+        # we now have the final number of hits so we could shrink the array here
+        # as explained here (https://stackoverflow.com/a/32398318/13440564), resizing
+        # would cause a copy, so we slice the array instead
+        slicedScannedValues = scannedValues[echoStartIndex:valueIndex]
 
-                            # calculate the direction vector 
-                            dustDirection =  direction.normalized() * Rd
+        # set category/part id for all hits to enable segmentation
+        generic.assignLabels(slicedScannedValues, targetLabels)
 
-                            # calculate the dust cloud location of the hit point
-                            dustLocation = dustDirection + origin
+        if len(slicedScannedValues) > 0:
+            # collect the pure geometric result of this frame
+            rayIndices = np.fromiter((hit.x * yRange.size + hit.y for hit in slicedScannedValues), dtype=np.int64, count=len(slicedScannedValues))
 
-                            if debugOutput:
-                                print("Dust Distance ", dustDirection)
-                                print("Dust Location ", dustLocation)
-                            
-                            # update the closest hit to the dust cloud
-                            closestHit.location = dustLocation
-                            closestHit.distance = Rd
-                            closestHit.intensity = beta
-                        else:
-                            # light enters the dust cloud
-
-                            # the end is the length + the start distance
-                            dustCloudEnd = Rd + Ld
-
-                            if Rt < dustCloudEnd: 
-                                # target inside dust cloud, so we need to calculate the part of the dust cloud
-                                # which is IN FRONT of our target
-                                relevantDustCloudLength = Rt - Rd
-                                
-                            else:
-                                # target behind dust cloud, so the full length of the dust cloud reduces the power
-                                relevantDustCloudLength = Ld
-                            
-                            # calculate the transmission loss
-                            alpha = np.exp(-2 * np.pi * r**2 * n * (relevantDustCloudLength)) # eq. (32)
+            geometry = scan_cache.FrameGeometry.fromHits(frameNumber, scannerType, origin, numberOfRaysInFrame, rayIndices, slicedScannedValues, hitDirections, hitRayDistances, stepsX, stepsY, echo)
 
-                surfaceReflectivity *= alpha
+            if cacheGeometry:
+                scan_cache.saveFrame(dataFilePath, dataFileName + echoSuffix, geometry, categoryIDs, partIDs)
 
-                isVisible = surfaceReflectivity > rMin #relativeSensorPower > minimumRelativePower:
-                
-                # if the return is not powerful enough, the detector can't see it at all
-                if not isVisible:
-                    closestHit.intensity = 0.0
+            # apply reflectivity threshold, rain, dust and noise to all hits of this frame at once
+            sensorResult = applySensorModel(geometry, noiseGenerator,
+                                            reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+                                            addNoise, noiseType, mu, sigma, noiseAbsoluteOffset, noiseRelativeOffset,
+                                            simulateRain, rainfallRate,
+                                            simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart)
 
-                #if not isVisible:
-                #    continue
-                
-                if debugOutput:
-                    print("Visible ", isVisible, surfaceReflectivity, rMin)
+            if debugOutput:
+                print("Visible hits ", np.count_nonzero(sensorResult.isVisible), "/", len(slicedScannedValues))
 
-                if addNoise:
-                    # generate some noise
-                    # error model: https://github.com/mgschwan/blensor/blob/master/release/scripts/addons/blensor/gaussian_error_model.py#L21
-                    #              https://github.com/mgschwan/blensor/blob/0b6cca9f189b1e072cfd8aaa6360deeab0b96c61/release/scripts/addons/blensor/generic_lidar.py#L172
-                    noise += error_distribution.applyNoise(mu, sigma)
+            for index, hit in enumerate(slicedScannedValues):
+                hit.intensity = sensorResult.intensity[index]
+                hit.location = Vector(sensorResult.location[index])
+                hit.distance = sensorResult.distance[index]
 
-                if debugOutput:
-                    print("Location ", closestHit.location)
-                    print("Direction ", direction)
-                    print("Length ", closestHit.location.length)
-                    print("Noise ", noise)
-                    print("Distance ", closestHit.distance)
-                
                 if exportNoiseData:
-                    # we can't simply move the hit location around by some random translation
-                    # instead, we have to move it along the ray direction
-
-                    # calculate distance with noise
-                    if scannerType == generic.ScannerType.static.name:
-                        noiseDistance = actualDistance + noise
-                    else:
-                        noiseDistance = closestHit.distance + noise
-                    
-                    # calculate the direction vector with noise applied
-                    noiseDirection =  direction.normalized() * noiseDistance
-
-                    # calculate the noise location of the hit point
-                    noiseLocation = noiseDirection + origin
-
-                    if debugOutput:
-                        print("Noise Distance ", noiseDistance)
-                        print("Noise Location ", noiseLocation)
-                    
-                    closestHit.noiseLocation = noiseLocation
-                    closestHit.noiseDistance = noiseDistance
-
-                # save closest hit into array
-                scannedValues[valueIndex] = closestHit
-                valueIndex += 1
-            else:
-                if debugOutput:
-                    print("NO HIT within range of %f" % distanceUpper)
-            
-            indexY += 1
-
-            if singleRay:
-                break
-        
-        indexX += 1
-        indexY = 0
+                    hit.noiseLocation = Vector(sensorResult.noiseLocation[index])
+                    hit.noiseDistance = sensorResult.noiseDistance[index]
 
-        if outputProgress:
-            percentage = (indexX * yRange.size) / totalNumberOfRays 
-            generic.updateProgress("Scanning scene", percentage)
+        if addMesh:
+            generic.addMeshToScene("real_values_frame_%d%s" % (frameNumber, echoSuffix), slicedScannedValues, False)
 
-        if singleRay:
-            break
-
-    if measureTime:
-        print("Loop: %s s" % (time.time() - startTime))
-        startTime = time.time()
-
-    # we now have the final number of hits so we could shrink the array here
-    # as explained here (https://stackoverflow.com/a/32398318/13440564), resizing
-    # would cause a copy, so we slice the array instead
-    slicedScannedValues = scannedValues[startIndex:valueIndex]
-
-    if addMesh:
-        generic.addMeshToScene("real_values_frame_%d" % frameNumber, slicedScannedValues, False)
-
-        if exportNoiseData:
-            generic.addMeshToScene("noise_values_frame_%d" % frameNumber, slicedScannedValues, True)
+            if exportNoiseData:
+                generic.addMeshToScene("noise_values_frame_%d%s" % (frameNumber, echoSuffix), slicedScannedValues, True)
 
-    if measureTime:
-        print("Meshes: %s s" % (time.time() - startTime))
-        startTime = time.time()
+        if measureTime:
+            print("Meshes: %s s" % (time.time() - startTime))
+            startTime = time.time()
 
-    # save data to files
-    if debugOutput:
-        print("File path ", os.path.abspath(dataFilePath))
+        # save data to files
+        if debugOutput:
+            print("File path ", os.path.abspath(dataFilePath))
 
-    if len(slicedScannedValues) > 0:
-        # setup exporter with our data
-        if exportLAS or exportHDF or exportCSV or exportPLY or exportSegmentedImage or exportRenderedImage or exportDepthmap:
-            fileExporter = exporter.Exporter(dataFilePath, "%s_frame_%d" % (dataFileName, frameNumber), dataFileName, slicedScannedValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, stepsX, stepsY)
+        if len(slicedScannedValues) > 0:
+            # setup exporter with our data
+            if exportLAS or exportHDF or exportCSV or exportPLY or exportSegmentedImage or exportRenderedImage or exportDepthmap:
+                fileExporter = exporter.Exporter(dataFilePath, "%s_frame_%d%s" % (dataFileName, frameNumber, echoSuffix), dataFileName + echoSuffix, slicedScannedValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, stepsX, stepsY)
 
-            # export to each format
-            if exportLAS:
-                fileExporter.exportLAS()
+                # export to each format
+                if exportLAS:
+                    fileExporter.exportLAS()
 
-            if exportHDF:
-                fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_single" % (firstFrame, lastFrame))
+                if exportHDF:
+                    fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_single" % (firstFrame, lastFrame))
 
-            if exportCSV:
-                fileExporter.exportCSV()
+                if exportCSV:
+                    fileExporter.exportCSV()
 
-            if exportPLY:
-                fileExporter.exportPLY()
+                if exportPLY:
+                    fileExporter.exportPLY()
 
-            if scannerType == generic.ScannerType.static.name:
-                if exportSegmentedImage:
-                    fileExporter.exportSegmentedImage(exportPascalVoc)
+                if scannerType == generic.ScannerType.static.name:
+                    if exportSegmentedImage:
+                        fileExporter.exportSegmentedImage(exportPascalVoc)
 
-                if exportRenderedImage:
-                    fileExporter.exportRenderedImage()
+                    if exportRenderedImage:
+                        fileExporter.exportRenderedImage()
 
-                if exportDepthmap:
-                    fileExporter.exportDepthmap(depthMinDistance, depthMaxDistance)
-    else:
-        print("No data to export!")
+                    if exportDepthmap:
+                        fileExporter.exportDepthmap(depthMinDistance, depthMaxDistance)
+        else:
+            print("No data to export!")
 
     if measureTime:
         print("Output: %s s" % (time.time() - startTime))
@@ -0,0 +1,69 @@
+import numpy as np
+
+from . import tiles
+
+# far away objects are only hit by a few rays, so a decimated version of their mesh is sufficient
+# the decimated meshes are generated by vertex clustering, each triangle keeps the index of the
+# original face, so that materials, labels and normals don't change
+# see: Rossignac and Borrel, "Multi-resolution 3D approximations for rendering complex scenes", 1993
+
+# cell size of the vertex clustering for each level, relative to the diagonal of the mesh's bounding box
+# level 0 is the original mesh
+levelCellSizes = [0.0, 1.0 / 128, 1.0 / 32, 1.0 / 8]
+
+# smaller meshes are not decimated
+minimumNumberOfFaces = 1000
+
+def decimate(vertices, triangles, polygonIndices, cellSize):
+    # merge all vertices within the same grid cell to their mean position
+    cells = np.floor((vertices - vertices.min(axis=0)) / cellSize).astype(np.int64)
+    _, clusters = np.unique(cells, axis=0, return_inverse=True)
+    clusters = clusters.reshape(-1)
+
+    numberOfClusters = clusters.max() + 1
+
+    clusterVertices = np.zeros((numberOfClusters, 3), dtype=np.float64)
+    np.add.at(clusterVertices, clusters, vertices)
+    clusterVertices /= np.bincount(clusters, minlength=numberOfClusters)[:, np.newaxis]
+
+    clusterTriangles = clusters[triangles]
+
+    # triangles with merged corners vanish
+    isValid = (clusterTriangles[:, 0] != clusterTriangles[:, 1]) & \
+              (clusterTriangles[:, 1] != clusterTriangles[:, 2]) & \
+              (clusterTriangles[:, 0] != clusterTriangles[:, 2])
+
+    clusterTriangles = clusterTriangles[isValid]
+    clusterPolygonIndices = polygonIndices[isValid]
+
+    # several triangles can collapse into the same one, keep the first of them
+    _, firstTriangles = np.unique(np.sort(clusterTriangles, axis=1), axis=0, return_index=True)
+    firstTriangles.sort()
+
+    return (clusterVertices, clusterTriangles[firstTriangles], clusterPolygonIndices[firstTriangles])
+
+def getLevelsOfDetail(sourceObject, depsgraph, faceNormals):
+    # level -> TriangleTree for all levels except the original mesh
+    vertices, triangles, polygonIndices = tiles.getTriangles(sourceObject, depsgraph)
+
+    diagonal = np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0))
+
+    levels = {}
+
+    for level in range(1, len(levelCellSizes)):
+        levelVertices, levelTriangles, levelPolygonIndices = decimate(vertices, triangles, polygonIndices, max(diagonal * levelCellSizes[level], 1e-9))
+
+        levels[level] = tiles.TriangleTree(levelVertices, levelTriangles, levelPolygonIndices, faceNormals)
+
+    return levels
+
+def selectLevel(size, raySpacing):
+    # the coarsest level whose clusters are smaller than half of the distance between two neighboring rays
+    # size: the diagonal of the target's bounding box in world space
+    level = 0
+
+    for candidate in range(1, len(levelCellSizes)):
+        if size * levelCellSizes[candidate] <= raySpacing / 2.0:
+            level = candidate
+
+    return level
@@ -0,0 +1,256 @@
+import hashlib
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from . import heightfield
+from . import tiles
+
+# preparing the geometry of large meshes (triangulation, face normals, heightfield detection) takes
+# a long time and is repeated for every scan of the same scene, so the results are stored on disk
+# the key is a hash of the evaluated mesh, so any change of the geometry (or its modifiers) creates a new entry
+# the trees are built in the object's local space, so moving an object does not invalidate its entry
+# BVH trees can't be serialized, so only the arrays they are built from are stored
+# tiled terrains (see tiles.py) are stored as a directory of tiles instead of a single file
+# the least recently used entries are deleted when the cache exceeds its size
+
+defaultDirectory = os.path.join(tempfile.gettempdir(), "range_scanner_mesh_cache")
+
+# increase if the stored arrays change, so that old entries are not used anymore
+cacheVersion = 1
+
+class MeshCache:
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize  # bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        # the tiles are loaded during the whole scan, so their directories must not be evicted
+        self.usedTileDirectories = set()
+
+    def getFilePath(self, key):
+        return os.path.join(self.directory, "%s.npz" % key)
+
+    def getTree(self, sourceObject, depsgraph):
+        # returns the local face normals and the tree of the object's evaluated mesh
+        evaluatedObject = sourceObject.evaluated_get(depsgraph)
+        mesh = evaluatedObject.to_mesh()
+
+        vertices, loopStarts, loopTotals, loopVertices = heightfield.readPolygons(mesh)
+
+        key = getKey(sourceObject, vertices, loopTotals, loopVertices)
+        filePath = self.getFilePath(key)
+
+        if os.path.exists(filePath):
+            evaluatedObject.to_mesh_clear()
+
+            try:
+                faceNormals, tree = self.load(filePath)
+
+                self.hits += 1
+
+                return (faceNormals, tree)
+            except (OSError, ValueError, KeyError) as error:
+                # e.g. an entry which was evicted by another process in the meantime
+                print("WARNING: could not load cached mesh of %s: %s" % (sourceObject.name, error))
+
+                mesh = evaluatedObject.to_mesh()
+
+        self.misses += 1
+
+        # see: https://docs.blender.org/api/current/bpy.types.Mesh.html#bpy.types.Mesh.loop_triangles
+        mesh.calc_loop_triangles()
+
+        faceNormals = np.empty(len(mesh.polygons) * 3, dtype=np.float64)
+        mesh.polygons.foreach_get("normal", faceNormals)
+        faceNormals = faceNormals.reshape(-1, 3)
+
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        triangles = triangles.reshape(-1, 3)
+
+        polygonIndices = np.empty(len(mesh.loop_triangles), dtype=np.int64)
+        mesh.loop_triangles.foreach_get("polygon_index", polygonIndices)
+
+        evaluatedObject.to_mesh_clear()
+
+        tree = heightfield.getHeightfieldTreeFromArrays(sourceObject, vertices, loopStarts, loopTotals, loopVertices, faceNormals)
+
+        arrays = {
+            "faceNormals": faceNormals,
+            "vertices": vertices,
+            "triangles": triangles,
+            "polygonIndices": polygonIndices,
+        }
+
+        if tree is None:
+            tree = tiles.TriangleTree(vertices, triangles, polygonIndices, faceNormals)
+        else:
+            arrays.update({
+                "origin": np.asarray(tree.origin, dtype=np.float64),
+                "spacing": np.asarray(tree.spacing, dtype=np.float64),
+                "heights": tree.heights,
+                "cellTriangles": tree.cellTriangles,
+                "cellFaces": tree.cellFaces,
+            })
+
+        self.save(filePath, arrays)
+
+        return (faceNormals, tree)
+
+    def getTiledTree(self, sourceObject, depsgraph, maxLoadedTiles):
+        # returns the tiled tree of the object's evaluated mesh, only the key is computed from the mesh
+        # if its tiles are already stored
+        evaluatedObject = sourceObject.evaluated_get(depsgraph)
+        mesh = evaluatedObject.to_mesh()
+
+        vertices, loopStarts, loopTotals, loopVertices = heightfield.readPolygons(mesh)
+
+        evaluatedObject.to_mesh_clear()
+
+        key = getKey(sourceObject, vertices, loopTotals, loopVertices)
+        directoryPath = os.path.join(self.directory, "tiles_%s" % key)
+        indexPath = os.path.join(directoryPath, "index.npz")
+
+        self.usedTileDirectories.add(directoryPath)
+
+        if os.path.exists(indexPath):
+            try:
+                tree = tiles.loadTiledTree(directoryPath, maxLoadedTiles)
+
+                # mark the entry as recently used
+                os.utime(indexPath)
+
+                self.hits += 1
+
+                return tree
+            except (OSError, ValueError, KeyError) as error:
+                print("WARNING: could not load cached tiles of %s: %s" % (sourceObject.name, error))
+
+        self.misses += 1
+
+        # like single files, the tiles are written to a temporary directory which is renamed afterwards
+        temporaryDirectoryPath = "%s.%d.tmp" % (directoryPath, os.getpid())
+        os.makedirs(temporaryDirectoryPath, exist_ok=True)
+
+        tiles.writeTiles(temporaryDirectoryPath, sourceObject, depsgraph)
+
+        try:
+            if os.path.exists(directoryPath):
+                # an incomplete entry
+                shutil.rmtree(directoryPath)
+
+            os.replace(temporaryDirectoryPath, directoryPath)
+        except OSError as error:
+            # e.g. another process stored the same tiles in the meantime
+            if not os.path.exists(indexPath):
+                print("WARNING: could not write to mesh cache: %s" % error)
+
+                self.usedTileDirectories.add(temporaryDirectoryPath)
+
+                return tiles.loadTiledTree(temporaryDirectoryPath, maxLoadedTiles)
+
+            shutil.rmtree(temporaryDirectoryPath, ignore_errors=True)
+
+        self.evict()
+
+        return tiles.loadTiledTree(directoryPath, maxLoadedTiles)
+
+    def load(self, filePath):
+        with np.load(filePath) as data:
+            faceNormals = data["faceNormals"]
+
+            if "heights" in data:
+                tree = heightfield.HeightfieldTree(data["origin"], data["spacing"], data["heights"],
+                                                   data["cellTriangles"], data["cellFaces"], faceNormals)
+            else:
+                tree = tiles.TriangleTree(data["vertices"], data["triangles"], data["polygonIndices"], faceNormals)
+
+        # mark the entry as recently used
+        os.utime(filePath)
+
+        return (faceNormals, tree)
+
+    def save(self, filePath, arrays):
+        # several scanner processes can share the cache, so write to a temporary file first
+        # and rename it afterwards, which is atomic
+        temporaryFilePath = "%s.%d.tmp.npz" % (filePath[:-len(".npz")], os.getpid())
+
+        try:
+            np.savez(temporaryFilePath, **arrays)
+            os.replace(temporaryFilePath, filePath)
+        except OSError as error:
+            print("WARNING: could not write to mesh cache: %s" % error)
+            return
+
+        self.evict()
+
+    def evict(self):
+        # delete the least recently used entries until the cache fits its size again
+        entries = []
+
+        for fileName in os.listdir(self.directory):
+            filePath = os.path.join(self.directory, fileName)
+
+            try:
+                if fileName.startswith("tiles_") and not fileName.endswith(".tmp"):
+                    # the index is touched whenever the tiles are used
+                    if filePath in self.usedTileDirectories:
+                        continue
+
+                    size = sum(entry.stat().st_size for entry in os.scandir(filePath))
+                    lastUsage = os.stat(os.path.join(filePath, "index.npz")).st_mtime
+                elif fileName.endswith(".npz") and not fileName.endswith(".tmp.npz"):
+                    status = os.stat(filePath)
+                    size = status.st_size
+                    lastUsage = status.st_mtime
+                else:
+                    continue
+            except OSError:
+                continue
+
+            entries.append((lastUsage, size, filePath))
+
+        totalSize = sum(size for _, size, _ in entries)
+
+        for _, size, filePath in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+
+            try:
+                if os.path.isdir(filePath):
+                    shutil.rmtree(filePath)
+                else:
+                    os.remove(filePath)
+            except OSError:
+                pass
+
+            totalSize -= size
+
+    def printStatistics(self):
+        print("Mesh cache: %d hits, %d misses" % (self.hits, self.misses))
+
+def getKey(sourceObject, vertices, loopTotals, loopVertices):
+    # hash of everything the stored arrays depend on
+    hash = hashlib.blake2b(digest_size=16)
+
+    hash.update(str(cacheVersion).encode())
+
+    # the heightfield detection can be forced or disabled per object
+    if "heightfield" in sourceObject:
+        hash.update(("heightfield=%d" % bool(sourceObject["heightfield"])).encode())
+
+    # tiled terrains are stored as a directory of tiles
+    if "tileSize" in sourceObject:
+        hash.update(("tileSize=%r" % float(sourceObject["tileSize"])).encode())
+
+    for array in (vertices, loopTotals, loopVertices):
+        hash.update(np.ascontiguousarray(array).tobytes())
+        hash.update(b"|")
+
+    return hash.hexdigest()
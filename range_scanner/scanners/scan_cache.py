@@ -0,0 +1,140 @@
+import bpy
+import os
+import re
+import json
+import numpy as np
+from mathutils import Vector
+
+from . import hit_info
+
+# the geometric result of a scan (everything before the sensor model is applied) can be stored
+# per frame, so that different weather/noise settings can be applied later without casting again
+
+class FrameGeometry:
+    def __init__(self, frameNumber, scannerType, origin, numberOfRays, rayIndices, x, y,
+                 locations, distances, rayDistances, directions, intensities, colors,
+                 categoryIDs, partIDs, width, height, echo):
+        self.frameNumber = frameNumber
+        self.scannerType = scannerType
+        self.origin = origin                # (3) sensor location
+        self.numberOfRays = numberOfRays    # number of rays in this frame, needed to reproduce the noise
+        self.rayIndices = rayIndices        # (N) index of the ray inside the frame
+        self.x = x                          # (N) image coordinates
+        self.y = y                          # (N)
+        self.locations = locations          # (N x 3)
+        self.distances = distances          # (N) measured distance
+        self.rayDistances = rayDistances    # (N) distance along the ray
+        self.directions = directions        # (N x 3) normalized ray directions
+        self.intensities = intensities      # (N) intensity before weather/noise
+        self.colors = colors                # (N x 4)
+        self.categoryIDs = categoryIDs      # (N) uint16
+        self.partIDs = partIDs              # (N) uint16
+        self.width = width                  # image size for tof sensors
+        self.height = height
+        self.echo = echo                    # echo type (first, strongest, last) of this geometry
+
+    @classmethod
+    def fromHits(cls, frameNumber, scannerType, origin, numberOfRays, rayIndices, hits, directions, rayDistances, width, height, echo):
+        return cls(frameNumber, scannerType, np.array(origin, dtype=np.float64), numberOfRays, np.asarray(rayIndices, dtype=np.int64),
+                   np.array([hit.x for hit in hits], dtype=np.int64),
+                   np.array([hit.y for hit in hits], dtype=np.int64),
+                   np.array([hit.location for hit in hits], dtype=np.float64).reshape(-1, 3),
+                   np.array([hit.distance for hit in hits], dtype=np.float64),
+                   np.array(rayDistances, dtype=np.float64),
+                   np.array(directions, dtype=np.float64).reshape(-1, 3),
+                   np.array([hit.intensity for hit in hits], dtype=np.float64),
+                   np.array([hit.color for hit in hits], dtype=np.float64).reshape(-1, 4),
+                   np.array([hit.categoryID for hit in hits], dtype=np.uint16),
+                   np.array([hit.partID for hit in hits], dtype=np.uint16),
+                   width, height, echo)
+
+    def toHits(self, sensorResult, exportNoiseData):
+        # convert the columns back into hit objects, so that the exporters can be used
+        hits = np.full(len(self.distances), None, dtype=hit_info.HitInfo)
+
+        for index in range(len(self.distances)):
+            hit = hit_info.HitInfo(Vector(sensorResult.location[index]), None, None, sensorResult.distance[index], None)
+            hit.color = self.colors[index]
+            hit.intensity = sensorResult.intensity[index]
+            hit.x = int(self.x[index])
+            hit.y = int(self.y[index])
+            hit.categoryID = int(self.categoryIDs[index])
+            hit.partID = int(self.partIDs[index])
+
+            if exportNoiseData:
+                hit.noiseLocation = Vector(sensorResult.noiseLocation[index])
+                hit.noiseDistance = sensorResult.noiseDistance[index]
+
+            hits[index] = hit
+
+        return hits
+
+def getFrameFilePath(filePath, fileName, frameNumber):
+    return os.path.join(bpy.path.abspath(filePath), "%s_frame_%d_geometry.npz" % (fileName, frameNumber))
+
+def saveFrame(filePath, fileName, geometry, categoryIDs, partIDs):
+    os.makedirs(bpy.path.abspath(filePath), exist_ok=True)
+
+    path = getFrameFilePath(filePath, fileName, geometry.frameNumber)
+
+    print("Caching geometric scan result to %s..." % path)
+
+    np.savez(path,
+             frameNumber=geometry.frameNumber,
+             scannerType=geometry.scannerType,
+             origin=geometry.origin,
+             numberOfRays=geometry.numberOfRays,
+             rayIndices=geometry.rayIndices,
+             x=geometry.x,
+             y=geometry.y,
+             locations=geometry.locations,
+             distances=geometry.distances,
+             rayDistances=geometry.rayDistances,
+             directions=geometry.directions,
+             intensities=geometry.intensities,
+             colors=geometry.colors,
+             categoryIDs=geometry.categoryIDs,
+             partIDs=geometry.partIDs,
+             width=geometry.width,
+             height=geometry.height,
+             echo=geometry.echo,
+             # the name -> index mappings are needed for the segmented image export
+             categoryIDMapping=json.dumps({str(key): value for key, value in categoryIDs.items()}),
+             partIDMapping=json.dumps({str(key): value for key, value in partIDs.items()}))
+
+def loadFrames(filePath, fileName, frameNumbers=None):
+    # returns all cached frames of the given scan, sorted by frame number, as well as
+    # the category and part ID mappings
+    # frameNumbers: only load these frames (default: all)
+    directory = bpy.path.abspath(filePath)
+    pattern = re.compile(r"^%s_frame_(-?\d+)_geometry\.npz$" % re.escape(fileName))
+
+    frameFiles = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match is not None and (frameNumbers is None or int(match.group(1)) in frameNumbers):
+            frameFiles.append((int(match.group(1)), os.path.join(directory, name)))
+
+    frames = []
+    categoryIDs = {}
+    partIDs = {}
+
+    for _, path in sorted(frameFiles):
+        with np.load(path) as data:
+            frames.append(FrameGeometry(int(data["frameNumber"]), str(data["scannerType"]), data["origin"], int(data["numberOfRays"]), data["rayIndices"],
+                                        data["x"], data["y"], data["locations"], data["distances"], data["rayDistances"], data["directions"],
+                                        data["intensities"], data["colors"], data["categoryIDs"], data["partIDs"], int(data["width"]), int(data["height"]),
+                                        str(data["echo"])))
+
+            categoryIDs.update(json.loads(str(data["categoryIDMapping"])))
+            partIDs.update(json.loads(str(data["partIDMapping"])))
+
+    return (frames, categoryIDs, partIDs)
+
+def removeFrames(filePath, fileName, frameNumbers):
+    # delete the cached frames, e.g. after they were merged by a frame-parallel scan
+    for frameNumber in frameNumbers:
+        path = getFrameFilePath(filePath, fileName, frameNumber)
+
+        if os.path.exists(path):
+            os.remove(path)
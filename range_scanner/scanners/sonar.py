@@ -15,13 +15,13 @@ from .. import error_distribution
 from .. import material_helper
 from ..export import exporter
 from . import hit_info
-from .. import fresnel
+from .. import optics
 from ..ui import user_interface
 from . import generic
 
 
 
-def castRay(targets, trees, origin, direction, maxRange, materialMappings, depsgraph, debugLines, debugOutput,
+def castRay(targets, trees, mergedTrees, origin, direction, maxRange, materialMappings, depsgraph, debugLines, debugOutput,
             sourceLevel, noiseLevel, directivityIndex, processingGain, receptionThreshold):
     if debugOutput:
         print("")
@@ -30,19 +30,14 @@ def castRay(targets, trees, origin, direction, maxRange, materialMappings, depsg
         print("### SUBCAST ###")
         print(origin, direction, maxRange)
 
-    closestHit = generic.getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debugLines)
+    closestHit = generic.getClosestHit(targets, trees, origin, direction, maxRange, debugOutput, debugLines, mergedTrees)
 
     if closestHit is not None:
-        materialProperty = material_helper.getMaterialColorAndMetallic(closestHit, materialMappings, depsgraph, debugOutput)
-        closestHit.color = materialProperty.color
+        closestHit.color = material_helper.getFaceColor(closestHit.target, closestHit.faceIndex, closestHit.location, materialMappings)
 
         if debugOutput:
-            print("RGBA", materialProperty.color[0], materialProperty.color[1], materialProperty.color[2], materialProperty.color[3])
-            print("Metallic ", materialProperty.metallic)
+            print("RGBA", closestHit.color[0], closestHit.color[1], closestHit.color[2], closestHit.color[3])
 
-        # see: https://link.springer.com/book/10.1007/978-1-349-20508-0, p. 18
-        transmissionLoss = 10 * np.log10(closestHit.distance)
-        
         #backscatteringCrossSection = material_helper.getSurfaceReflectivity(closestHit.color)
         #targetStrength = 10 * np.log10(backscatteringCrossSection)
 
@@ -51,39 +46,282 @@ def castRay(targets, trees, origin, direction, maxRange, materialMappings, depsg
         # just use it as factor how much of the incoming energy should be refelcted
         targetStrength = material_helper.getSurfaceReflectivity(closestHit.color)
 
-
-        ' SONAR EQUATION '
-        # see: https://www.uio.no/studier/emner/matnat/ifi/INF-GEO4310/h12/undervisningsmateriale/sonar_introduction_2012_compressed.pdf
-        # eq. (19)
-        receivedSignalLevel = sourceLevel - 2*transmissionLoss - noiseLevel + directivityIndex + processingGain # + targetStrength
-        receivedSignalLevel *= targetStrength
-
-        isMeasured = receivedSignalLevel > receptionThreshold
+        intensity, isMeasured = getSonarIntensities(closestHit.distance, targetStrength, sourceLevel, noiseLevel, directivityIndex, processingGain, receptionThreshold)
 
         if debugOutput:
-            print("SEND ", sourceLevel, transmissionLoss, targetStrength, noiseLevel, directivityIndex, processingGain)
-            print("RECEIVE ", receivedSignalLevel, isMeasured)
+            print("SEND ", sourceLevel, closestHit.distance, targetStrength, noiseLevel, directivityIndex, processingGain)
+            print("RECEIVE ", intensity * sourceLevel, isMeasured)
 
         if isMeasured:
-            closestHit.intensity = receivedSignalLevel / sourceLevel
+            closestHit.intensity = intensity
             return closestHit
             
     return None
 
+class RefractionPaths:
+    # precomputed path of each beam through the horizontal water layers
+    # B = number of beams, S = number of segments (water layers below the sensor + 1)
+    def __init__(self, origins, directions, lengths, startDistances, sourceLevels, numberOfSegments):
+        self.origins = origins                      # (B x S x 3) start of each segment
+        self.directions = directions                # (B x S x 3) normalized direction inside each segment
+        self.lengths = lengths                      # (B x S) length of each segment, the last one is unlimited
+        self.startDistances = startDistances        # (B x S) distance traveled before the segment
+        self.sourceLevels = sourceLevels            # (B x S) remaining source level after all layer borders before the segment
+        self.numberOfSegments = numberOfSegments    # (B) number of reachable segments
+
+def getFirstLayerBelowSensor(depthList, sensorHeight):
+    # the layers are sorted by depth, so their heights are descending
+    heights = np.array([value[0] for value in depthList], dtype=np.float64)
+    return int(np.searchsorted(-heights, -sensorHeight, side='right'))
+
+def getRefractionPaths(origin, directions, depthList, firstLayer, sourceLevel):
+    # the water layers are horizontal, so the bent path of a beam only depends on its depression angle
+    # and the sensor depth: the azimuth stays the same and only the angle to the vertical changes at each border
+    # this way, all layer crossings can be computed for all beams at once
+    directions = optics.normalize(directions)
+    origin = np.asarray(origin, dtype=np.float64)
+    numberOfBeams = len(directions)
+
+    layers = depthList[firstLayer:] if firstLayer < len(depthList) else []
+    numberOfSegments = len(layers) + 1
+
+    # angle to the downward vertical axis as sine/cosine
+    horizontal = directions[:, :2]
+    sinAngle = np.zeros((numberOfBeams, numberOfSegments), dtype=np.float64)
+    cosAngle = np.zeros((numberOfBeams, numberOfSegments), dtype=np.float64)
+    sinAngle[:, 0] = np.linalg.norm(horizontal, axis=1)
+    cosAngle[:, 0] = -directions[:, 2]
+
+    # unit vector of the (constant) azimuth
+    horizontalLengths = sinAngle[:, 0].copy()
+    horizontalLengths[horizontalLengths == 0.0] = 1.0
+    azimuth = horizontal / horizontalLengths[:, np.newaxis]
+
+    lengths = np.full((numberOfBeams, numberOfSegments), np.inf)
+    sourceLevels = np.full((numberOfBeams, numberOfSegments), float(sourceLevel))
+    reachable = np.ones((numberOfBeams, numberOfSegments), dtype=bool)
+
+    topHeight = origin[2]
+
+    for border, layer in enumerate(layers):
+        layerIndex = firstLayer + border
+
+        # determine the range until the next water layer
+        # beams going horizontally or upwards never reach it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lengths[:, border] = np.where(cosAngle[:, border] > 0.0, (topHeight - layer[0]) / cosAngle[:, border], np.inf)
+
+        topHeight = layer[0]
+
+        # determine n by the refractive index of the layer above and below the border
+        # https://en.wikipedia.org/wiki/Snell%27s_law
+        # sin a1   v2   n1 
+        # ------ = -- = --
+        # sin a2   v1   n2
+        v1 = depthList[layerIndex - 1][1]
+        v2 = depthList[layerIndex][1]
+
+        sinAngle[:, border + 1] = sinAngle[:, border] * v2 / v1
+
+        # in case of total internal reflection, the sound doesn't reach the next layer
+        isTotalInternalReflection = sinAngle[:, border + 1] > 1.0
+        cosAngle[:, border + 1] = np.sqrt(np.maximum(1.0 - sinAngle[:, border + 1]**2, 0.0))
+
+        # now we need to calculate how much of the waves energy is transmitted as some fraction is reflected away from the receiver
+        # see: https://epic.awi.de/id/eprint/29175/1/Hat2009b.pdf, p. 38, 2.7.4 Schalltransmission
+        p1 = depthList[layerIndex - 1][2]
+        p2 = depthList[layerIndex][2]
+
+        cosIncident = cosAngle[:, border]
+        cosRefraction = cosAngle[:, border + 1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denominator = p2 * v2 * cosIncident + p1 * v1 * cosRefraction
+            transmission = (4 * p1 * v1 * p2 * v2 * cosIncident * cosRefraction) / denominator**2 # equation (2.42)
+
+        sourceLevels[:, border + 1] = sourceLevels[:, border] * transmission
+        reachable[:, border + 1] = reachable[:, border] & np.isfinite(lengths[:, border]) & ~isTotalInternalReflection
+
+    # segments behind a total internal reflection or a border which is never reached are not used
+    lengths[~reachable] = np.inf
+    sourceLevels[~reachable] = 0.0
+
+    # direction of each segment, the first one is the original beam direction
+    segmentDirections = np.concatenate((azimuth[:, np.newaxis, :] * sinAngle[:, :, np.newaxis], -cosAngle[:, :, np.newaxis]), axis=2)
+    segmentDirections[:, 0] = directions
+
+    # start of each segment along the path
+    steps = np.where(np.isfinite(lengths), lengths, 0.0)
+    startDistances = np.concatenate((np.zeros((numberOfBeams, 1)), np.cumsum(steps[:, :-1], axis=1)), axis=1)
+    offsets = np.concatenate((np.zeros((numberOfBeams, 1, 3)), np.cumsum(segmentDirections[:, :-1] * steps[:, :-1, np.newaxis], axis=1)), axis=1)
+
+    return RefractionPaths(origin + offsets, segmentDirections, lengths, startDistances, sourceLevels, np.count_nonzero(reachable, axis=1))
+
+def getSonarIntensities(distances, targetStrengths, sourceLevels, noiseLevel, directivityIndex, processingGain, receptionThreshold):
+    # transmission loss for spherical spreading
+    # see: https://link.springer.com/book/10.1007/978-1-349-20508-0, p. 18
+    transmissionLoss = 10 * np.log10(distances)
+
+    ' SONAR EQUATION '
+    # see: https://www.uio.no/studier/emner/matnat/ifi/INF-GEO4310/h12/undervisningsmateriale/sonar_introduction_2012_compressed.pdf
+    # eq. (19)
+    receivedSignalLevel = sourceLevels - 2*transmissionLoss - noiseLevel + directivityIndex + processingGain # + targetStrength
+    receivedSignalLevel *= targetStrengths
+
+    isMeasured = receivedSignalLevel > receptionThreshold
+
+    return (receivedSignalLevel / sourceLevels, isMeasured)
+
+def getMultibeamDirections(sensorRotation, fovSonar, numberOfBeams):
+    # across-track fan of beams, centered below the sensor
+    # each beam is the "zero" direction of the sensor rotated around the Y axis
+    angles = np.radians(np.linspace(-fovSonar / 2.0, fovSonar / 2.0, numberOfBeams))
+    localDirections = np.stack((-np.sin(angles), np.zeros(numberOfBeams), -np.cos(angles)), axis=1)
+
+    # caution: we need to use the global rotation after "Follow Path" constraint is applied
+    # see comments of: https://blender.stackexchange.com/a/38179/95167 
+    return localDirections @ np.array(sensorRotation.to_matrix()).T
+
+def scanMultibeamPing(targets, trees, materialMappings, origin, paths, maxDistance,
+                      noiseLevel, directivityIndex, processingGain, receptionThreshold,
+                      noiseAbsoluteOffset, noiseRelativeOffset, gaussianNoise,
+                      pingIndex, debugLines, debugOutput):
+    # cast all beams of one ping segment by segment along their precomputed paths
+    # and evaluate the sonar equation for all of them at once
+    numberOfBeams = len(paths.numberOfSegments)
+
+    hits = np.zeros(numberOfBeams, dtype=bool)
+    locations = np.zeros((numberOfBeams, 3), dtype=np.float64)
+    faceIndices = np.zeros(numberOfBeams, dtype=np.int64)
+    targetIndices = np.full(numberOfBeams, -1, dtype=np.int64)
+    segmentDistances = np.zeros(numberOfBeams, dtype=np.float64)
+    distances = np.zeros(numberOfBeams, dtype=np.float64)
+    directions = np.zeros((numberOfBeams, 3), dtype=np.float64)
+    sourceLevels = np.zeros(numberOfBeams, dtype=np.float64)
+
+    for segment in range(paths.lengths.shape[1]):
+        remainingDistances = maxDistance - paths.startDistances[:, segment]
+
+        # beams which already hit something, left the water profile or have no scanning distance left are done
+        isActive = ~hits & (segment < paths.numberOfSegments) & (remainingDistances >= 0.0)
+        beams = np.flatnonzero(isActive)
+
+        if len(beams) == 0:
+            break
+
+        segmentHits, segmentLocations, segmentFaceIndices, segmentDistance, segmentTargetIndices = generic.castRays(
+            targets, trees, paths.origins[beams, segment], paths.directions[beams, segment],
+            np.minimum(remainingDistances[beams], paths.lengths[beams, segment]), debugOutput, debugLines)
+
+        hitBeams = beams[segmentHits]
+
+        hits[hitBeams] = True
+        locations[hitBeams] = segmentLocations[segmentHits]
+        faceIndices[hitBeams] = segmentFaceIndices[segmentHits]
+        targetIndices[hitBeams] = segmentTargetIndices[segmentHits]
+        segmentDistances[hitBeams] = segmentDistance[segmentHits]
+        distances[hitBeams] = segmentDistance[segmentHits] + paths.startDistances[hitBeams, segment]
+        directions[hitBeams] = paths.directions[hitBeams, segment]
+        sourceLevels[hitBeams] = paths.sourceLevels[hitBeams, segment]
+
+    hitBeams = np.flatnonzero(hits)
+
+    if len(hitBeams) == 0:
+        return []
+
+    hitTargets = [targets[targetIndex] for targetIndex in targetIndices[hitBeams]]
+    colors, _, _ = material_helper.sampleMaterials(hitTargets, faceIndices[hitBeams], locations[hitBeams], materialMappings)
+
+    # same as for light: instead of some formula to calculate a value, we let the user
+    # directly set the value for simplification the input process
+    # just use it as factor how much of the incoming energy should be refelcted
+    # (the transmission loss is calculated for the distance inside the last water layer, as for the side-scan beams)
+    intensities, isMeasured = getSonarIntensities(segmentDistances[hitBeams], colors[:, 3], sourceLevels[hitBeams],
+                                                  noiseLevel, directivityIndex, processingGain, receptionThreshold)
+
+    if debugOutput:
+        print("Ping %d: %d / %d beams hit, %d measured" % (pingIndex, len(hitBeams), numberOfBeams, np.count_nonzero(isMeasured)))
+
+    noise = noiseAbsoluteOffset + (distances[hitBeams] * noiseRelativeOffset / 100.0)
+
+    if gaussianNoise is not None:
+        noise += gaussianNoise[hitBeams]
+
+    # the noise moves each hit along the direction of the beam inside the last water layer
+    noiseLocations = locations[hitBeams] + directions[hitBeams] * noise[:, np.newaxis]
+
+    # the measured beams form the bathymetry swath of this ping
+    swath = []
+
+    for index in np.flatnonzero(isMeasured):
+        beam = hitBeams[index]
+
+        hit = hit_info.HitInfo(Vector(locations[beam]), None, int(faceIndices[beam]), distances[beam], hitTargets[index])
+        hit.color = colors[index]
+        hit.intensity = intensities[index]
+        hit.noiseLocation = Vector(noiseLocations[index])
+        hit.noiseDistance = distances[beam] + noise[index]
+
+        # across-track beam index and ping index
+        hit.x = int(beam)
+        hit.y = pingIndex
+
+        swath.append(hit)
+
+    return swath
+
+def exportHits(slicedScannedValues, meshNameSuffix, fileName,
+               addMesh, exportLAS, exportHDF, exportCSV, exportPLY, dataFilePath, dataFileName, frameStart, frameEnd,
+               exportNoiseData, targets, categoryIDs, partIDs, materialMappings, targetLabels, debugOutput):
+    # set category/part id for all hits to enable segmentation
+    generic.assignLabels(slicedScannedValues, targetLabels)
+
+    if addMesh:
+        generic.addMeshToScene("real_values%s" % meshNameSuffix, slicedScannedValues, False)
+
+        if exportNoiseData:
+            generic.addMeshToScene("noise_values%s" % meshNameSuffix, slicedScannedValues, True)
+
+    # save data to files
+    if debugOutput:
+        print("File path ", os.path.abspath(dataFilePath))
+
+    if len(slicedScannedValues) > 0:
+        # setup exporter with our data
+        if exportLAS or exportHDF or exportCSV or exportPLY:
+            fileExporter = exporter.Exporter(dataFilePath, fileName, dataFileName, slicedScannedValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, 0, 0)
+
+            # export to each format
+            if exportLAS:
+                fileExporter.exportLAS()
+
+            if exportHDF:
+                fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_single" % (frameStart, frameEnd))
+
+            if exportCSV:
+                fileExporter.exportCSV()
+
+            if exportPLY:
+                fileExporter.exportPLY()
+    else:
+        print("No data to export!")
+
 def performScan(context, 
                 scannerType, scannerObject,
                 maxDistance,
-                fovSonar, sonarStepDegree, sonarMode3D, sonarKeepRotation,
+                fovSonar, sonarStepDegree, sonarMode3D, sonarKeepRotation, multibeam, numberOfBeams,
                 sourceLevel, noiseLevel, directivityIndex, processingGain, receptionThreshold,    
                 simulateWaterProfile, depthList,  
-                addNoise, noiseType, mu, sigma, addConstantNoise, noiseAbsoluteOffset, noiseRelativeOffset,
+                addNoise, noiseType, mu, sigma, addConstantNoise, noiseAbsoluteOffset, noiseRelativeOffset, noiseGenerator,
                 addMesh,
                 exportLAS, exportHDF, exportCSV, exportPLY, exportSingleFrames,
+                exportWaterfall, waterfallResolution, waterfallBitDepth, waterfallGroundRange,
                 dataFilePath, dataFileName,
                 debugLines, debugOutput, outputProgress, measureTime, singleRay, destinationObject, targetObject,
                 enableAnimation, frameStart, frameEnd, frameStep,
+                levelOfDetail, meshCache, mergedTargets,
                 targets, materialMappings,
-                categoryIDs, partIDs):
+                categoryIDs, partIDs, targetLabels):
 
     if measureTime:
         startTime = time.time()
@@ -110,16 +348,6 @@ def performScan(context,
         print(xRange)
         print(yRange)
 
-    totalNumberOfRays = xRange.size * yRange.size * int((frameEnd - frameStart + 1) / frameStep)
-
-    # array to store hit information
-    # we don't know how many of our rays will actually hit an object, so we allocate
-    # memory for the worst case of every ray hitting the scene
-    # (TODO depending on the RAM usage, it might be a good idea to use some kind of caching)
-    scannedValues = np.full(totalNumberOfRays, None, dtype=hit_info.HitInfo)
-
-    valueIndex = 0
-
     if enableAnimation:
         # read the needed camera settings
         # alternative: get needed values from the main Blender GUI ('Output Properties' tab on the right)
@@ -130,6 +358,39 @@ def performScan(context,
         firstFrame = bpy.context.scene.frame_current
         lastFrame = bpy.context.scene.frame_current
         frameStep = 1  
+
+    frameRange = range(firstFrame, lastFrame + 1, frameStep)
+
+    # number of rays of one ping
+    if multibeam:
+        raysPerPing = numberOfBeams
+
+        # the waterfall image is only available for the two side-scan beams
+        exportWaterfall = False
+    else:
+        raysPerPing = xRange.size * yRange.size
+
+    totalNumberOfRays = raysPerPing * len(frameRange)
+
+    # the smallest angle between two neighboring beams
+    if multibeam:
+        angularResolution = math.radians(fovSonar / (numberOfBeams - 1))
+    else:
+        angularResolution = math.radians(sonarStepDegree)
+
+    levelStatistics = {}
+
+    # array to store hit information
+    # we don't know how many of our rays will actually hit an object, so we allocate
+    # memory for the worst case of every ray hitting the scene
+    # if single frames are exported, each ping is written right after scanning it, so we only need to
+    # store the hits of one ping
+    if exportSingleFrames:
+        scannedValues = np.full(raysPerPing, None, dtype=hit_info.HitInfo)
+    else:
+        scannedValues = np.full(totalNumberOfRays, None, dtype=hit_info.HitInfo)
+
+    valueIndex = 0
     
     bpy.context.scene.frame_set(firstFrame)
 
@@ -143,7 +404,6 @@ def performScan(context,
 
     # set counter of scanned rays to 0
     indexX = 0
-    indexY = 0
 
     if measureTime:
         print("Prepare: %s s" % (time.time() - startTime))
@@ -155,203 +415,173 @@ def performScan(context,
 
     exportNoiseData = addNoise or addConstantNoise
 
-    for frameNumber in range(firstFrame, lastFrame + 1, frameStep):
+    if exportWaterfall:
+        from ..export import export_waterfall
+        os.makedirs(bpy.path.abspath(dataFilePath), exist_ok=True)
+        waterfallWriter = export_waterfall.WaterfallWriter(bpy.path.abspath(dataFilePath), dataFileName, len(frameRange), waterfallResolution, maxDistance, int(waterfallBitDepth), waterfallGroundRange)
+
+    for pingIndex, frameNumber in enumerate(frameRange):
         bpy.context.scene.frame_set(frameNumber)
 
         # setup BVH tree for each object
-        trees = generic.getBVHTrees(trees, targets, depsgraph)
-        
-        sensorHeight = sensor.matrix_world.translation.z
+        # skip all targets which are out of range in this frame
+        if singleRay:
+            visibleTargets = targets
+        else:
+            visibleTargets = generic.getVisibleTargets(targets, depsgraph, sensor.matrix_world, maxDistance)
+
+        trees = generic.getBVHTrees(trees, targets, depsgraph, visibleTargets, meshCache, mergedTargets)
+        generic.updateTiles(trees, sensor.matrix_world.translation, maxDistance)
+
+        if levelOfDetail:
+            generic.updateLevelsOfDetail(trees, targets, depsgraph, sensor.matrix_world.translation, angularResolution, levelStatistics)
+        activeTargets = generic.getActiveTargets(targets, trees)
+        mergedTrees = generic.getMergedTrees(trees)
 
-        firstValueBelowSensor = -1
+        if addNoise:
+            # generate the noise for all rays of this frame at once
+            gaussianNoise = noiseGenerator.frameNoise(error_distribution.NoiseStream.gaussian, frameNumber, raysPerPing, noiseType, mu, sigma)
+
+        sensorHeight = sensor.matrix_world.translation.z
 
         # for each timestep, calculate the traveled distance for normalization
         traveledDistance = math.sqrt((startLocation.x - origin.x)**2 + (startLocation.y - origin.y)**2 + (startLocation.z - origin.z)**2)
 
-        for index, value in enumerate(depthList):
-            if value[0] < sensorHeight:
-                firstValueBelowSensor = index
-                break
-        
-        if firstValueBelowSensor == 0:
-            # the first value is below the sensor, so we don't know the 
-            # refractive index at the start of the ray
-            print("You must set at least 1 refractive index above the sensor!")
-            return 
-
-        if firstValueBelowSensor == -1:
-            # all values are above the sensor or no values are given
-            # in both cases we don't have to care about refraction
-            simulateWaterProfile = False
-
-        # iterate over all X/Y coordinates
-        for x in xRange:
-            # setup vector in the according direction
-            quatX = Quaternion((0.0, 1.0, 0.0), radians(x))
-            
-            for y in yRange:
-                quatY = Quaternion((1.0, 0.0, 0.0), radians(y))
+        if simulateWaterProfile:
+            firstLayer = getFirstLayerBelowSensor(depthList, sensorHeight)
 
-                # define "zero" direction of sensor
-                vec = Vector((0.0, 0.0, -1.0))
-                
-                # calculate destination translation from X/Y directions
-                quatAll = quatX @ quatY
-                vec.rotate(quatAll)
-
-                # caution: we can't use sensor.rotation_euler as it only gives us the 
-                # object's local rotation
-                # instead, we need to use the global rotation after "Follow Path" constraint is applied
-                # see comments of: https://blender.stackexchange.com/a/38179/95167 
-                vec.rotate(sensor.matrix_world.decompose()[1])
-                            
-                # calculate destination location
-                destination = vec + sensor.matrix_world.translation
+            if firstLayer == 0:
+                # the first value is below the sensor, so we don't know the 
+                # refractive index at the start of the ray
+                print("You must set at least 1 refractive index above the sensor!")
 
-                if singleRay:
-                    destination = destinationObject.matrix_world.translation
+                # the sensor can move above the first layer during the animation, so this can't be checked
+                # before scanning, keep the pings which are already scanned
+                if exportWaterfall:
+                    waterfallWriter.close()
 
-                # calculate ray direction 
-                direction = (destination - origin).normalized()
-                
-                closestHit = None
-                internalOrigin = origin
+                return
+        else:
+            # we don't have to care about refraction
+            firstLayer = len(depthList)
 
-                if simulateWaterProfile:
-                    angle = Vector((0.0, 0.0, -1.0)).angle(direction) 
+        if multibeam:
+            # all beams of the across-track fan are generated, cast and evaluated as arrays
+            beamDirections = getMultibeamDirections(sensor.matrix_world.decompose()[1], fovSonar, numberOfBeams)
+            paths = getRefractionPaths(origin, beamDirections, depthList, firstLayer, sourceLevel)
 
-                    remainingDistance = maxDistance   
+            swath = scanMultibeamPing(targets, trees, materialMappings, origin, paths, maxDistance,
+                                      noiseLevel, directivityIndex, processingGain, receptionThreshold,
+                                      noiseAbsoluteOffset, noiseRelativeOffset, gaussianNoise if addNoise else None,
+                                      pingIndex, debugLines, debugOutput)
 
-                    oldHeight = sensorHeight        
+            for hit in swath:
+                # save closest hit into array
+                scannedValues[valueIndex] = hit
+                valueIndex += 1
 
-                    remainingSourceLevel = sourceLevel
+            if outputProgress:
+                generic.updateProgress("Scanning scene", (pingIndex + 1) / len(frameRange))
+        else:
+            # collect the directions of all beams of this frame first
+            beamDirections = []
+            beamX = []
+
+            # iterate over all X/Y coordinates
+            for x in xRange:
+                # setup vector in the according direction
+                quatX = Quaternion((0.0, 1.0, 0.0), radians(x))
+            
+                for y in yRange:
+                    quatY = Quaternion((1.0, 0.0, 0.0), radians(y))
 
-                    distanceTraveled = 0.0
+                    # define "zero" direction of sensor
+                    vec = Vector((0.0, 0.0, -1.0))
+                
+                    # calculate destination translation from X/Y directions
+                    quatAll = quatX @ quatY
+                    vec.rotate(quatAll)
+
+                    # caution: we can't use sensor.rotation_euler as it only gives us the 
+                    # object's local rotation
+                    # instead, we need to use the global rotation after "Follow Path" constraint is applied
+                    # see comments of: https://blender.stackexchange.com/a/38179/95167 
+                    vec.rotate(sensor.matrix_world.decompose()[1])
+                            
+                    # calculate destination location
+                    destination = vec + sensor.matrix_world.translation
 
-                    for layerIndex in range(firstValueBelowSensor, len(depthList) + 1):
-                        # after passing the final layer, the ray distance is only limited by the
-                        # sensor's parameters, not the water layers
-                        if layerIndex == len(depthList):
-                            newRange = remainingDistance
-                        else:
-                            # else, determine the range until the next water layer
-                            newRange = (oldHeight - depthList[layerIndex][0]) / np.cos(angle)
+                    if singleRay:
+                        destination = destinationObject.matrix_world.translation
 
-                            oldHeight = depthList[layerIndex][0]
+                    # calculate ray direction 
+                    beamDirections.append((destination - origin).normalized())
+                    beamX.append(x)
 
-                            if debugOutput:
-                                print(sensorHeight, depthList[layerIndex][0], depthList[layerIndex][1], angle, remainingDistance, newRange)
-                            
-                        closestHit = castRay(targets, trees, internalOrigin, direction, min(remainingDistance, newRange), materialMappings, depsgraph, debugLines, debugOutput,
-                                        remainingSourceLevel, noiseLevel, directivityIndex, processingGain, receptionThreshold)
-                        
-                        if debugLines:
-                            generic.addLine(internalOrigin, internalOrigin + direction * min(remainingDistance, newRange))
-                            
-                        if closestHit is None:
-                            # no hit was found
-                            # decrease the scanning distance for next run
-                            remainingDistance -= newRange
-                            distanceTraveled += newRange
-
-                            # no scanning distance left or final layer reached, abort
-                            if remainingDistance < 0 or layerIndex == len(depthList):
-                                break
-                            
-                            if debugOutput:
-                                print("No hit from ", internalOrigin, " in direction ", direction, " within range of ", min(remainingDistance, newRange))
-                                print("Adding line from ", internalOrigin, " to ", internalOrigin + direction * min(remainingDistance, newRange) )
-                                                        
-                            # for the next ray we need to refract the current ray at the border
-                            # of the two adjacent layers
-
-                            # see: https://en.wikipedia.org/wiki/Snell%27s_law
-                            #      https://en.wikipedia.org/wiki/List_of_refractive_indices
-
-                            # as the water layers are not represented by Blender objects, we
-                            # need to define the normal manually as upwards (positive Z axis)
-                            normal = Vector((0.0, 0.0, 1.0)).normalized()
-
-                            # determine n by the refractive index of the layer above and below the border
-                            # https://en.wikipedia.org/wiki/Snell%27s_law
-                            # sin a1   v2   n1 
-                            # ------ = -- = --
-                            # sin a2   v1   n2
-
-                            # we now need to get n1 / n2, so we can also take v2 / v1
-                            v1 = depthList[layerIndex - 1][1]
-                            v2 = depthList[layerIndex][1]
-                            
-                            n = v2 / v1
+                    if singleRay:
+                        break
 
-                            if debugOutput:
-                                print(v1, v2, n)
+                if singleRay:
+                    break
 
-                            # calculate new direction vector
-                            # see: http://www.starkeffects.com/snells-law-vector.shtml
-                            newDirection = n * (normal.cross(-normal.cross(direction))) - normal * np.sqrt(1 - (n**2) * (normal.cross(direction) @ normal.cross(direction)))
+            # side, range and intensity of each hit of this ping for the waterfall image
+            pingIsPort = []
+            pingSlantRanges = []
+            pingGroundRanges = []
+            pingIntensities = []
 
-                            incidentAngle = normal.angle(direction)
-                            refractionAngle = normal.angle(newDirection)
+            # the path of each beam through the water layers only depends on the sensor depth and the beam direction,
+            # so we compute all layer crossings once and only cast rays along the precomputed segments
+            paths = getRefractionPaths(origin, beamDirections, depthList, firstLayer, sourceLevel)
 
-                            if debugOutput:
-                                print(normal.normalized(), direction.normalized(), newDirection.normalized())
-                                print(incidentAngle, refractionAngle)
+            for beamIndex, x in enumerate(beamX):
+                closestHit = None
 
-                            # now we need to calculate how much of the waves energy is transmitted as some fraction is reflected away from the receiver
-                            # see: https://epic.awi.de/id/eprint/29175/1/Hat2009b.pdf, p. 38, 2.7.4 Schalltransmission
-                            p1 = depthList[layerIndex - 1][2]
-                            p2 = depthList[layerIndex][2]
+                for segment in range(paths.numberOfSegments[beamIndex]):
+                    remainingDistance = maxDistance - paths.startDistances[beamIndex, segment]
 
-                            denominator = p2 * v2 * np.cos(incidentAngle) + p1 * v1 * np.cos(refractionAngle)
-                            transmission = (4 * p1 * v1 * p2 * v2 * np.cos(incidentAngle) * np.cos(refractionAngle)) / denominator**2 # equation (2.42)
+                    # no scanning distance left
+                    if remainingDistance < 0:
+                        break
 
-                            if debugOutput:
-                                print("density ", p1, p2, "transmission", transmission)
-                            
-                            # set ray parameters for next run
-                            internalOrigin = direction * newRange + internalOrigin
-                            direction = newDirection
-                            remainingSourceLevel *= transmission
+                    internalOrigin = Vector(paths.origins[beamIndex, segment])
+                    direction = Vector(paths.directions[beamIndex, segment])
+                    segmentRange = min(remainingDistance, paths.lengths[beamIndex, segment])
+
+                    if debugOutput:
+                        print("Segment ", segment, " from ", internalOrigin, " in direction ", direction, " within range of ", segmentRange, ", source level ", paths.sourceLevels[beamIndex, segment])
+
+                    closestHit = castRay(activeTargets, trees, mergedTrees, internalOrigin, direction, segmentRange, materialMappings, depsgraph, debugLines, debugOutput,
+                                         paths.sourceLevels[beamIndex, segment], noiseLevel, directivityIndex, processingGain, receptionThreshold)
+
+                    if debugLines:
+                        generic.addLine(internalOrigin, internalOrigin + direction * segmentRange)
 
-                            if debugOutput:
-                                print("New origin ", internalOrigin, ", new direction ", direction)
-                        else:
-                            break
-                    
                     if closestHit is not None:
                         # important: update the total distance, as currently it is set so the distance
                         # between the hitpoint and water layer above!
-                        closestHit.distance = closestHit.distance + distanceTraveled                
-                else:
-                    closestHit = castRay(targets, trees, origin, direction, maxDistance, materialMappings, depsgraph, debugLines, debugOutput,
-                                     sourceLevel, noiseLevel, directivityIndex, processingGain, receptionThreshold)
+                        closestHit.distance = closestHit.distance + paths.startDistances[beamIndex, segment]
+                        break
+
+                # the index of the current ray inside the frame
+                rayIndex = beamIndex
 
                 # if location is None, no hit was found within the given range
                 if closestHit is not None:
-                    # set category/part id for that hit to enable segmentation
-                    if "partID" in closestHit.target:
-                        partIDIndex = closestHit.target["partID"]
-                    else:
-                        partIDIndex = closestHit.target.material_slots[materialMappings[closestHit.target][closestHit.faceIndex]].name
-
-                    closestHit.categoryID = categoryIDs[closestHit.target["categoryID"]]
-                    closestHit.partID = partIDs[partIDIndex]
-                    
                     noise = noiseAbsoluteOffset + (closestHit.distance * noiseRelativeOffset / 100.0)
 
                     if addNoise:
                         # generate some noise
                         # error model: https://github.com/mgschwan/blensor/blob/master/release/scripts/addons/blensor/gaussian_error_model.py#L21
                         #              https://github.com/mgschwan/blensor/blob/0b6cca9f189b1e072cfd8aaa6360deeab0b96c61/release/scripts/addons/blensor/generic_lidar.py#L172
-                        noise += error_distribution.applyNoise(mu, sigma)
+                        noise += gaussianNoise[rayIndex]
 
                     # we can't simply move the hit location around by some random translation
                     # instead, we have to move it along the ray direction
 
                     # calculate distance with noise
                     noiseDistance = closestHit.distance + noise
-                    
+                
                     # calculate the direction vector with noise applied
                     noiseDirection =  direction.normalized() * noiseDistance
 
@@ -361,7 +591,7 @@ def performScan(context,
                     if debugOutput:
                         print("Noise Distance ", noiseDistance)
                         print("Noise Location ", noiseLocation)
-                    
+                
                     closestHit.noiseLocation = noiseLocation
                     closestHit.noiseDistance = noiseDistance
 
@@ -372,6 +602,13 @@ def performScan(context,
                         print("Noise ", noise)
                         print("Distance ", closestHit.distance)     
 
+                    if exportWaterfall:
+                        # the ground range is measured on the real hit location, before it is moved into the sonar plane
+                        pingIsPort.append(x > 0)
+                        pingSlantRanges.append(noiseDistance if exportNoiseData else closestHit.distance)
+                        pingGroundRanges.append(math.sqrt((closestHit.location.x - origin.x)**2 + (closestHit.location.y - origin.y)**2))
+                        pingIntensities.append(closestHit.intensity)
+
                     if not sonarMode3D:
                         # to simulate sonar, we have to move all values into one plane
                         if sonarKeepRotation:
@@ -381,7 +618,7 @@ def performScan(context,
                                 closestHit.location.x = -closestHit.distance
                             else:
                                 closestHit.location.x = closestHit.distance
-                            
+                        
                             closestHit.location.y = traveledDistance
                             closestHit.location.z = startLocation.z
 
@@ -392,64 +629,47 @@ def performScan(context,
                 else:
                     if debugOutput:
                         print("NO HIT within range of %f" % maxDistance)
-                
-                indexY += 1
 
-                if singleRay:
-                    break
-            
-            indexX += 1
-            indexY = 0
+                # update the progress bar after each side and depression angle column
+                if outputProgress and (beamIndex + 1) % yRange.size == 0:
+                    indexX += 1
+                    percentage = (indexX * yRange.size) / totalNumberOfRays 
+                    generic.updateProgress("Scanning scene", percentage)
 
-            if outputProgress:
-                percentage = (indexX * yRange.size) / totalNumberOfRays 
-                generic.updateProgress("Scanning scene", percentage)
+        if exportWaterfall:
+            waterfallWriter.addPing(pingIndex, pingIsPort, pingSlantRanges, pingGroundRanges, pingIntensities)
 
-            if singleRay:
-                break
+        if exportSingleFrames:
+            # write the hits of this ping right away and reuse the array for the next one,
+            # so that the memory usage does not grow with the length of the survey
+            # (all pings are appended to the same .hdf5 file)
+            exportHits(scannedValues[:valueIndex], "_frame_%d" % frameNumber, "%s_frame_%d" % (dataFileName, frameNumber),
+                       addMesh, exportLAS, exportHDF, exportCSV, exportPLY, dataFilePath, dataFileName, frameStart, frameEnd,
+                       exportNoiseData, targets, categoryIDs, partIDs, materialMappings, targetLabels, debugOutput)
+
+            scannedValues[:valueIndex] = None
+            valueIndex = 0
 
     if measureTime:
         print("Loop: %s s" % (time.time() - startTime))
         startTime = time.time()
 
-    # we now have the final number of hits so we could shrink the array here
-    # as explained here (https://stackoverflow.com/a/32398318/13440564), resizing
-    # would cause a copy, so we slice the array instead
-    slicedScannedValues = scannedValues[:valueIndex]
+    if exportWaterfall:
+        waterfallWriter.close()
 
-    if addMesh:
-        generic.addMeshToScene("real_values", slicedScannedValues, False)
+    if levelOfDetail:
+        generic.printLevelStatistics(levelStatistics)
 
-        if exportNoiseData:
-            generic.addMeshToScene("noise_values", slicedScannedValues, True)
+    if meshCache is not None and debugOutput:
+        meshCache.printStatistics()
 
-    if measureTime:
-        print("Meshes: %s s" % (time.time() - startTime))
-        startTime = time.time()
-
-    # save data to files
-    if debugOutput:
-        print("File path ", os.path.abspath(dataFilePath))
-
-    if len(slicedScannedValues) > 0:
-        # setup exporter with our data
-        if exportLAS or exportHDF or exportCSV or exportPLY:
-            fileExporter = exporter.Exporter(dataFilePath, "%s_frame_%d" % (dataFileName, frameNumber), dataFileName, slicedScannedValues, targets, categoryIDs, partIDs, materialMappings, exportNoiseData, 0, 0)
-
-            # export to each format
-            if exportLAS:
-                fileExporter.exportLAS()
-
-            if exportHDF:
-                fileExporter.exportHDF(fileNameExtra="_frames_%d_to_%d_single" % (frameStart, frameEnd))
-
-            if exportCSV:
-                fileExporter.exportCSV()
-
-            if exportPLY:
-                fileExporter.exportPLY()
-    else:
-        print("No data to export!")
+    if not exportSingleFrames:
+        # we now have the final number of hits so we could shrink the array here
+        # as explained here (https://stackoverflow.com/a/32398318/13440564), resizing
+        # would cause a copy, so we slice the array instead
+        exportHits(scannedValues[:valueIndex], "", "%s_frame_%d" % (dataFileName, frameNumber),
+                   addMesh, exportLAS, exportHDF, exportCSV, exportPLY, dataFilePath, dataFileName, frameStart, frameEnd,
+                   exportNoiseData, targets, categoryIDs, partIDs, materialMappings, targetLabels, debugOutput)
 
     if measureTime:
         print("Output: %s s" % (time.time() - startTime))
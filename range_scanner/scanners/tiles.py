@@ -0,0 +1,307 @@
+import numpy as np
+import os
+import tempfile
+from collections import OrderedDict
+from mathutils import Vector
+from mathutils.bvhtree import BVHTree
+
+from . import heightfield
+
+# very large terrains are split into square tiles (in the object's local XY plane) which are written to disk
+# only the tiles within the sensor's range are kept in memory, the least recently used ones are evicted
+# as the sensor moves on, so the memory usage does not depend on the size of the terrain
+# each tile also stores the normals of its faces, so not even these are kept for the whole terrain
+# the custom property "tileSize" (local units) enables this mode for an object, "maxLoadedTiles"
+# optionally overrides the default number of tiles kept in memory
+# with the mesh cache enabled, the tiles are stored in it and reused by later scans (see MeshCache.getTiledTree)
+
+defaultMaxLoadedTiles = 64
+
+class TriangleTree:
+    # BVH tree of a triangulated mesh, same interface as BVHTree.ray_cast (local space)
+    # but the face index of the original mesh is returned
+    def __init__(self, vertices, triangles, polygonIndices, faceNormals):
+        self.tree = BVHTree.FromPolygons(vertices.tolist(), triangles.tolist())
+        self.polygonIndices = polygonIndices    # (T) face index of each triangle
+        self.faceNormals = faceNormals          # (F x 3)
+
+    def ray_cast(self, origin, direction, distance):
+        location, _, triangleIndex, distance = self.tree.ray_cast(origin, direction, distance)
+
+        if location is None:
+            return (None, None, None, None)
+
+        faceIndex = int(self.polygonIndices[triangleIndex])
+
+        return (location, Vector(self.faceNormals[faceIndex]), faceIndex, distance)
+
+class Tile:
+    def __init__(self, tree, triangleFaces, polygons, faceNormals):
+        self.tree = tree
+        self.triangleFaces = triangleFaces      # (T) index into polygons of each triangle in the tile
+        self.polygons = polygons                # (P) sorted face indices of the whole mesh
+        self.faceNormals = faceNormals          # (P x 3)
+
+def intersectBounds(origins, directions, boundsMin, boundsMax, maxDistances):
+    # slab test of (normalized) rays against one axis aligned box, returns a mask of all rays
+    # which pass the box within their range
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (boundsMin - origins) / directions
+        t2 = (boundsMax - origins) / directions
+
+    isParallel = directions == 0.0
+    isInsideSlab = (origins >= boundsMin) & (origins <= boundsMax)
+
+    tNear = np.where(isParallel, np.where(isInsideSlab, -np.inf, np.inf), np.minimum(t1, t2)).max(axis=1)
+    tFar = np.where(isParallel, np.where(isInsideSlab, np.inf, -np.inf), np.maximum(t1, t2)).min(axis=1)
+
+    return (np.maximum(tNear, 0.0) <= tFar) & (tNear <= maxDistances)
+
+class TiledTree:
+    # same interface as BVHTree.ray_cast (local space), additionally all rays can be cast at once
+    def __init__(self, directoryPath, boundsMin, boundsMax, maxLoadedTiles, temporaryDirectory=None):
+        self.directoryPath = directoryPath
+
+        # keep a reference, so that a temporary directory is deleted together with the tree
+        self.temporaryDirectory = temporaryDirectory
+
+        self.boundsMin = boundsMin      # (T x 3)
+        self.boundsMax = boundsMax      # (T x 3)
+        self.maxLoadedTiles = maxLoadedTiles
+
+        # tile index -> Tile, in order of their last usage
+        self.loadedTiles = OrderedDict()
+
+        # until the first update, all tiles are tested
+        self.activeTiles = np.arange(len(boundsMin))
+
+    def getTileFilePath(self, tileIndex):
+        return os.path.join(self.directoryPath, "tile_%d.npz" % tileIndex)
+
+    def getTile(self, tileIndex):
+        if tileIndex in self.loadedTiles:
+            self.loadedTiles.move_to_end(tileIndex)
+            return self.loadedTiles[tileIndex]
+
+        with np.load(self.getTileFilePath(tileIndex)) as data:
+            vertices = data["vertices"]
+            triangles = data["triangles"]
+            triangleFaces = data["triangleFaces"]
+            polygons = data["polygons"]
+            faceNormals = data["faceNormals"]
+
+        # most tiles of a grid terrain are grids themselves
+        tree = heightfield.fromArrays(vertices, np.arange(len(triangles)) * 3, np.full(len(triangles), 3), triangles.ravel(), faceNormals)
+
+        if tree is not None:
+            # the heightfield returns the triangle index inside the tile, so map it to the face directly
+            tree.cellFaces = triangleFaces[tree.cellFaces]
+            triangleFaces = None
+        else:
+            tree = BVHTree.FromPolygons(vertices.tolist(), triangles.tolist())
+
+        tile = Tile(tree, triangleFaces, polygons, faceNormals)
+
+        self.loadedTiles[tileIndex] = tile
+
+        # evict the least recently used tiles, but never those which are needed in the current frame
+        while len(self.loadedTiles) > max(self.maxLoadedTiles, len(self.activeTiles)):
+            self.loadedTiles.popitem(last=False)
+
+        return tile
+
+    def update(self, sensorLocations, radii):
+        # activate all tiles within the range of the sensor(s), given in local space
+        isActive = np.zeros(len(self.boundsMin), dtype=bool)
+
+        for sensorLocation, radius in zip(sensorLocations, radii):
+            # distance between the sensor and the closest point of each tile
+            offsets = np.maximum(np.maximum(self.boundsMin - sensorLocation, sensorLocation - self.boundsMax), 0.0)
+            isActive |= np.linalg.norm(offsets, axis=1) <= radius
+
+        self.activeTiles = np.flatnonzero(isActive)
+
+        if len(self.activeTiles) > self.maxLoadedTiles:
+            print("WARNING: %d tiles are within the sensor's range, but only %d should be loaded!" % (len(self.activeTiles), self.maxLoadedTiles))
+
+        for tileIndex in self.activeTiles:
+            self.getTile(tileIndex)
+
+    def ray_cast_batch(self, origins, directions, maxDistances):
+        origins = np.asarray(origins, dtype=np.float64)
+        directions = np.asarray(directions, dtype=np.float64)
+
+        lengths = np.linalg.norm(directions, axis=1)
+        lengths[lengths == 0.0] = 1.0
+        directions = directions / lengths[:, np.newaxis]
+
+        numberOfRays = len(origins)
+
+        hits = np.zeros(numberOfRays, dtype=bool)
+        faceIndices = np.zeros(numberOfRays, dtype=np.int64)
+        distances = np.zeros(numberOfRays, dtype=np.float64)
+
+        closestDistances = np.array(maxDistances, dtype=np.float64)
+
+        for tileIndex in self.activeTiles:
+            rays = np.flatnonzero(intersectBounds(origins, directions, self.boundsMin[tileIndex], self.boundsMax[tileIndex], closestDistances))
+
+            if len(rays) == 0:
+                continue
+
+            tile = self.getTile(tileIndex)
+
+            if tile.triangleFaces is None:
+                tileHits, _, tileFaceIndices, tileDistances = tile.tree.ray_cast_batch(origins[rays], directions[rays], closestDistances[rays])
+                tileFaceIndices = tile.polygons[tileFaceIndices]
+            else:
+                tileHits = np.zeros(len(rays), dtype=bool)
+                tileFaceIndices = np.zeros(len(rays), dtype=np.int64)
+                tileDistances = np.zeros(len(rays), dtype=np.float64)
+
+                for index, rayIndex in enumerate(rays):
+                    location, _, triangleIndex, distance = tile.tree.ray_cast(Vector(origins[rayIndex]), Vector(directions[rayIndex]), closestDistances[rayIndex])
+
+                    if location is not None:
+                        tileHits[index] = True
+                        tileFaceIndices[index] = tile.polygons[tile.triangleFaces[triangleIndex]]
+                        tileDistances[index] = distance
+
+            isCloser = tileHits & (tileDistances < closestDistances[rays])
+            closerRays = rays[isCloser]
+
+            hits[closerRays] = True
+            faceIndices[closerRays] = tileFaceIndices[isCloser]
+            distances[closerRays] = tileDistances[isCloser]
+            closestDistances[closerRays] = tileDistances[isCloser]
+
+        locations = origins + directions * distances[:, np.newaxis]
+
+        return (hits, locations, faceIndices, distances)
+
+    def ray_cast(self, origin, direction, distance):
+        hits, locations, faceIndices, distances = self.ray_cast_batch(np.array([origin]), np.array([direction]), np.array([distance]))
+
+        if not hits[0]:
+            return (None, None, None, None)
+
+        return (Vector(locations[0]), Vector(self.getFaceNormals(faceIndices)[0]), int(faceIndices[0]), float(distances[0]))
+
+    def getFaceNormals(self, faceIndices):
+        # local normals of the given faces, which have to be hit in the current frame
+        # every hit face is part of an active tile, so only these are searched
+        faceIndices = np.asarray(faceIndices, dtype=np.int64)
+
+        normals = np.zeros((len(faceIndices), 3), dtype=np.float64)
+        isFound = np.zeros(len(faceIndices), dtype=bool)
+
+        for tileIndex in self.activeTiles:
+            tile = self.getTile(tileIndex)
+
+            positions = np.minimum(np.searchsorted(tile.polygons, faceIndices), len(tile.polygons) - 1)
+            isInTile = ~isFound & (tile.polygons[positions] == faceIndices)
+
+            normals[isInTile] = tile.faceNormals[positions[isInTile]]
+            isFound |= isInTile
+
+        return normals
+
+def getTriangles(sourceObject, depsgraph):
+    # triangulated evaluated mesh in local space, together with the face index of each triangle
+    # see: https://docs.blender.org/api/current/bpy.types.Mesh.html#bpy.types.Mesh.loop_triangles
+    evaluatedObject = sourceObject.evaluated_get(depsgraph)
+    mesh = evaluatedObject.to_mesh()
+    mesh.calc_loop_triangles()
+
+    vertices = np.empty(len(mesh.vertices) * 3, dtype=np.float64)
+    mesh.vertices.foreach_get("co", vertices)
+    vertices = vertices.reshape(-1, 3)
+
+    triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+    mesh.loop_triangles.foreach_get("vertices", triangles)
+    triangles = triangles.reshape(-1, 3)
+
+    polygonIndices = np.empty(len(mesh.loop_triangles), dtype=np.int64)
+    mesh.loop_triangles.foreach_get("polygon_index", polygonIndices)
+
+    evaluatedObject.to_mesh_clear()
+
+    return (vertices, triangles, polygonIndices)
+
+def getFaceNormals(sourceObject, depsgraph):
+    # local normals of all faces of the evaluated mesh
+    evaluatedObject = sourceObject.evaluated_get(depsgraph)
+    mesh = evaluatedObject.to_mesh()
+
+    faceNormals = np.empty(len(mesh.polygons) * 3, dtype=np.float64)
+    mesh.polygons.foreach_get("normal", faceNormals)
+
+    evaluatedObject.to_mesh_clear()
+
+    return faceNormals.reshape(-1, 3)
+
+def getMaxLoadedTiles(sourceObject):
+    if "maxLoadedTiles" in sourceObject:
+        return int(sourceObject["maxLoadedTiles"])
+
+    return defaultMaxLoadedTiles
+
+def writeTiles(directoryPath, sourceObject, depsgraph):
+    # split the mesh into tiles and write them to the given directory
+    # the index with the bounds of all tiles is written last, so a directory with an index is complete
+    tileSize = float(sourceObject["tileSize"])
+
+    vertices, triangles, polygonIndices = getTriangles(sourceObject, depsgraph)
+    faceNormals = getFaceNormals(sourceObject, depsgraph)
+
+    # each triangle belongs to the tile which contains its center
+    centers = vertices[triangles].mean(axis=1)
+    minimum = vertices[:, :2].min(axis=0)
+
+    tileCoordinates = np.floor((centers[:, :2] - minimum) / tileSize).astype(np.int64)
+    tileKeys = tileCoordinates[:, 1] * (tileCoordinates[:, 0].max() + 1) + tileCoordinates[:, 0]
+
+    uniqueKeys, triangleTiles = np.unique(tileKeys, return_inverse=True)
+    order = np.argsort(triangleTiles, kind='stable')
+    tileStarts = np.searchsorted(triangleTiles[order], np.arange(len(uniqueKeys) + 1))
+
+    boundsMin = np.empty((len(uniqueKeys), 3), dtype=np.float64)
+    boundsMax = np.empty((len(uniqueKeys), 3), dtype=np.float64)
+
+    for tileIndex in range(len(uniqueKeys)):
+        tileTriangles = order[tileStarts[tileIndex]:tileStarts[tileIndex + 1]]
+
+        # only store the vertices and faces used by the tile, with new indices
+        usedVertices, tileFaces = np.unique(triangles[tileTriangles], return_inverse=True)
+        polygons, triangleFaces = np.unique(polygonIndices[tileTriangles], return_inverse=True)
+        tileVertices = vertices[usedVertices]
+
+        boundsMin[tileIndex] = tileVertices.min(axis=0)
+        boundsMax[tileIndex] = tileVertices.max(axis=0)
+
+        np.savez(os.path.join(directoryPath, "tile_%d.npz" % tileIndex),
+                 vertices=tileVertices, triangles=tileFaces.reshape(-1, 3),
+                 triangleFaces=triangleFaces, polygons=polygons, faceNormals=faceNormals[polygons])
+
+    np.savez(os.path.join(directoryPath, "index.npz"), boundsMin=boundsMin, boundsMax=boundsMax)
+
+    print("Split %s into %d tiles" % (sourceObject.name, len(uniqueKeys)))
+
+def loadTiledTree(directoryPath, maxLoadedTiles, temporaryDirectory=None):
+    with np.load(os.path.join(directoryPath, "index.npz")) as data:
+        boundsMin = data["boundsMin"]
+        boundsMax = data["boundsMax"]
+
+    return TiledTree(directoryPath, boundsMin, boundsMax, maxLoadedTiles, temporaryDirectory)
+
+def getTiledTree(sourceObject, depsgraph, meshCache=None):
+    if meshCache is not None:
+        # the tiles of unchanged meshes are loaded from the cache
+        return meshCache.getTiledTree(sourceObject, depsgraph, getMaxLoadedTiles(sourceObject))
+
+    # the tiles are only needed during this scan
+    temporaryDirectory = tempfile.TemporaryDirectory(prefix="range_scanner_tiles_")
+
+    writeTiles(temporaryDirectory.name, sourceObject, depsgraph)
+
+    return loadTiledTree(temporaryDirectory.name, getMaxLoadedTiles(sourceObject), temporaryDirectory)
@@ -0,0 +1,109 @@
+import numpy as np
+
+# all functions in this file work on the columns of all hits of one frame (N = number of hits)
+# so that the sensor model can be applied without casting any rays
+# this allows us to re-run different weather/noise settings on the same geometric data
+
+class SensorModelResult:
+    def __init__(self, intensity, isVisible, location, distance, noiseDistance, noiseLocation):
+        self.intensity = intensity          # (N)
+        self.isVisible = isVisible          # (N) bool
+        self.location = location            # (N x 3) hit location, dust returns are moved to the dust cloud
+        self.distance = distance            # (N)
+        self.noiseDistance = noiseDistance  # (N)
+        self.noiseLocation = noiseLocation  # (N x 3)
+
+def getReflectivityThreshold(distances, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper):
+    # source: https://github.com/mgschwan/blensor/blob/0b6cca9f189b1e072cfd8aaa6360deeab0b96c61/release/scripts/addons/blensor/scan_interface_pure.py#L9
+    with np.errstate(divide='ignore', invalid='ignore'):
+        threshold = reflectivityLower + ((reflectivityUpper - reflectivityLower) * distances) / (distanceUpper - distanceLower)
+
+    return np.where(distances >= distanceLower, threshold, 0.0)
+
+def getNoiseLocations(origins, directions, noiseDistances):
+    # we can't simply move the hit location around by some random translation
+    # instead, we have to move it along the (normalized) ray direction
+    return origins + directions * noiseDistances[:, np.newaxis]
+
+def applyLidarSensorModel(origins, directions, locations, distances, rayDistances, intensities,
+                          reflectivityLower, distanceLower, reflectivityUpper, distanceUpper,
+                          noiseAbsoluteOffset, noiseRelativeOffset, gaussianNoise,
+                          simulateRain, rainfallRate, rainNoise,
+                          simulateDust, particleRadius, particlesPcm, dustCloudLength, dustCloudStart,
+                          echo='strongest'):
+    # origins       (N x 3) or (3) sensor location
+    # directions    (N x 3) normalized ray directions
+    # locations     (N x 3) hit locations
+    # distances     (N) measured distance (for tof sensors: distance to the camera plane)
+    # rayDistances  (N) distance along the ray, used to move the noise location
+    # intensities   (N) returned intensity before any weather effects
+    # gaussianNoise (N) or None, rainNoise (N) standard normal values or None
+    # echo          echo type of the geometric data, decides between dust cloud and target behind it
+    distances = np.array(distances, dtype=np.float64)
+    rayDistances = np.array(rayDistances, dtype=np.float64)
+    intensities = np.array(intensities, dtype=np.float64)
+    locations = np.array(locations, dtype=np.float64).reshape(-1, 3)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    origins = np.asarray(origins, dtype=np.float64)
+
+    noise = noiseAbsoluteOffset + (distances * noiseRelativeOffset / 100.0)
+
+    surfaceReflectivity = intensities.copy()
+
+    rMin = getReflectivityThreshold(distances, reflectivityLower, distanceLower, reflectivityUpper, distanceUpper)
+
+    if simulateRain:
+        # see https://www.researchgate.net/publication/330415308_Predicting_the_influence_of_rain_on_LIDAR_in_ADAS for details
+        noise += rainNoise * 0.02 * distances * (1 - np.e ** -rainfallRate) ** 2 # equation (9)
+
+        # coefficient following observation
+        backScatteringCoefficientRain = 0.01 * rainfallRate ** 0.6 # equation (5)
+
+        surfaceReflectivity += np.exp(-2 * backScatteringCoefficientRain * distances) - 1
+
+    if simulateDust:
+        # see: https://www.researchgate.net/publication/313582355_When_the_Dust_Settles_The_Four_Behaviors_of_LiDAR_in_the_Presence_of_Fine_Airborne_Particulates
+        r = particleRadius * 10**(-6)
+        n = particlesPcm
+        Ld = dustCloudLength
+        Rd = dustCloudStart
+
+        # targets in front of the dust cloud are not affected at all
+        isBehindDust = distances >= Rd
+
+        beta = (r**2 * n) / 4 # eq. (31)
+
+        # light is reflected by the cloud -> appears as solid object
+        isDustReturn = isBehindDust & (beta > rMin)
+
+        # otherwise, the light enters the dust cloud and is weakened by the part of the
+        # dust cloud which is in front of the target
+        relevantDustCloudLength = np.clip(distances - Rd, 0.0, Ld)
+        alpha = np.exp(-2 * np.pi * r**2 * n * relevantDustCloudLength) # eq. (32)
+
+        if echo == 'last':
+            # the dust cloud is only the last echo if the target behind it can't be seen anymore
+            isDustReturn &= ~(surfaceReflectivity * alpha > rMin)
+
+        surfaceReflectivity = np.where(isBehindDust & ~isDustReturn, surfaceReflectivity * alpha, surfaceReflectivity)
+
+        # update the dust returns to the dust cloud
+        surfaceReflectivity[isDustReturn] = beta
+        intensities[isDustReturn] = beta
+        distances[isDustReturn] = Rd
+        rayDistances[isDustReturn] = Rd
+        locations[isDustReturn] = (origins + directions * Rd)[isDustReturn]
+
+    # if the return is not powerful enough, the detector can't see it at all
+    isVisible = surfaceReflectivity > rMin
+    intensities[~isVisible] = 0.0
+
+    if gaussianNoise is not None:
+        # error model: https://github.com/mgschwan/blensor/blob/master/release/scripts/addons/blensor/gaussian_error_model.py#L21
+        #              https://github.com/mgschwan/blensor/blob/0b6cca9f189b1e072cfd8aaa6360deeab0b96c61/release/scripts/addons/blensor/generic_lidar.py#L172
+        noise += gaussianNoise
+
+    noiseDistances = rayDistances + noise
+    noiseLocations = getNoiseLocations(origins, directions, noiseDistances)
+
+    return SensorModelResult(intensities, isVisible, locations, distances, noiseDistances, noiseLocations)
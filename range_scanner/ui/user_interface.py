@@ -40,6 +40,8 @@ from bpy.utils import register_class, unregister_class
 
 from ..scanners import hit_info
 from ..scanners import generic
+from ..scanners import lidar
+from .. import model_cache
 
 import time
 import os
@@ -363,8 +365,8 @@ class ScannerProperties(PropertyGroup):
     )
 
     joinMeshes: BoolProperty(
-        name="Join static meshes",
-        description="Join all static meshes in the scene",
+        name="Merge static meshes",
+        description="Cast rays against one BVH tree over all static meshes in the scene instead of one tree per object. The objects in the scene are not modified",
         default = False
     )
 
@@ -428,6 +430,16 @@ class ScannerProperties(PropertyGroup):
         max = 1000
     )
 
+    echoMode: EnumProperty(
+        name="Echo",
+        description="Select which return is reported if a ray produces more than one (e.g. through glass or dust)",
+        items=[ ('strongest', "Strongest", "Report the return with the highest intensity"),
+                ('first', "First", "Report the closest return"),
+                ('last', "Last", "Report the farthest return"),
+                ('all', "All", "Export first, strongest and last return as separate point clouds"),
+        ]
+    )
+
 
 
 
@@ -508,6 +520,12 @@ class ScannerProperties(PropertyGroup):
         subtype='DIR_PATH'
     )
 
+    cacheModels: BoolProperty(
+        name="Cache models",
+        description="Store each imported model as .blend file in the temporary directory, so that later scans don't have to import it again",
+        default = False
+    )
+
     enableModification: BoolProperty(
         name="Enable random modification",
         description="Enable or disable modification of the selected object",
@@ -721,6 +739,13 @@ class ScannerProperties(PropertyGroup):
         default = 0.01,
     )
 
+    noiseSeed: IntProperty(
+        name = "Seed",
+        description = "Seed for all random values of a scan. The same seed always leads to the same noise",
+        default = 0,
+        min = 0,
+    )
+
 
     addConstantNoise: BoolProperty(
         name="Add constant offset",
@@ -849,6 +874,41 @@ class ScannerProperties(PropertyGroup):
         default = False
     ) 
 
+    exportWaterfall: BoolProperty(
+        name="Export waterfall image",
+        description="Write a side-scan waterfall image (one row per ping) while scanning",
+        default = False
+    )
+
+    waterfallResolution: IntProperty(
+        name = "Range bins",
+        description = "Number of range bins per side of the waterfall image",
+        default = 512,
+        min = 1,
+        max = 65536
+    )
+
+    waterfallBitDepth: EnumProperty(
+        name="Bit depth",
+        description="Bit depth of the waterfall image",
+        items=[ ('8', "8 bit", ""),
+                ('16', "16 bit", ""),
+        ],
+        default='16'
+    )
+
+    waterfallGroundRange: BoolProperty(
+        name="Ground range",
+        description="If enabled, the horizontal distance to each hit is used for the range bins. If disabled, the slant range is used",
+        default = False
+    )
+
+    cacheGeometry: BoolProperty(
+        name="Cache geometric scan",
+        description="Store the scan result before weather and noise are applied, so that other weather/noise settings can be applied later without scanning again",
+        default = False
+    )
+
     dataFilePath : StringProperty(
         name="Directory",
         description="Path to Directory",
@@ -1033,6 +1093,26 @@ class ScannerProperties(PropertyGroup):
         max = 100000
     )
 
+    levelOfDetail: BoolProperty(
+        name="Level of detail",
+        description="Use decimated versions of high-poly meshes for far away objects, depending on the distance between two neighboring rays",
+        default = False
+    )
+
+    cacheMeshes: BoolProperty(
+        name="Cache meshes",
+        description="Store the prepared geometry of each mesh on disk, so that later scans of unchanged meshes don't have to prepare it again",
+        default = False
+    )
+
+    meshCacheSize: IntProperty(
+        name = "Cache size (MB)",
+        description = "Maximum size of the mesh cache on disk, the least recently used meshes are deleted first",
+        default = 2048,
+        min = 1,
+        max = 1000000
+    )
+
 
     ############################################################# 
     #                                                           #
@@ -1071,6 +1151,20 @@ class ScannerProperties(PropertyGroup):
         default = False
     )
 
+    sonarMultibeam: BoolProperty(
+        name="Multibeam",
+        description="Simulate a multibeam echosounder: one across-track fan of beams per frame spanning the whole field of view",
+        default = False
+    )
+
+    numberOfBeams: IntProperty(
+        name = "Beams",
+        description = "Number of beams of the multibeam fan",
+        default = 256,
+        min = 2,
+        max = 4096
+    )
+
 
     # default values taken from this example: https://dosits.org/science/advanced-topics/sonar-equation/sonar-equation-example-active-sonar/
     sourceLevel: FloatProperty(
@@ -1160,7 +1254,9 @@ class ScannerProperties(PropertyGroup):
 #                                                           #
 #############################################################
 
-def modifyAndScan(context, properties, objectName):
+def modifyAndScan(context, properties, objectName, modificationIndices=None, randomGenerator=random):
+    # modificationIndices: only scan these modifications (default: all), used by the dataset job runner
+    # randomGenerator: source of the random modifications, the job runner passes a seeded random.Random
     # random modifications enabled
     if properties.enableModification:
         # store the objects pose as default
@@ -1170,33 +1266,36 @@ def modifyAndScan(context, properties, objectName):
         oldRotation = matrixWorldDecomposed[1].to_euler()
         oldScale = matrixWorldDecomposed[2]
 
+        if modificationIndices is None:
+            modificationIndices = range(properties.numberOfModifications)
+
         # repeat the given number of times
-        for i in range(properties.numberOfModifications):
+        for i in modificationIndices:
             # generate random values for translation, rotation and scaling
-            transX = random.uniform(properties.minTransX, properties.maxTransX)
-            transY = random.uniform(properties.minTransY, properties.maxTransY)
-            transZ = random.uniform(properties.minTransZ, properties.maxTransZ)
+            transX = randomGenerator.uniform(properties.minTransX, properties.maxTransX)
+            transY = randomGenerator.uniform(properties.minTransY, properties.maxTransY)
+            transZ = randomGenerator.uniform(properties.minTransZ, properties.maxTransZ)
 
             # add the values
             properties.swapObject.location = oldLocation + Vector((transX, transY, transZ))
             
-            rotX = random.uniform(properties.minRotX, properties.maxRotX)
-            rotY = random.uniform(properties.minRotY, properties.maxRotY)
-            rotZ = random.uniform(properties.minRotZ, properties.maxRotZ)
+            rotX = randomGenerator.uniform(properties.minRotX, properties.maxRotX)
+            rotY = randomGenerator.uniform(properties.minRotY, properties.maxRotY)
+            rotZ = randomGenerator.uniform(properties.minRotZ, properties.maxRotZ)
 
             properties.swapObject.rotation_mode = 'XYZ'
             properties.swapObject.rotation_euler = Euler((oldRotation[0] + radians(rotX), oldRotation[1] + radians(rotY), oldRotation[2] + radians(rotZ)), 'XYZ')
 
             # if uniform sclaing is enabled, all values should be scaled the same
             if properties.uniformScaling:
-                scaleAll = random.uniform(properties.minScaleAll, properties.maxScaleAll)
+                scaleAll = randomGenerator.uniform(properties.minScaleAll, properties.maxScaleAll)
                 properties.swapObject.scale[0] = oldScale[0] * scaleAll
                 properties.swapObject.scale[1] = oldScale[1] * scaleAll
                 properties.swapObject.scale[2] = oldScale[2] * scaleAll
             else:
-                scaleX = random.uniform(properties.minScaleX, properties.maxScaleX)
-                scaleY = random.uniform(properties.minScaleY, properties.maxScaleY)
-                scaleZ = random.uniform(properties.minScaleZ, properties.maxScaleZ)
+                scaleX = randomGenerator.uniform(properties.minScaleX, properties.maxScaleX)
+                scaleY = randomGenerator.uniform(properties.minScaleY, properties.maxScaleY)
+                scaleZ = randomGenerator.uniform(properties.minScaleZ, properties.maxScaleZ)
                 properties.swapObject.scale[0] = oldScale[0] * scaleX
                 properties.swapObject.scale[1] = oldScale[1] * scaleY
                 properties.swapObject.scale[2] = oldScale[2] * scaleZ
@@ -1208,104 +1307,110 @@ def modifyAndScan(context, properties, objectName):
     else:
         generic.startScan(context, properties, objectName)
 
-def performScan(context, properties):
-    if properties.joinMeshes:
-        # for large groups of objects it seems to be a good idea to join them into one
-        # mesh to speed up performance
-        # of course this also needs some time, but it still faster overall
-
-        # get all meshes, but exclude animated objects and the swap object as they are
-        # modified during the simulation
-        targets = list(filter(lambda x: x.type == 'MESH' and # object has some kind of geometry
-                                        x != properties.swapObject and # exclude swap object
-                                        (x.animation_data == None or x.animation_data.action == None) and # exclude animated objects
-                                        x.hide_get() == False and # exclude hidden objects
-                                        x.active_material != None and # only consider targets with a material set
-                                        'categoryID' not in x and 'partID' not in x # exclude objects with semantic mappings
-        , bpy.context.scene.objects))
-
-        if len(targets) > 1:
-            # the following block joins all objects so that there is only one BVHTree for all of them
-            # this leads to some perfomance improvement, but needs more memory as objects are stored
-            # multiple times instead of using instances
-            bpy.ops.object.select_all(action='DESELECT')
-
-            for target in targets:
-                target.select_set(True)
-
-            context.view_layer.objects.active = targets[0]
-
-            print("Joining %d meshes..." % len(targets))
-            
-            bpy.ops.object.join()
+def getModelFiles(modelsFilePath):
+    # get all files that can be imported in a given directory
+    filePaths = []
 
-            print("Done.")
+    absolutePath = bpy.path.abspath(modelsFilePath)
 
-    # swapping enabled, so load all objects inside the given path and place them into the scene
-    if properties.enableSwapping:
-        # get all files that can be imported in a given directory
-        filePaths = []
-
-        absolutePath = bpy.path.abspath(properties.modelsFilePath)
-
-        for path, _, files in os.walk(absolutePath):
-            for name in files:
-                if name.endswith(".fbx") or name.endswith(".gltf") or name.endswith(".glb") or name.endswith(".obj"): # or name.endswith(".x3d") or name.endswith(".wrl"):
-                    # get the full path wich is used to load the obj file
-                    fullPath = os.path.join(path, name)
-
-                    # get the relative path inside the chosen directory to use it as unique name for the output file
-                    relativePath = os.path.relpath(fullPath, absolutePath)
-                    
-                    filePaths.append((fullPath, relativePath))
-                    
-                    print("Found file: ", fullPath)
-                    
-        for (currentFile, fileName) in filePaths:
-            print("Loading model %s" % currentFile)
-
-            # import file
-            if fileName.endswith(".glb") or fileName.endswith(".gltf") :
-                bpy.ops.import_scene.gltf(filepath=currentFile)
-                bpy.context.active_object.select_set(True)
-
-            else:   
-                if fileName.endswith(".fbx"):
-                    bpy.ops.import_scene.fbx(filepath=currentFile)
-
-                if fileName.endswith(".glb") or fileName.endswith(".gltf") :
-                    bpy.ops.import_scene.gltf(filepath=currentFile)
-
-                if fileName.endswith(".obj"):
-                    bpy.ops.import_scene.obj(filepath=currentFile)
-
-                # the .x3d format importer seems to not support materials -> the scanner needs some material to perform calculations,
-                # so we don't use this format for now :(
-                #if fileName.endswith(".x3d") or fileName.endswith(".wrl"):
-                #    bpy.ops.import_scene.x3d(filepath=currentFile)
+    for path, _, files in os.walk(absolutePath):
+        for name in files:
+            if name.endswith(".fbx") or name.endswith(".gltf") or name.endswith(".glb") or name.endswith(".obj"): # or name.endswith(".x3d") or name.endswith(".wrl"):
+                # get the full path wich is used to load the obj file
+                fullPath = os.path.join(path, name)
+
+                # get the relative path inside the chosen directory to use it as unique name for the output file
+                relativePath = os.path.relpath(fullPath, absolutePath)
                 
-                # set the selected objects active
-                # we don't need this step fpr gltf files as the importer already sets the object as active
-                context.view_layer.objects.active = bpy.context.selected_objects[0]
-            
-            # join objects in case the model consists of multiple parts
-            # otherwise we can't simply transfer all properties of the original object
-            bpy.ops.object.join()
+                filePaths.append((fullPath, relativePath))
+                
+                print("Found file: ", fullPath)
+
+    # the order of os.walk depends on the file system, but the dataset job runner needs a stable order
+    filePaths.sort(key=lambda filePath: filePath[1])
+
+    return filePaths
+
+def swapModel(context, properties, currentFile, fileName):
+    if properties.cacheModels:
+        cachePath = model_cache.getCachePath(model_cache.defaultDirectory, currentFile)
 
-            # get reference to imported object
-            importedObject = context.view_layer.objects.active
+        if os.path.exists(cachePath):
+            print("Loading model %s from cache" % currentFile)
 
-            # we copy the data instead of deleting the old and adding the new object
-            # to keep properties like translation, rotation, animation steps, etc.
-            properties.swapObject.data = importedObject.data
+            properties.swapObject.data = model_cache.loadMesh(cachePath)
+            return
 
-            # if you want to keep the translation (or any other property) of the original object, you can use following code
-            #originalTranslation = properties.swapObject.matrix_world.translation.copy()
-            #properties.swapObject.matrix_world = importedObject.matrix_world
-            #properties.swapObject.matrix_world.translation = originalTranslation
+    print("Loading model %s" % currentFile)
 
-            # delete the imported object as we copied it and don't need it anymore
-            bpy.ops.object.delete({"selected_objects": [importedObject]})
+    # import file
+    if fileName.endswith(".glb") or fileName.endswith(".gltf") :
+        bpy.ops.import_scene.gltf(filepath=currentFile)
+        bpy.context.active_object.select_set(True)
+
+    else:   
+        if fileName.endswith(".fbx"):
+            bpy.ops.import_scene.fbx(filepath=currentFile)
+
+        if fileName.endswith(".glb") or fileName.endswith(".gltf") :
+            bpy.ops.import_scene.gltf(filepath=currentFile)
+
+        if fileName.endswith(".obj"):
+            bpy.ops.import_scene.obj(filepath=currentFile)
+
+        # the .x3d format importer seems to not support materials -> the scanner needs some material to perform calculations,
+        # so we don't use this format for now :(
+        #if fileName.endswith(".x3d") or fileName.endswith(".wrl"):
+        #    bpy.ops.import_scene.x3d(filepath=currentFile)
+        
+        # set the selected objects active
+        # we don't need this step fpr gltf files as the importer already sets the object as active
+        context.view_layer.objects.active = bpy.context.selected_objects[0]
+    
+    # join objects in case the model consists of multiple parts
+    # otherwise we can't simply transfer all properties of the original object
+    bpy.ops.object.join()
+
+    # get reference to imported object
+    importedObject = context.view_layer.objects.active
+
+    # we copy the data instead of deleting the old and adding the new object
+    # to keep properties like translation, rotation, animation steps, etc.
+    properties.swapObject.data = importedObject.data
+
+    if properties.cacheModels:
+        model_cache.saveMesh(cachePath, importedObject.data)
+
+    # if you want to keep the translation (or any other property) of the original object, you can use following code
+    #originalTranslation = properties.swapObject.matrix_world.translation.copy()
+    #properties.swapObject.matrix_world = importedObject.matrix_world
+    #properties.swapObject.matrix_world.translation = originalTranslation
+
+    # delete the imported object as we copied it and don't need it anymore
+    bpy.ops.object.delete({"selected_objects": [importedObject]})
+
+def resensorizeScan(properties, dataFileName, outputFileName, addMesh, frameRange=None):
+    # apply the current sensor model and export settings to the cached geometry of each echo type
+    echoTypes = generic.getEchoTypes(properties.echoMode)
+
+    for echo in echoTypes:
+        echoSuffix = "_%s_echo" % echo if len(echoTypes) > 1 else ""
+
+        lidar.resensorize(properties.dataFilePath, dataFileName, outputFileName,
+                          properties.reflectivityLower, properties.distanceLower, properties.reflectivityUpper, properties.distanceUpper,
+                          properties.addNoise, properties.noiseType, properties.mu, properties.sigma, properties.addConstantNoise, properties.noiseAbsoluteOffset, properties.noiseRelativeOffset, properties.noiseSeed,
+                          properties.simulateRain, properties.rainfallRate,
+                          properties.simulateDust, properties.particleRadius, properties.particlesPcm, properties.dustCloudLength, properties.dustCloudStart,
+                          addMesh,
+                          properties.exportLAS, properties.exportHDF, properties.exportCSV, properties.exportPLY, properties.exportSingleFrames,
+                          properties.exportSegmentedImage, properties.exportPascalVoc, properties.exportDepthmap, properties.depthMinDistance, properties.depthMaxDistance,
+                          frameRange, echoSuffix)
+
+def performScan(context, properties):
+    # swapping enabled, so load all objects inside the given path and place them into the scene
+    if properties.enableSwapping:
+        for (currentFile, fileName) in getModelFiles(properties.modelsFilePath):
+            swapModel(context, properties, currentFile, fileName)
 
             modifyAndScan(context, properties, fileName)
     else:
@@ -1330,6 +1435,8 @@ def scan_rotating(context,
         dataFilePath, dataFileName,
         
         debugLines, debugOutput, outputProgress, measureTime, singleRay, destinationObject, targetObject,
+
+        noiseSeed=0, cacheGeometry=False, echoMode='strongest', levelOfDetail=False, cacheMeshes=False, meshCacheSize=2048,
 ):
 
     scene = context.scene
@@ -1362,6 +1469,12 @@ def scan_rotating(context,
     properties.sigma = sigma
     properties.noiseAbsoluteOffset = noiseAbsoluteOffset
     properties.noiseRelativeOffset = noiseRelativeOffset
+    properties.noiseSeed = noiseSeed
+    properties.cacheGeometry = cacheGeometry
+    properties.levelOfDetail = levelOfDetail
+    properties.cacheMeshes = cacheMeshes
+    properties.meshCacheSize = meshCacheSize
+    properties.echoMode = echoMode
 
     properties.simulateRain = simulateRain
     properties.rainfallRate = rainfallRate
@@ -1407,6 +1520,9 @@ def scan_sonar(context,
         dataFilePath, dataFileName,
         
         debugLines, debugOutput, outputProgress, measureTime, singleRay, destinationObject, targetObject,
+
+        noiseSeed=0, exportWaterfall=False, waterfallResolution=512, waterfallBitDepth='16', waterfallGroundRange=False,
+        sonarMultibeam=False, numberOfBeams=256, levelOfDetail=False, cacheMeshes=False, meshCacheSize=2048,
 ):
 
     scene = context.scene
@@ -1420,6 +1536,11 @@ def scan_sonar(context,
     properties.sonarStepDegree = sonarStepDegree
     properties.sonarMode3D = sonarMode3D
     properties.sonarKeepRotation = sonarKeepRotation
+    properties.sonarMultibeam = sonarMultibeam
+    properties.numberOfBeams = numberOfBeams
+    properties.levelOfDetail = levelOfDetail
+    properties.cacheMeshes = cacheMeshes
+    properties.meshCacheSize = meshCacheSize
 
     properties.sourceLevel = sourceLevel
     properties.noiseLevel = noiseLevel
@@ -1441,6 +1562,7 @@ def scan_sonar(context,
     properties.sigma = sigma
     properties.noiseAbsoluteOffset = noiseAbsoluteOffset
     properties.noiseRelativeOffset = noiseRelativeOffset
+    properties.noiseSeed = noiseSeed
 
     properties.simulateRain = simulateRain
     properties.rainfallRate = rainfallRate
@@ -1452,6 +1574,10 @@ def scan_sonar(context,
     properties.exportCSV = exportCSV
     properties.exportPLY = exportPLY
     properties.exportSingleFrames = exportSingleFrames
+    properties.exportWaterfall = exportWaterfall
+    properties.waterfallResolution = waterfallResolution
+    properties.waterfallBitDepth = waterfallBitDepth
+    properties.waterfallGroundRange = waterfallGroundRange
     properties.dataFilePath = dataFilePath
     properties.dataFileName = dataFileName
     
@@ -1486,6 +1612,8 @@ def scan_static(context,
         dataFilePath, dataFileName,
         
         debugLines, debugOutput, outputProgress, measureTime, singleRay, destinationObject, targetObject,
+
+        noiseSeed=0, cacheGeometry=False, echoMode='strongest', levelOfDetail=False, cacheMeshes=False, meshCacheSize=2048,
 ):
 
     scene = context.scene
@@ -1518,6 +1646,12 @@ def scan_static(context,
     properties.sigma = sigma
     properties.noiseAbsoluteOffset = noiseAbsoluteOffset
     properties.noiseRelativeOffset = noiseRelativeOffset
+    properties.noiseSeed = noiseSeed
+    properties.cacheGeometry = cacheGeometry
+    properties.levelOfDetail = levelOfDetail
+    properties.cacheMeshes = cacheMeshes
+    properties.meshCacheSize = meshCacheSize
+    properties.echoMode = echoMode
 
     properties.simulateRain = simulateRain
     properties.rainfallRate = rainfallRate
@@ -1654,6 +1788,21 @@ class WM_OT_GENERATE_POINT_CLOUDS(Operator):
 
         return {'FINISHED'}
 
+class WM_OT_RESENSORIZE(Operator):
+    bl_label = "Re-apply weather and noise"
+    bl_idname = "wm.resensorize"
+    bl_description = "Apply the current weather, noise and export settings to the cached geometric scan with the given file name"
+
+    def execute(self, context):
+        scene = context.scene
+        properties = scene.scannerProperties
+
+        dataFileName = generic.removeInvalidCharatersFromFileName(properties.dataFileName)
+
+        resensorizeScan(properties, dataFileName, "%s_resensorized" % dataFileName, properties.addMesh)
+
+        return {'FINISHED'}
+
 # define UI panels
 class OBJECT_PT_MAIN_PANEL(MAIN_PANEL, Panel):
     bl_label = "Point clouds"
@@ -1723,6 +1872,7 @@ class OBJECT_PT_REFLECTIVITY_PANEL(MAIN_PANEL, Panel):
 
         layout.separator()
         layout.prop(properties, "maxReflectionDepth")
+        layout.prop(properties, "echoMode")
 
 
 class OBJECT_PT_SCANNER_PANEL(MAIN_PANEL, Panel):
@@ -1745,12 +1895,22 @@ class OBJECT_PT_SCANNER_PANEL(MAIN_PANEL, Panel):
 
         if properties.scannerType == generic.ScannerType.sideScan.name:
             layout.prop(properties, "fovSonar")
-            layout.prop(properties, "sonarStepDegree")
+
             row = layout.row()
-            row.prop(properties, "sonarMode3D")
+            row.prop(properties, "sonarMultibeam")
             column = row.column()
-            column.prop(properties, "sonarKeepRotation")
-            column.enabled = not properties.sonarMode3D
+            column.prop(properties, "numberOfBeams")
+            column.enabled = properties.sonarMultibeam
+
+            # the multibeam fan always produces 3D bathymetry points
+            column = layout.column()
+            column.prop(properties, "sonarStepDegree")
+            row = column.row()
+            row.prop(properties, "sonarMode3D")
+            subColumn = row.column()
+            subColumn.prop(properties, "sonarKeepRotation")
+            subColumn.enabled = not properties.sonarMode3D
+            column.enabled = not properties.sonarMultibeam
                 
             layout.separator()
 
@@ -1828,6 +1988,15 @@ class OBJECT_PT_SCANNER_PANEL(MAIN_PANEL, Panel):
 
             layout.prop(properties, "resolutionPercentage")
 
+        layout.separator()
+
+        layout.prop(properties, "levelOfDetail")
+
+        layout.prop(properties, "cacheMeshes")
+        meshCacheLayout = layout.column()
+        meshCacheLayout.prop(properties, "meshCacheSize")
+        meshCacheLayout.enabled = properties.cacheMeshes
+
 class OBJECT_PT_ANIMATION_PANEL(MAIN_PANEL, Panel):
     bl_parent_id = "OBJECT_PT_MAIN_PANEL"
     bl_label = "Animation"
@@ -1874,6 +2043,7 @@ class OBJECT_PT_OBJECT_MODIFICATION_PANEL(MAIN_PANEL, Panel):
         verticalLayout = layout.column()
         verticalLayout.enabled = properties.enableSwapping
         verticalLayout.prop(properties, "modelsFilePath")
+        verticalLayout.prop(properties, "cacheModels")
 
         layout.separator()
         layout.separator()
@@ -1966,6 +2136,10 @@ class OBJECT_PT_NOISE_PANEL(MAIN_PANEL, Panel):
         verticalLayout.prop(properties, "sigma")
         column.enabled = properties.addNoise
 
+        layout.separator()
+
+        layout.prop(properties, "noiseSeed")
+
 
 class OBJECT_PT_WEATHER_PANEL(MAIN_PANEL, Panel):
     bl_parent_id = "OBJECT_PT_MAIN_PANEL"
@@ -2028,6 +2202,24 @@ class OBJECT_PT_EXPORT_PANEL(MAIN_PANEL, Panel):
         layout.prop(properties, "exportPLY")
         layout.prop(properties, "exportSingleFrames")
 
+        if properties.scannerType == generic.ScannerType.sideScan.name:
+            layout.separator()
+
+            layout.label(text="Waterfall")
+            layout.prop(properties, "exportWaterfall")
+            waterfallLayout = layout.column()
+            waterfallLayout.prop(properties, "waterfallResolution")
+            waterfallLayout.prop(properties, "waterfallBitDepth")
+            waterfallLayout.prop(properties, "waterfallGroundRange")
+            waterfallLayout.enabled = properties.exportWaterfall
+
+        if properties.scannerType != generic.ScannerType.sideScan.name:
+            layout.separator()
+
+            layout.label(text="Geometric cache")
+            layout.prop(properties, "cacheGeometry")
+            layout.operator("wm.resensorize")
+
         layout.separator()
 
         if properties.scannerType == generic.ScannerType.static.name:
@@ -2237,6 +2429,7 @@ classes = (
 
     ScannerProperties,
     WM_OT_GENERATE_POINT_CLOUDS,
+    WM_OT_RESENSORIZE,
     OBJECT_PT_MAIN_PANEL,
     OBJECT_PT_PRESET_PANEL,
     OBJECT_PT_SCANNER_PANEL,
@@ -104,7 +104,10 @@ settings.use_scale_instance = True
 settings.particle_size = 1
 # settings.instance_object = bpy.data.objects["grass"]
 settings.instance_collection = bpy.data.collections["grass_blueprints"]
-bpy.ops.object.duplicates_make_real()
+
+# the instances don't have to be made real, the scanner reads them from the depsgraph
+# and all blades of the same blueprint share one BVH tree
+#bpy.ops.object.duplicates_make_real()
 
 
 
@@ -165,11 +168,12 @@ scale = (randint(8, 12) / 10.0)
 tree.scale = (scale, scale, scale)
 
 # spawn some more trees
-# use copies to speed things up: https://stackoverflow.com/a/48819995/13440564
+# use linked copies to speed things up: https://stackoverflow.com/a/48819995/13440564
+# objects sharing the same mesh also share one BVH tree in the scanner
 for _ in range(numberOfTrees):
     index = randint(0, len(coords))
             
-    m = tree.data.copy()
+    m = tree.data
     o = bpy.data.objects.new("cube", m)
     o.location = coords[index]
     scale = (randint(5, 15) / 10.0)
@@ -183,7 +187,7 @@ for _ in range(numberOfTrees):
     bpy.context.scene.collection.objects.link(o)
     
 
-    m = leaves.data.copy()
+    m = leaves.data
     o = bpy.data.objects.new("cube", m)
     o.location = coords[index]
     o.scale = (scale, scale, scale)